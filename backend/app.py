@@ -1,23 +1,37 @@
 import os
 import psycopg2
+import psycopg2.errors
 from psycopg2.extras import RealDictCursor, execute_values, DictCursor  # Added DictCursor if needed
 import pandas as pd
 import io
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, g, has_request_context
 from flask_cors import CORS
 import datetime
 import re
+import tempfile
+import threading
+import urllib.parse
 # werkzeug.utils is already imported implicitly by Flask, but good to be explicit if using functions
 # from werkzeug.utils import secure_filename # Uncomment if you explicitly use secure_filename
 
 # Assume scheduler_module.py is available and imported correctly
-# Make sure your scheduler_module.py contains load_data_from_db and generate_excel_report_for_send_file
+# Make sure your scheduler_module.py contains load_semester_data_from_db and generate_excel_report_for_send_file
 # and the TimetableEntry class (likely a namedtuple or dataclass)
 import scheduler_module
+import course_plan_import
+import db_pool
+import export_cache
+import ical_export
+import job_queue
+import reference_cache
+import migrate
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
+# Background job worker threads started inside the API process (0 = only use job_worker.py processes)
+JOB_WORKER_THREADS = int(os.getenv("JOB_WORKER_THREADS", "1"))
+
 # --- Database Configuration ---
 # TODO: In production, use environment variables exclusively and avoid default sensitive values
 DB_HOST = os.getenv("DB_HOST", "localhost")
@@ -26,8 +40,40 @@ DB_USER = os.getenv("DB_USER", "postgres")  # Replace with your DB user
 DB_PASSWORD = os.getenv("DB_PASSWORD", "031104")  # Replace with your DB password
 
 
+# Connection pool shared by the request handlers, the in-process job workers and the scheduler (one pool per process)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+DB_POOL_HEALTHCHECK_IDLE = float(os.getenv("DB_POOL_HEALTHCHECK_IDLE", "30"))  # ping connections idle longer than this
+
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+
 # WARNING: Storing password directly in code or env vars is not ideal for production.
 # Consider using a secrets management system.
+def connect_db():
+    """Opens a new, unpooled database connection (used by the pool, and by tools that change session settings)."""
+    return psycopg2.connect(
+        host=DB_HOST,
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD
+    )
+
+
+def get_db_pool():
+    """Returns this process's connection pool, creating it on first use (job_worker.py forks before connecting)."""
+    global _db_pool, _db_pool_pid
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool_pid != os.getpid():
+            _db_pool = db_pool.ConnectionPool(connect_db, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX,
+                                              timeout=DB_POOL_TIMEOUT, healthcheck_idle=DB_POOL_HEALTHCHECK_IDLE)
+            _db_pool_pid = os.getpid()
+        return _db_pool
+
+
 def get_teacher_id_by_user_id(user_id):
     conn = None
     cur = None
@@ -37,7 +83,6 @@ def get_teacher_id_by_user_id(user_id):
         cur = conn.cursor()
         cur.execute("SELECT id FROM teachers WHERE user_id = %s", (user_id,))
         teacher_id = cur.fetchone()
-        cur.close()
         return teacher_id[0] if teacher_id else None
     except Exception as e:
         app.logger.error(f"Error getting teacher_id for user {user_id}: {e}", exc_info=True)
@@ -45,23 +90,59 @@ def get_teacher_id_by_user_id(user_id):
     finally:
         if cur: cur.close()
         if conn: conn.close()
+
+
 def get_db_connection():
-    """Establishes and returns a database connection."""
+    """
+    Checks a connection out of the pool; conn.close() returns it.
+    Within a request every call shares one checkout (released when the request ends), so helpers such as
+    get_teacher_id_by_user_id and scheduler_module.load_semester_data_from_db reuse the handler's connection
+    instead of opening another one. Outside a request (job workers) each call is its own checkout.
+    """
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-        # conn.autocommit = True # Only enable autocommit if you are sure you don't need transactions
-        return conn
+        pool = get_db_pool()
+        if not has_request_context():
+            return pool.connection()
+        lease = g.get('db_lease')
+        if lease is None:
+            lease = g.db_lease = pool.checkout(keep=True)
+        return lease.handle()
     except psycopg2.Error as e:
         # Use app.logger for consistent logging
         app.logger.error(f"Error connecting to PostgreSQL database: {e}")
         return None
 
 
+@app.teardown_request
+def release_request_connection(exc):
+    lease = g.pop('db_lease', None)
+    if lease is not None:
+        lease.release()
+
+
+@app.route('/api/db/pool-stats', methods=['GET'])
+def get_db_pool_stats():
+    """Connection pool size and checkout wait-time statistics for this process."""
+    return jsonify(get_db_pool().stats())
+
+
+@app.route('/api/cache/reference-stats', methods=['GET'])
+def get_reference_cache_stats():
+    """Hit/miss counts of the per-process reference data cache used by the exports."""
+    return jsonify(reference_cache.stats())
+
+
+def timetable_source(semester_id, week_number=None):
+    """
+    FROM clause (aliased te) and its leading parameters for reading timetable rows one-per-week.
+    Placements are stored once with a week set and expanded lazily by the timetable_entries_expanded view;
+    a single-week read goes through timetable_entries_for_week() so the GIN index on the week set is used.
+    """
+    if week_number is not None:
+        return "timetable_entries_for_week(%s, %s) te", [semester_id, week_number]
+    return "timetable_entries_expanded te", []
+
+
 @app.route('/register', methods=['POST'])
 def register():
     data = request.get_json()
@@ -159,23 +240,6 @@ def login():
         if conn: conn.close()
 
 
-# --- Helper Function ---
-def get_id_from_name(cur, table_name, name_column, name_value, id_column='id', additional_conditions=None):
-    """Generic function to get ID from a table by name, with optional additional conditions."""
-    query = f"SELECT {id_column} FROM {table_name} WHERE {name_column} = %s"
-    params = [name_value]
-    if additional_conditions:
-        for col, val in additional_conditions.items():
-            query += f" AND {col} = %s"
-            params.append(val)
-    # Use SELECT DISTINCT to avoid potential duplicates if your schema allows (it shouldn't for unique names)
-    # But given your unique constraints, this is fine.
-    cur.execute(query, tuple(params))
-    result = cur.fetchone()
-    # Fetchone returns None if no row, otherwise a tuple. Need to handle the None case.
-    return result[0] if result else None
-
-
 # 在 app.py 文件顶部导入必要的库
 import datetime
 import math # 用于向上取整
@@ -289,6 +353,65 @@ def get_course_plans():
         if conn: conn.close()
 
 
+def format_course_plan_import_message(summary, semester_id):
+    """Chinese summary shown to the user after a course-plan import."""
+    summary_message = f"文件处理完成。处理了 {summary['processed_rows']} 行 Excel 数据。\n"
+    summary_message += f"新建课程: {summary['created_courses']} 个。\n"
+    summary_message += f"更新现有课程信息: {summary['updated_courses']} 个。\n"
+    if summary['mode'] == course_plan_import.IMPORT_MODE_DIFF:
+        summary_message += (f"课程计划条目: 新增 {summary['inserted_assignments']} 条，更新 {summary['updated_assignments']} 条，"
+                            f"删除 {summary['deleted_assignments']} 条，未变化 {summary['unchanged_assignments']} 条 (未变化条目的课表已保留)。\n")
+        if summary['kept_unmatched_assignments']:
+            summary_message += (f"由于有行被跳过，文件中未出现的 {summary['kept_unmatched_assignments']} 条现有课程计划未删除，"
+                                f"请修正后重新导入。\n")
+    else:
+        summary_message += f"导入课程计划条目: {summary['inserted_assignments']} 条 (已覆盖学期 ID {semester_id} 的旧数据)。\n"
+    if summary['error_rows']:
+        summary_message += f"有 {summary['error_rows']} 行数据存在问题已被跳过，请查看问题列表。"
+    return summary_message
+
+
+# --- Course-plan import jobs ---
+# The upload endpoint stores the file with the job (see course_plan_import section 5) and returns at once;
+# a worker runs the import, committing validation errors chunk by chunk so they can be paged while it runs.
+def run_course_plan_import_job(params, report_progress):
+    """Job handler for 'course_plan_import' jobs: imports the stored upload and returns the import summary."""
+    job_id = params['job_id']
+
+    def on_progress(progress):
+        try:
+            report_progress(progress)
+        except job_queue.JobCancelled:
+            if progress['stage'] == 'importing':  # the import is already committed or rolled back otherwise
+                raise
+
+    def on_errors(errors):
+        course_plan_import.record_import_errors(get_db_connection, job_id, errors)
+
+    try:
+        # Start from an empty error list in case a crashed worker's job is being re-run
+        course_plan_import.record_import_errors(get_db_connection, job_id, [], clear=True)
+        with tempfile.TemporaryFile() as upload:
+            course_plan_import.spool_upload(get_db_connection, job_id, upload)
+            upload.seek(0)
+            summary = course_plan_import.import_course_plans(
+                upload, params['filename'], params['semester_id'], get_db_connection,
+                progress_callback=on_progress, mode=params['mode'], error_callback=on_errors)
+    except course_plan_import.CoursePlanImportError as e:
+        raise job_queue.JobFailed(str(e))
+    except (KeyError, ValueError, TypeError) as data_err:
+        raise job_queue.JobFailed(f"Excel 文件数据格式错误: {data_err}。请检查列名和数据类型。")
+    finally:
+        course_plan_import.delete_upload_parts(get_db_connection, job_id)
+    del summary['errors']  # reported through import_job_errors
+    summary['status'] = "partial_success" if summary['error_rows'] else "success"
+    summary['message'] = format_course_plan_import_message(summary, params['semester_id'])
+    return summary
+
+
+job_queue.register_job_handler('course_plan_import', run_course_plan_import_job)
+
+
 @app.route('/api/course-plans/upload', methods=['POST'])
 def upload_course_plans():
     if 'file' not in request.files:
@@ -308,210 +431,68 @@ def upload_course_plans():
         return jsonify({"message": "未选择文件"}), 400
     if semester_id_from_form is None:  # Check explicitly for None
         return jsonify({"message": "缺少 semester_id 参数"}), 400
-    if not (file.filename.endswith('.xlsx') or file.filename.endswith('.xls')):
-        return jsonify({"message": "不支持的文件类型。请上传 .xls 或 .xlsx 文件"}), 400
+    if not file.filename.lower().endswith(course_plan_import.SUPPORTED_EXTENSIONS):
+        return jsonify({"message": "不支持的文件类型。请上传 .xlsx、.xls 或 .csv 文件"}), 400
 
-    conn = None
-    cur = None
-    processed_rows = 0
-    created_courses_count = 0
-    updated_courses_count = 0
-    inserted_assignments_count = 0
-    error_messages = []
+    mode = request.form.get('mode', course_plan_import.IMPORT_MODE_REPLACE)
+    if mode not in course_plan_import.IMPORT_MODES:
+        return jsonify({"message": f"不支持的导入方式: {mode}"}), 400
 
     try:
-        # Use BytesIO to pass the file content to pandas
-        file_content = io.BytesIO(file.read())
-        df = pd.read_excel(file_content,
-                           engine='openpyxl' if file.filename.endswith('.xlsx') else 'xlrd')  # xlrd for .xls
-        actual_columns = [str(col).strip() for col in df.columns]  # Ensure columns are strings and strip whitespace
-        df.columns = actual_columns
-
-        expected_excel_columns = [
-            '学期名称', '专业名称', '课程名称', '总课时',
-            '课程类型', '授课教师姓名', '是否核心课程', '预计学生人数'
-        ]
-        missing_cols = [col for col in expected_excel_columns if col not in df.columns]
-        if missing_cols:
-            return jsonify({"message": f"Excel 文件缺少必需的列: {', '.join(missing_cols)}"}), 400
+        # The upload is copied from werkzeug's spooled temporary file into the job, one part at a time
+        job_id = job_queue.enqueue_job(
+            get_db_connection, 'course_plan_import',
+            {"semester_id": semester_id_from_form, "filename": file.filename, "mode": mode},
+            before_commit=lambda cur, job_id: course_plan_import.save_upload_parts(cur, job_id, file.stream))
+        app.logger.info(f"Course-plan import for semester {semester_id_from_form} queued as job {job_id}")
+        return jsonify({"message": "文件已上传，正在后台导入。", "job_id": job_id}), 202
+    except psycopg2.Error as db_err:
+        app.logger.error(f"Database error queueing course-plan import: {db_err}", exc_info=True)
+        return jsonify({"message": f"数据库操作失败: {db_err}"}), 500
+    except Exception as e:
+        app.logger.error(f"Unknown error queueing course-plan import: {e}", exc_info=True)
+        return jsonify({"message": f"服务器内部错误: {e}"}), 500
 
-        conn = get_db_connection()
-        if conn is None: return jsonify({"message": "数据库连接失败"}), 500
-        cur = conn.cursor()
-        conn.autocommit = False  # Start transaction
 
-        # Verify semester ID and get name from DB
-        cur.execute("SELECT name FROM semesters WHERE id = %s", (semester_id_from_form,))
-        semester_name_from_db_tuple = cur.fetchone()
-        if not semester_name_from_db_tuple:
-            conn.rollback()
-            return jsonify({"message": f"选定的学期ID {semester_id_from_form} 无效"}), 400
-        semester_name_from_db = semester_name_from_db_tuple[0]
-
-        # Clear existing assignments for this semester
-        cur.execute("DELETE FROM course_assignments WHERE semester_id = %s", (semester_id_from_form,))
-        deleted_count = cur.rowcount
-        app.logger.info(f"Deleted {deleted_count} old course_assignments for semester_id {semester_id_from_form}.")
-
-        course_assignments_to_insert = []
-
-        # Pre-fetch common IDs to reduce DB queries in loop (Optional optimization)
-        # majors_map = {row['name']: row['id'] for row in get_db_connection().cursor(cursor_factory=RealDictCursor).execute("SELECT id, name FROM majors").fetchall()} # Example
-        # teachers_map = {row['name']: row['id'] for row in get_db_connection().cursor(cursor_factory=RealDictCursor).execute("SELECT t.id, u.username as name FROM teachers t JOIN users u ON t.user_id = u.id WHERE u.role = 'Teacher'").fetchall()} # Example
-
-        for index, row in df.iterrows():
-            processed_rows += 1
-            try:
-                # Ensure all necessary fields exist and handle potential NaNs from pandas
-                excel_semester_name = str(row.get('学期名称', '')).strip()
-                major_name = str(row.get('专业名称', '')).strip()
-                course_name = str(row.get('课程名称', '')).strip()
-                total_sessions_raw = row.get('总课时')
-                course_type = str(row.get('课程类型', '')).strip()
-                teacher_name = str(row.get('授课教师姓名', '')).strip()
-                is_core_course_str = str(row.get('是否核心课程', '')).strip().lower()
-                expected_students_raw = row.get('预计学生人数')
-
-                # Basic validation
-                if not all([excel_semester_name, major_name, course_name, teacher_name]):
-                    error_messages.append(
-                        f"Row {index + 2}: 必填字段 (学期名称, 专业名称, 课程名称, 授课教师姓名) 不能为空。已跳过。")
-                    continue
-
-                # Validate semester name match
-                if excel_semester_name != semester_name_from_db:
-                    error_messages.append(
-                        f"Row {index + 2}: Excel中的学期名称 '{excel_semester_name}' 与选定的学期 '{semester_name_from_db}' 不匹配。已跳过。")
-                    continue
-
-                # Get Major ID
-                major_id = get_id_from_name(cur, 'majors', 'name', major_name)
-                if major_id is None:
-                    error_messages.append(f"Row {index + 2}: 专业 '{major_name}' 未找到。已跳过。")
-                    continue
-
-                # Validate and get Total Sessions
-                if pd.isna(total_sessions_raw) or not isinstance(total_sessions_raw,
-                                                                 (int, float)) or total_sessions_raw < 0:
-                    error_messages.append(
-                        f"Row {index + 2}: 课程 '{course_name}' 的总课时 '{total_sessions_raw}' 无效。必须是非负整数。已跳过。")
-                    continue
-                total_sessions = int(total_sessions_raw)
-
-                # Get Course ID (create if not exists, update if exists)
-                cur.execute("SELECT id FROM courses WHERE name = %s", (course_name,))
-                course_result = cur.fetchone()
-                course_id = None
-                if course_result:
-                    course_id = course_result[0]
-                    # Check if update is needed before executing UPDATE
-                    cur.execute("SELECT total_sessions, course_type FROM courses WHERE id = %s", (course_id,))
-                    current_course_info = cur.fetchone()
-                    if current_course_info and (
-                            current_course_info[0] != total_sessions or current_course_info[1] != course_type):
-                        cur.execute(
-                            "UPDATE courses SET total_sessions = %s, course_type = %s WHERE id = %s",
-                            (total_sessions, course_type, course_id)
-                        )
-                        if cur.rowcount > 0: updated_courses_count += 1
-                else:
-                    cur.execute(
-                        "INSERT INTO courses (name, total_sessions, course_type) VALUES (%s, %s, %s) RETURNING id",
-                        (course_name, total_sessions, course_type)
-                    )
-                    course_id = cur.fetchone()[0]
-                    created_courses_count += 1
-
-                # Get Teacher ID (Need user_id first)
-                user_id = get_id_from_name(cur, 'users', 'username', teacher_name, id_column='id',
-                                           additional_conditions={'role': 'teacher'})
-                if user_id is None:
-                    error_messages.append(
-                        f"Row {index + 2}: 教师 '{teacher_name}' (角色: Teacher) 未在 users 表中找到。已跳过。")
-                    continue
-                # Then get teacher_id from teachers table using user_id
-                teacher_id = get_id_from_name(cur, 'teachers', 'user_id', user_id, id_column='id')
-                if teacher_id is None:
-                    error_messages.append(
-                        f"Row {index + 2}: 教师 '{teacher_name}' (User ID: {user_id}) 未在 teachers 表中找到 (可能未关联到用户)。已跳过。")
-                    continue
-
-                # Validate and get Expected Students
-                if pd.isna(expected_students_raw) or not isinstance(expected_students_raw,
-                                                                    (int, float)) or expected_students_raw < 0:
-                    error_messages.append(
-                        f"Row {index + 2}: 课程 '{course_name}' 的预计学生人数 '{expected_students_raw}' 无效。必须是非负整数。已跳过。")
-                    continue
-                expected_students = int(expected_students_raw)
-
-                # Determine is_core_course boolean value
-                is_core_course = is_core_course_str in ['是', 'yes', 'true', '1']  # Handle common values
-
-                # Add to batch insert list
-                course_assignments_to_insert.append(
-                    (major_id, course_id, teacher_id, semester_id_from_form, is_core_course, expected_students)
-                )
-
-            except Exception as row_error:
-                # Log the specific row error but continue processing
-                app.logger.error(f"Error processing Excel row {index + 2}: {row_error}", exc_info=True)
-                error_messages.append(
-                    f"处理 Excel 行 {index + 2} 时发生错误: {row_error}。已跳过。")
-                continue  # Continue to the next row
-
-        # Perform batch insert for course assignments
-        if course_assignments_to_insert:
-            insert_query_ca = """
-            INSERT INTO course_assignments (major_id, course_id, teacher_id, semester_id, is_core_course, expected_students)
-            VALUES %s
-            """
-            try:
-                execute_values(cur, insert_query_ca, course_assignments_to_insert, page_size=100)
-                inserted_assignments_count = len(course_assignments_to_insert)
-            except psycopg2.IntegrityError as ie:
-                # Handle potential integrity issues during batch insert (e.g. duplicate assignment if UNIQUE constraint exists)
-                app.logger.error(f"Integrity error during batch insert: {ie}", exc_info=True)
-                error_messages.append(f"批量插入课程计划时发生数据库完整性错误: {ie}。部分或全部数据可能未导入。")
-                # Depending on requirements, you might want to rollback and stop, or try inserting row by row here
-                # For simplicity, we just add error and proceed with commit/rollback
-            except Exception as batch_err:
-                app.logger.error(f"Unexpected error during batch insert: {batch_err}", exc_info=True)
-                error_messages.append(f"批量插入课程计划时发生未知错误: {batch_err}。部分或全部数据可能未导入。")
-
-        conn.commit()  # Commit the transaction
-
-        summary_message = f"文件处理完成。处理了 {processed_rows} 行 Excel 数据。\n"
-        summary_message += f"新建课程: {created_courses_count} 个。\n"
-        summary_message += f"更新现有课程信息: {updated_courses_count} 个。\n"
-        summary_message += f"导入课程计划条目: {inserted_assignments_count} 条 (已覆盖学期 ID {semester_id_from_form} 的旧数据)。\n"
-
-        if error_messages:
-            summary_message += "\n处理过程中遇到以下问题 (部分行可能已跳过):\n" + "\n".join(error_messages)
-            # Use status code 207 (Multi-Status) to indicate partial success
-            return jsonify({"message": summary_message, "status": "partial_success"}), 207
-        else:
-            return jsonify({"message": summary_message, "status": "success"}), 200
+def get_course_plan_import_job(job_id):
+    job = job_queue.get_job(get_db_connection, job_id)
+    return job if job is not None and job['job_type'] == 'course_plan_import' else None
 
-    except pd.errors.EmptyDataError:
-        if conn: conn.rollback()
-        return jsonify({"message": "上传的 Excel 文件为空或无法解析。"}), 400
-    except (KeyError, ValueError, TypeError) as data_err:  # Catch errors related to data reading/conversion
-        if conn: conn.rollback()
-        app.logger.error(f"Data error processing Excel file: {data_err}", exc_info=True)
-        return jsonify({"message": f"Excel 文件数据格式错误: {data_err}。请检查列名和数据类型。"}), 400
-    except psycopg2.Error as db_err:
-        if conn: conn.rollback()
-        app.logger.error(f"Database operation error during Excel import: {db_err}", exc_info=True)
-        return jsonify({"message": f"数据库操作失败: {db_err}"}), 500
+
+# Import progress (rows processed, rows skipped so far) and, once finished, the final counts
+@app.route('/api/course-plans/import-jobs/<int:job_id>', methods=['GET'])
+def get_course_plan_import_status(job_id):
+    try:
+        job = get_course_plan_import_job(job_id)
+        if job is None:
+            return jsonify({"message": "导入任务不存在"}), 404
+        body = serialize_job(job)
+        body['summary'] = job['result'] if job['status'] in job_queue.FINISHED_JOB_STATUSES else None
+        return jsonify(body), 200
     except Exception as e:
-        if conn: conn.rollback()
-        app.logger.error(f"Unknown error processing Excel file: {e}", exc_info=True)
+        app.logger.error(f"Error fetching course-plan import job {job_id}: {e}", exc_info=True)
+        return jsonify({"message": f"服务器内部错误: {e}"}), 500
+
+
+# Rows skipped by an import, in file order: ?page=1&page_size=100
+@app.route('/api/course-plans/import-jobs/<int:job_id>/errors', methods=['GET'])
+def get_course_plan_import_errors(job_id):
+    try:
+        page = int(request.args.get('page', 1))
+        page_size = int(request.args.get('page_size', 100))
+        if page < 1 or not 1 <= page_size <= 1000:
+            raise ValueError("page out of range")
+    except (ValueError, TypeError):
+        return jsonify({"message": "page 必须是正整数，page_size 必须在 1 到 1000 之间"}), 400
+    try:
+        if get_course_plan_import_job(job_id) is None:
+            return jsonify({"message": "导入任务不存在"}), 404
+        total, errors = course_plan_import.get_import_errors(get_db_connection, job_id,
+                                                             (page - 1) * page_size, page_size)
+        return jsonify({"total": total, "page": page, "page_size": page_size, "errors": errors}), 200
+    except Exception as e:
+        app.logger.error(f"Error fetching errors of course-plan import job {job_id}: {e}", exc_info=True)
         return jsonify({"message": f"服务器内部错误: {e}"}), 500
-    finally:
-        if cur: cur.close()
-        if conn:
-            conn.autocommit = True  # Restore default autocommit behavior if needed, or just close
-            conn.close()
 
 
 @app.route('/api/course-plans/template', methods=['GET'])
@@ -887,42 +868,135 @@ def update_course_plan(plan_id):
             conn.close()
 
 
+# --- Scheduling jobs ---
+# Scheduling runs on background workers (see job_queue.py); the run endpoint only enqueues a job.
+def run_schedule_job(params, report_progress):
+    """Job handler for 'schedule' jobs: runs the full scheduling pipeline and returns its summary."""
+    def on_progress(progress):
+        try:
+            report_progress(progress)
+        except job_queue.JobCancelled:
+            raise scheduler_module.SchedulingCancelled()
+
+    if params.get('mode') == 'incremental':
+        summary = scheduler_module.run_incremental_scheduling_process(
+            params['semester_id'], get_db_connection, progress_callback=on_progress)
+    else:
+        summary = scheduler_module.run_full_scheduling_process(
+            params['semester_id'], get_db_connection,
+            attempts=params.get('attempts') or 1, seed=params.get('seed'),
+            improve_time_budget=params.get('improve_seconds'), time_budget=params.get('time_budget'),
+            progress_callback=on_progress)
+    # Exports of the old timetable are never served again (the timetable version changed); free their space now
+    export_cache.invalidate(params['semester_id'])
+    status = summary.get("status", "failure").lower()
+    if status == "cancelled":
+        raise job_queue.JobCancelled(summary.get("message"))
+    if not status.startswith("success"):
+        raise job_queue.JobFailed(summary.get("message") or "排课失败", result=summary)
+    return summary
+
+
+job_queue.register_job_handler('schedule', run_schedule_job)
+
+
+def serialize_job(job):
+    """Public view of a background job (without the stored result)."""
+    return {
+        "id": job['id'],
+        "type": job['job_type'],
+        "status": job['status'],
+        "params": job['params'],
+        "progress": job['progress'],
+        "error": job['error'],
+        "cancel_requested": job['cancel_requested'],
+        "created_at": job['created_at'].isoformat() if job['created_at'] else None,
+        "started_at": job['started_at'].isoformat() if job['started_at'] else None,
+        "finished_at": job['finished_at'].isoformat() if job['finished_at'] else None,
+    }
+
+
 # Route to trigger the scheduling algorithm
 @app.route('/api/schedule/run/<int:semester_id>', methods=['POST'])
 def run_scheduling_for_semester_api(semester_id):
     app.logger.info(f"API: Received request to run scheduling for semester_id: {semester_id}")
+    # Optional JSON body: {"mode": "full"|"incremental", "attempts": <int>, "seed": <int>,
+    #                      "improve_seconds": <number>, "time_budget": <number>}
+    # "incremental" only re-places added/modified/incomplete course plans and writes the delta;
+    # the other options apply to full runs (multi-start, reproducing a previous run, a time-boxed
+    # local-search pass, an overall wall-clock budget after which the best schedule so far is saved)
+    options = request.get_json(silent=True) or {}
+    mode = options.get('mode') or 'full'
+    if mode not in ('full', 'incremental'):
+        return jsonify({"message": "mode 只能是 full 或 incremental"}), 400
     try:
-        # Pass the app's get_db_connection function to the scheduler module
-        # The scheduler module should handle connecting, fetching data, running algo, saving results, disconnecting
-        scheduling_summary = scheduler_module.run_full_scheduling_process(semester_id, get_db_connection)
+        attempts = int(options.get('attempts') or 1)
+        seed = int(options['seed']) if options.get('seed') is not None else None
+        improve_seconds = float(options['improve_seconds']) if options.get('improve_seconds') is not None else None
+        time_budget = float(options['time_budget']) if options.get('time_budget') is not None else None
+        if attempts <= 0:
+            raise ValueError("attempts must be positive")
+        if improve_seconds is not None and improve_seconds < 0:
+            raise ValueError("improve_seconds must not be negative")
+        if time_budget is not None and time_budget <= 0:
+            raise ValueError("time_budget must be positive")
+    except (ValueError, TypeError):
+        return jsonify({"message": "attempts 必须是正整数，seed 必须是整数，improve_seconds 不能为负数，time_budget 必须为正数"}), 400
+    try:
+        job_id = job_queue.enqueue_job(get_db_connection, 'schedule', {
+            "semester_id": semester_id, "mode": mode, "attempts": attempts, "seed": seed,
+            "improve_seconds": improve_seconds, "time_budget": time_budget})
+        app.logger.info(f"API: Scheduling for semester {semester_id} queued as job {job_id}")
+        return jsonify({"message": "排课任务已提交，正在后台执行。", "job_id": job_id}), 202
+    except Exception as e:
+        app.logger.error(f"API: Error queueing scheduling for semester {semester_id}: {e}", exc_info=True)
+        return jsonify({"message": "提交排课任务时发生内部错误。"}), 500
 
-        app.logger.info(
-            f"API: Scheduling for semester {semester_id} finished. Status: {scheduling_summary.get('status')}")
 
-        status = scheduling_summary.get("status", "failure").lower()
-        message = scheduling_summary.get("message", "排课已执行。")
-        summary = scheduling_summary.get("summary", {})  # Ensure summary is included
+# Job status and progress (majors processed, entries generated, ...)
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+def get_job_status(job_id):
+    try:
+        job = job_queue.get_job(get_db_connection, job_id)
+        if job is None:
+            return jsonify({"message": "任务不存在"}), 404
+        return jsonify(serialize_job(job)), 200
+    except Exception as e:
+        app.logger.error(f"Error fetching job {job_id}: {e}", exc_info=True)
+        return jsonify({"message": f"服务器内部错误: {e}"}), 500
 
-        if status.startswith("success"):
-            # Successfully ran, even if some constraints weren't met (might be partial success)
-            # scheduler_module should indicate if it's partial or full success
-            return jsonify({
-                "message": message,
-                "summary": summary
-            }), 200  # Or 207 for partial success if scheduler_module indicates that
-        else:
-            # Indicates a failure in the scheduling *process* (e.g., data loading failed, algorithm crashed)
-            return jsonify({
-                "message": message,
-                "summary": summary
-            }), 500  # Internal server error related to scheduling process
+
+@app.route('/api/jobs/<int:job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    try:
+        status = job_queue.request_job_cancel(get_db_connection, job_id)
+        if status is None:
+            return jsonify({"message": "任务不存在"}), 404
+        if status in (job_queue.JOB_STATUS_SUCCEEDED, job_queue.JOB_STATUS_FAILED):
+            return jsonify({"message": "任务已结束，无法取消", "status": status}), 409
+        message = "任务已取消" if status == job_queue.JOB_STATUS_CANCELLED else "已请求取消，任务将在下一个检查点停止"
+        return jsonify({"message": message, "status": status}), 200
+    except Exception as e:
+        app.logger.error(f"Error cancelling job {job_id}: {e}", exc_info=True)
+        return jsonify({"message": f"服务器内部错误: {e}"}), 500
 
 
+# Final summary of a finished job
+@app.route('/api/jobs/<int:job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    try:
+        job = job_queue.get_job(get_db_connection, job_id)
+        if job is None:
+            return jsonify({"message": "任务不存在"}), 404
+        if job['status'] not in job_queue.FINISHED_JOB_STATUSES:
+            return jsonify({"message": "任务尚未完成", "status": job['status'], "progress": job['progress']}), 409
+        result = job['result'] or {}
+        message = result.get("message") or job['error'] or "任务已结束。"
+        http_status = 500 if job['status'] == job_queue.JOB_STATUS_FAILED else 200
+        return jsonify({"message": message, "status": job['status'], "summary": result}), http_status
     except Exception as e:
-        # Catch any unexpected errors during the API call itself
-        app.logger.error(f"API: Error during scheduling for semester {semester_id}: {e}", exc_info=True)
-        # Avoid returning sensitive exception details to the client
-        return jsonify({"message": f"执行排课时发生内部错误。"}), 500
+        app.logger.error(f"Error fetching result of job {job_id}: {e}", exc_info=True)
+        return jsonify({"message": f"服务器内部错误: {e}"}), 500
 
 
 # API to get timetable data for a whole semester
@@ -938,14 +1012,14 @@ def get_semester_timetable(semester_id):
         # Use time_slots based on your schema
         query = """
         SELECT
-            te.id, te.week_number, te.assignment_id,
+            te.id, te.placement_id, te.entry_key, te.week_number, te.assignment_id,
             s.name as semester_name,
             m.id as major_id, m.name as major_name,
             c.id as course_id, c.name as course_name, c.course_type,
             u.username as teacher_name, t.id as teacher_id,
             cl.id as classroom_id, cl.building || '-' || cl.room_number as classroom_name, -- Concatenate building and room
             ts.id as timeslot_id, ts.day_of_week, ts.period, ts.start_time, ts.end_time -- TIME fields
-        FROM timetable_entries te
+        FROM timetable_entries_expanded te
         JOIN semesters s ON te.semester_id = s.id
         JOIN majors m ON te.major_id = m.id
         JOIN courses c ON te.course_id = c.id
@@ -993,44 +1067,120 @@ def get_semester_timetable(semester_id):
         if conn: conn.close()
 
 
-# API to export timetable data for a whole semester to Excel#无用
-@app.route('/api/timetables/export/semester/<int:semester_id>', methods=['GET'])
-def export_semester_timetable_excel(semester_id):
+# Clear a whole semester's timetable. The semester's partitions are truncated (scheduler_module.clear_db_for_semester)
+# instead of deleting row by row; the timetable version is bumped in the same transaction, so cached exports go stale.
+@app.route('/api/timetables/semester/<int:semester_id>', methods=['DELETE'])
+def clear_semester_timetable(semester_id):
     try:
-        # load_data_from_db is expected to get all necessary lookup data (semesters, majors, etc.)
-        all_data = scheduler_module.load_data_from_db(get_db_connection)
-        current_semester = all_data.get('semesters', {}).get(semester_id)  # Use get with default {} for safety
-        if not current_semester:
-            return jsonify({"message": "学期信息未找到，无法导出"}), 404  # Use 404 if semester ID is bad
+        _, deleted_count = scheduler_module.clear_db_for_semester(semester_id, get_db_connection)
+        return jsonify({"message": f"学期 {semester_id} 的课表已清空", "deleted_count": deleted_count}), 200
+    except psycopg2.Error as e:
+        app.logger.error(f"API: DB error clearing timetable for semester {semester_id}: {e}", exc_info=True)
+        return jsonify({"message": "清空学期课表失败"}), 500
+    except Exception as e:
+        app.logger.error(f"API: Error clearing timetable for semester {semester_id}: {e}", exc_info=True)
+        return jsonify({"message": f"清空学期课表时发生内部错误"}), 500
+
+
+# --- Export caching ---
+# Generated exports are cached on disk (export_cache.py) under the semester's timetable and reference-data versions.
+# Responses carry a weak ETag (the cache key) and Last-Modified (when the file was generated), so a repeat
+# download is answered with 304 after one version lookup, or streamed from the cached file.
+EXPORT_MIMETYPES = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'zip': 'application/zip',
+}
+
 
+class ExportNotFound(Exception):
+    """Raised by an export generator when there is nothing to export; answered with 404 and the message."""
+
+
+def with_export_entity(all_data, kind, entity_id):
+    """
+    Returns (entity, all_data) for a teacher or major export. The cached semester data only holds the teachers and
+    majors with a course assignment in that semester, so anyone else costs one name lookup; the returned all_data is
+    then a shallow copy that includes them (the cached one is shared and must not be modified). entity is None only
+    when the id does not exist.
+    """
+    entity = all_data[kind].get(entity_id)
+    if entity is not None:
+        return entity, all_data
+    conn = None
+    cur = None
+    try:
         conn = get_db_connection()
-        if conn is None: return jsonify({"message": "数据库连接失败"}), 500
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)  # DictCursor is fine for fetching raw data
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        if kind == 'teachers':
+            cur.execute("""
+                SELECT t.id, t.user_id, u.username FROM teachers t LEFT JOIN users u ON u.id = t.user_id
+                WHERE t.id = %s
+            """, (entity_id,))
+            row = cur.fetchone()
+            if row:
+                entity = scheduler_module.Teacher(id=row['id'], user_id=row['user_id'],
+                                                  name=row['username'] or f"未知用户(ID:{row['user_id']})")
+        else:
+            cur.execute("SELECT id, name FROM majors WHERE id = %s", (entity_id,))
+            row = cur.fetchone()
+            if row:
+                entity = scheduler_module.Major(**row)
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+    if entity is None:
+        return None, all_data
+    return entity, {**all_data, kind: {**all_data[kind], entity_id: entity}}
 
-        # Fetch raw TimetableEntry compatible data
-        # Ensure field names match what scheduler_module.TimetableEntry expects
-        cur.execute("""
-            SELECT id, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id
-            FROM timetable_entries WHERE semester_id = %s
-            """, (semester_id,))
-        raw_entries = cur.fetchall()
-        cur.close()
-        conn.close()
 
-        # Convert fetched dicts to TimetableEntry objects (assuming it's a namedtuple/dataclass)
-        # This requires scheduler_module.TimetableEntry to accept these fields
-        schedule_entries_for_export = [scheduler_module.TimetableEntry(**row) for row in raw_entries]
+def send_cached_export(semester_id, scope, entity_id, export_format, download_name, generate):
+    versions = export_cache.current_versions(semester_id, get_db_connection)
+    if versions is None:
+        # Reference data has uncommitted writes: the export may not match any version, so it is neither
+        # cached nor given an ETag
+        try:
+            buffer = generate()
+        except ExportNotFound as not_found:
+            return jsonify({"message": str(not_found)}), 404
+        buffer.seek(0)
+        return send_file(buffer, mimetype=EXPORT_MIMETYPES[export_format], as_attachment=True,
+                         download_name=download_name, etag=False)
+    key = export_cache.ExportKey(semester_id, scope, entity_id, export_format, versions)
+    if request.if_none_match.contains_weak(key.etag):
+        response = app.response_class(status=304)
+    else:
+        try:
+            cached_file = export_cache.open_or_create(key, generate)
+        except ExportNotFound as not_found:
+            return jsonify({"message": str(not_found)}), 404
+        response = send_file(cached_file, mimetype=EXPORT_MIMETYPES[export_format], as_attachment=True,
+                             download_name=download_name, etag=False,
+                             last_modified=os.fstat(cached_file.fileno()).st_mtime)
+    response.set_etag(key.etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True  # clients may keep the file but must revalidate it
+    return response.make_conditional(request)
 
-        # Check if semester has valid week information before proceeding to generate report
-        if not current_semester or not hasattr(current_semester, 'total_weeks') or current_semester.total_weeks <= 0:
-            # Still try to generate if there are entries, might just have weird output
-            if not schedule_entries_for_export:
-                return jsonify({"message": "当前学期无排课数据可供导出，或学期周数未设置"}), 404
 
-        # generate_excel_report_for_send_file should handle empty schedule_entries gracefully
-        excel_buffer = scheduler_module.generate_excel_report_for_send_file(
-            schedule_entries_for_export, all_data, current_semester
-        )
+@app.route('/api/cache/export-stats', methods=['GET'])
+def export_cache_stats():
+    return jsonify(export_cache.stats())
+
+
+def send_semester_export(semester_id, scope, filename_prefix):
+    """
+    Shared body of the whole-semester export routes. ?format=xlsx (default) returns one workbook with a sheet per
+    major/teacher, ?format=zip a ZIP with one .xlsx per major/teacher; sheets are rendered in a process pool.
+    """
+    export_format = request.args.get('format', 'xlsx')
+    if export_format not in ('xlsx', 'zip'):
+        return jsonify({"message": "format 只能是 xlsx 或 zip"}), 400
+    try:
+        # Lookup data this semester references, cached per process until the reference data changes
+        all_data = reference_cache.get_semester_data(semester_id, get_db_connection)
+        current_semester = all_data.get('semesters', {}).get(semester_id)  # Use get with default {} for safety
+        if not current_semester:
+            return jsonify({"message": "学期信息未找到，无法导出"}), 404  # Use 404 if semester ID is bad
 
         # Sanitize semester name for filename
         # Allow CJK, alphanumeric, hyphen, underscore, space. Replace others with underscore.
@@ -1044,29 +1194,59 @@ def export_semester_timetable_excel(semester_id):
         if not safe_semester_name:
             safe_semester_name = f"semester_{semester_id}"
 
-        filename = f"排课结果_{safe_semester_name}_学期ID{semester_id}.xlsx"
+        filename = f"{filename_prefix}_{safe_semester_name}_学期ID{semester_id}.{export_format}"
 
-        # Flask < 2.3 uses filename/attachment_filename, Flask >= 2.3 uses download_name
-        send_file_kwargs = {
-            'mimetype': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            'as_attachment': True,
-            'download_name': filename  # Flask >= 2.3
-            # 'attachment_filename': filename # Flask < 2.3
-        }
-        # Check Flask version if necessary to pick download_name vs attachment_filename
+        def generate():
+            conn = get_db_connection()
+            if conn is None: raise psycopg2.OperationalError("数据库连接失败")
+            cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)  # DictCursor is fine for fetching raw data
 
-        return send_file(
-            excel_buffer,
-            **send_file_kwargs
-        )
+            # Fetch raw TimetableEntry compatible data
+            # Ensure field names match what scheduler_module.TimetableEntry expects
+            cur.execute("""
+                SELECT id, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id
+                FROM timetable_entries_expanded WHERE semester_id = %s
+                """, (semester_id,))
+            raw_entries = cur.fetchall()
+            cur.close()
+            conn.close()
+
+            # Convert fetched dicts to TimetableEntry objects (assuming it's a namedtuple/dataclass)
+            # This requires scheduler_module.TimetableEntry to accept these fields
+            schedule_entries_for_export = [scheduler_module.TimetableEntry(**row) for row in raw_entries]
+
+            # Check if semester has valid week information before proceeding to generate report
+            if not hasattr(current_semester, 'total_weeks') or current_semester.total_weeks <= 0:
+                # Still try to generate if there are entries, might just have weird output
+                if not schedule_entries_for_export:
+                    raise ExportNotFound("当前学期无排课数据可供导出，或学期周数未设置")
+
+            # generate_semester_export handles empty schedule_entries gracefully
+            return scheduler_module.generate_semester_export(
+                schedule_entries_for_export, all_data, current_semester, scope=scope, as_zip=export_format == 'zip'
+            )
+
+        return send_cached_export(semester_id, scope, None, export_format, filename, generate)
     except ImportError as ie:  # Specifically for openpyxl or xlsxwriter not found
         app.logger.error(f"API Export: Missing Excel library: {ie}", exc_info=True)
         return jsonify({"message": "导出功能不可用：缺少 Excel 处理库 (如 openpyxl)。请联系管理员。"}), 501
     except Exception as e:
-        app.logger.error(f"API Export: Error exporting semester timetable for {semester_id}: {e}", exc_info=True)
+        app.logger.error(f"API Export: Error exporting semester timetable ({scope}) for {semester_id}: {e}", exc_info=True)
         return jsonify({"message": f"导出Excel失败: {str(e)}"}), 500  # Return generic error, log details
 
 
+# API to export timetable data for a whole semester to Excel (every major and every teacher)#无用
+@app.route('/api/timetables/export/semester/<int:semester_id>', methods=['GET'])
+def export_semester_timetable_excel(semester_id):
+    return send_semester_export(semester_id, 'all', "排课结果")
+
+
+# API to export every teacher's timetable for a semester in one request
+@app.route('/api/timetables/export/semester/<int:semester_id>/teachers', methods=['GET'])
+def export_all_teacher_timetables_excel(semester_id):
+    return send_semester_export(semester_id, 'teachers', "全部教师课表")
+
+
 # API to get timetable data for a specific teacher and semester
 @app.route('/api/timetables/teacher/<int:teacher_id>/semester/<int:semester_id>', methods=['GET'])
 def get_teacher_timetable(teacher_id, semester_id):
@@ -1078,14 +1258,14 @@ def get_teacher_timetable(teacher_id, semester_id):
         cur = conn.cursor(cursor_factory=RealDictCursor)  # Or DictCursor
         # Use time_slots based on your schema
         query = """
-        SELECT te.id, te.week_number, te.assignment_id,
+        SELECT te.id, te.placement_id, te.entry_key, te.week_number, te.assignment_id,
                s.name as semester_name,
                m.id as major_id, m.name as major_name,
                c.id as course_id, c.name as course_name, c.course_type,
                u.username as teacher_name, t.id as teacher_id,
                cl.id as classroom_id, cl.building || '-' || cl.room_number as classroom_name,
                ts.id as timeslot_id, ts.day_of_week, ts.period, ts.start_time, ts.end_time -- TIME fields
-        FROM timetable_entries te
+        FROM timetable_entries_expanded te
         JOIN semesters s ON te.semester_id = s.id
         JOIN majors m ON te.major_id = m.id
         JOIN courses c ON te.course_id = c.id
@@ -1136,32 +1316,14 @@ def get_teacher_timetable(teacher_id, semester_id):
 @app.route('/api/timetables/export/teacher/<int:teacher_id>/semester/<int:semester_id>', methods=['GET'])
 def export_teacher_timetable_excel(teacher_id, semester_id):
     try:
-        all_data = scheduler_module.load_data_from_db(get_db_connection)
+        all_data = reference_cache.get_semester_data(semester_id, get_db_connection)
         current_semester = all_data.get('semesters', {}).get(semester_id)
-        teacher_info = all_data.get('teachers', {}).get(teacher_id)  # Assuming teachers dict is keyed by id
+        teacher_info = None
+        if current_semester:
+            teacher_info, all_data = with_export_entity(all_data, 'teachers', teacher_id)
         if not current_semester or not teacher_info:
             return jsonify({"message": "学期或教师信息未找到，无法导出"}), 404
 
-        conn = get_db_connection()
-        if conn is None: return jsonify({"message": "数据库连接失败"}), 500
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute("""
-            SELECT id, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id
-            FROM timetable_entries WHERE semester_id = %s AND teacher_id = %s
-            """, (semester_id, teacher_id))
-        raw_entries = cur.fetchall()
-        cur.close()
-        conn.close()
-        schedule_entries_for_export = [scheduler_module.TimetableEntry(**row) for row in raw_entries]
-
-        if not current_semester or not hasattr(current_semester, 'total_weeks') or current_semester.total_weeks <= 0:
-            if not schedule_entries_for_export:
-                return jsonify({"message": "当前学期或指定教师无排课数据可供导出"}), 404
-
-        excel_buffer = scheduler_module.generate_excel_report_for_send_file(
-            schedule_entries_for_export, all_data, current_semester, target_teacher_id=teacher_id
-        )
-
         safe_teacher_name = re.sub(r'[^\w\u4e00-\u9fff\s\-]', '_',
                                    teacher_info.name if hasattr(teacher_info, 'name') else str(
                                        teacher_id))  # Fallback to ID
@@ -1174,15 +1336,28 @@ def export_teacher_timetable_excel(teacher_id, semester_id):
 
         filename = f"教师课表_{safe_teacher_name}_{safe_semester_name}.xlsx"
 
-        send_file_kwargs = {
-            'mimetype': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            'as_attachment': True,
-            'download_name': filename  # Flask >= 2.3
-            # 'attachment_filename': filename # Flask < 2.3
-        }
-        # Check Flask version if necessary
+        def generate():
+            conn = get_db_connection()
+            if conn is None: raise psycopg2.OperationalError("数据库连接失败")
+            cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            cur.execute("""
+                SELECT id, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id
+                FROM timetable_entries_expanded WHERE semester_id = %s AND teacher_id = %s
+                """, (semester_id, teacher_id))
+            raw_entries = cur.fetchall()
+            cur.close()
+            conn.close()
+            schedule_entries_for_export = [scheduler_module.TimetableEntry(**row) for row in raw_entries]
+
+            if not hasattr(current_semester, 'total_weeks') or current_semester.total_weeks <= 0:
+                if not schedule_entries_for_export:
+                    raise ExportNotFound("当前学期或指定教师无排课数据可供导出")
 
-        return send_file(excel_buffer, **send_file_kwargs)
+            return scheduler_module.generate_excel_report_for_send_file(
+                schedule_entries_for_export, all_data, current_semester, target_teacher_id=teacher_id
+            )
+
+        return send_cached_export(semester_id, 'teacher', teacher_id, 'xlsx', filename, generate)
     except ImportError:
         app.logger.error("Missing openpyxl or xlsxwriter library for Excel export.")
         return jsonify({"message": "导出功能不可用：缺少 Excel 处理库 (如 openpyxl)。"}), 501
@@ -1212,9 +1387,17 @@ def get_major_timetable(major_id, semester_id):
 
         # 基础查询语句，连接必要的表以获取所需信息
         # 注意：你的原始查询缺少了 JOIN courses, teachers, users, classrooms 获取名称的部分，这里补上
-        query = """
+        if selected_week is not None and selected_week <= 0:
+            # 如果提供了无效周数 (如 0 或负数)，返回空结果比较安全
+            app.logger.warning(f"Invalid week number requested: {selected_week}")
+            return jsonify([]), 200 # 或者返回错误信息
+        # 如果提供了 week 参数，则只展开该周 (按周次集合的索引查询)
+        source, params = timetable_source(semester_id, selected_week)
+        query = f"""
             SELECT
                 te.id,
+                te.placement_id,
+                te.entry_key,
                 te.semester_id,
                 te.major_id,
                 te.course_id,
@@ -1232,7 +1415,7 @@ def get_major_timetable(major_id, semester_id):
                 u.username as teacher_name,
                 cl.building || '-' || cl.room_number as classroom_name, -- classroom_name 已在你的原代码中
                 m.name as major_name -- 如果需要显示专业名（虽然在此视图可能不需要）
-            FROM timetable_entries te
+            FROM {source}
             JOIN time_slots ts ON te.timeslot_id = ts.id
             JOIN courses c ON te.course_id = c.id
             JOIN teachers t ON te.teacher_id = t.id
@@ -1241,19 +1424,9 @@ def get_major_timetable(major_id, semester_id):
             JOIN majors m ON te.major_id = m.id -- 加入 majors 表
             WHERE te.major_id = %s AND te.semester_id = %s
         """
-        params = [major_id, semester_id]
+        params += [major_id, semester_id]
         if selected_week is not None:
             app.logger.debug(f"Applying week filter: week_number = {selected_week}")
-        # 如果提供了 week 参数，则添加到查询条件中
-        if selected_week is not None:
-            # 检查 week_number 是否大于 0，防止无效查询
-            if selected_week > 0:
-                query += " AND te.week_number = %s"
-                params.append(selected_week)
-            else:
-                # 如果提供了无效周数 (如 0 或负数)，返回空结果比较安全
-                app.logger.warning(f"Invalid week number requested: {selected_week}")
-                return jsonify([]), 200 # 或者返回错误信息
 
         # 添加排序，确保课表顺序正确 (按天、按节次)
         query += " ORDER BY ts.day_of_week, ts.period;" # 使用 time_slots 的 period 排序
@@ -1295,32 +1468,14 @@ def get_major_timetable(major_id, semester_id):
 @app.route('/api/timetables/export/major/<int:major_id>/semester/<int:semester_id>', methods=['GET'])
 def export_major_timetable_excel(major_id, semester_id):
     try:
-        all_data = scheduler_module.load_data_from_db(get_db_connection)
+        all_data = reference_cache.get_semester_data(semester_id, get_db_connection)
         current_semester = all_data.get('semesters', {}).get(semester_id)
-        major_info = all_data.get('majors', {}).get(major_id)  # Assuming majors dict is keyed by id
+        major_info = None
+        if current_semester:
+            major_info, all_data = with_export_entity(all_data, 'majors', major_id)
         if not current_semester or not major_info:
             return jsonify({"message": "学期或专业信息未找到，无法导出"}), 404
 
-        conn = get_db_connection()
-        if conn is None: return jsonify({"message": "数据库连接失败"}), 500
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute("""
-            SELECT id, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id
-            FROM timetable_entries WHERE semester_id = %s AND major_id = %s
-            """, (semester_id, major_id))
-        raw_entries = cur.fetchall()
-        cur.close()
-        conn.close()
-        schedule_entries_for_export = [scheduler_module.TimetableEntry(**row) for row in raw_entries]
-
-        if not current_semester or not hasattr(current_semester, 'total_weeks') or current_semester.total_weeks <= 0:
-            if not schedule_entries_for_export:
-                return jsonify({"message": "当前学期或指定专业无排课数据可供导出"}), 404
-
-        excel_buffer = scheduler_module.generate_excel_report_for_send_file(
-            schedule_entries_for_export, all_data, current_semester, target_major_id=major_id
-        )
-
         safe_major_name = re.sub(r'[^\w\u4e00-\u9fff\s\-]', '_',
                                  major_info.name if hasattr(major_info, 'name') else str(major_id))
         safe_major_name = safe_major_name.strip(' _').replace(' ', '_')
@@ -1332,15 +1487,28 @@ def export_major_timetable_excel(major_id, semester_id):
 
         filename = f"专业课表_{safe_major_name}_{safe_semester_name}.xlsx"
 
-        send_file_kwargs = {
-            'mimetype': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            'as_attachment': True,
-            'download_name': filename  # Flask >= 2.3
-            # 'attachment_filename': filename # Flask < 2.3
-        }
-        # Check Flask version if necessary
+        def generate():
+            conn = get_db_connection()
+            if conn is None: raise psycopg2.OperationalError("数据库连接失败")
+            cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            cur.execute("""
+                SELECT id, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id
+                FROM timetable_entries_expanded WHERE semester_id = %s AND major_id = %s
+                """, (semester_id, major_id))
+            raw_entries = cur.fetchall()
+            cur.close()
+            conn.close()
+            schedule_entries_for_export = [scheduler_module.TimetableEntry(**row) for row in raw_entries]
+
+            if not hasattr(current_semester, 'total_weeks') or current_semester.total_weeks <= 0:
+                if not schedule_entries_for_export:
+                    raise ExportNotFound("当前学期或指定专业无排课数据可供导出")
 
-        return send_file(excel_buffer, **send_file_kwargs)
+            return scheduler_module.generate_excel_report_for_send_file(
+                schedule_entries_for_export, all_data, current_semester, target_major_id=major_id
+            )
+
+        return send_cached_export(semester_id, 'major', major_id, 'xlsx', filename, generate)
     except ImportError:
         app.logger.error("Missing openpyxl or xlsxwriter library for Excel export.")
         return jsonify({"message": "导出功能不可用：缺少 Excel 处理库 (如 openpyxl)。"}), 501
@@ -1384,15 +1552,19 @@ def get_student_timetable(user_id, semester_id):
         student_major_id = student_info['major_id']
 
         # 2. Fetch timetable entries using the student's major_id, semester_id, and week filter
-        query = """
+        if selected_week is not None and selected_week <= 0:
+             app.logger.warning(f"Invalid week number requested: {selected_week}. Returning empty.")
+             return jsonify([]), 200 # Return empty if week is invalid
+        source, params = timetable_source(semester_id, selected_week)  # single week -> index-backed expansion
+        query = f"""
             SELECT
-                te.id, te.semester_id, te.major_id, te.course_id, te.teacher_id, te.classroom_id, te.timeslot_id, te.week_number, te.assignment_id,
+                te.id, te.placement_id, te.entry_key, te.semester_id, te.major_id, te.course_id, te.teacher_id, te.classroom_id, te.timeslot_id, te.week_number, te.assignment_id,
                 ts.day_of_week, ts.period, ts.start_time, ts.end_time,
                 c.name as course_name, c.course_type,
                 u.username as teacher_name, -- Include teacher name
                 cl.building || '-' || cl.room_number as classroom_name
                 -- No need for major_name in student view result, but could fetch it if needed
-            FROM timetable_entries te
+            FROM {source}
             JOIN time_slots ts ON te.timeslot_id = ts.id
             JOIN courses c ON te.course_id = c.id
             JOIN teachers t ON te.teacher_id = t.id
@@ -1400,15 +1572,10 @@ def get_student_timetable(user_id, semester_id):
             JOIN classrooms cl ON te.classroom_id = cl.id
             WHERE te.major_id = %s AND te.semester_id = %s
         """
-        params = [student_major_id, semester_id]
+        params += [student_major_id, semester_id]
 
-        if selected_week is not None and selected_week > 0:
+        if selected_week is not None:
              app.logger.debug(f"Applying week filter: week_number = {selected_week}")
-             query += " AND te.week_number = %s"
-             params.append(selected_week)
-        elif selected_week is not None and selected_week <= 0:
-             app.logger.warning(f"Invalid week number requested: {selected_week}. Returning empty.")
-             return jsonify([]), 200 # Return empty if week is invalid
 
         # Add sorting for correct timetable display order
         query += " ORDER BY te.week_number, ts.day_of_week, ts.period;" # Order by week, then day, then period
@@ -1474,42 +1641,14 @@ def export_student_timetable_excel(user_id, semester_id):
         student_username = student_info[1]
 
         # Load all necessary lookup data (including semesters, majors, teachers, etc.)
-        # load_data_from_db returns dictionaries keyed by ID, e.g., {'semesters': {id: semester_obj, ...}}
-        all_data = scheduler_module.load_data_from_db(get_db_connection) # Pass the connection function
+        # all_data holds dictionaries keyed by ID, e.g., {'semesters': {id: semester_obj, ...}}
+        all_data = reference_cache.get_semester_data(semester_id, get_db_connection)
 
         current_semester = all_data.get('semesters', {}).get(semester_id)
         if not current_semester:
              # This should ideally not happen if semester_id is from frontend selects, but check anyway
              return jsonify({"message": "学期信息未找到，无法导出"}), 404
 
-        # 2. Fetch *all* timetable entries for this student's major and semester
-        # Use DictCursor for fetching raw data to pass to TimetableEntry constructor
-        cur_dict = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur_dict.execute("""
-            SELECT id, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id
-            FROM timetable_entries
-            WHERE semester_id = %s AND major_id = %s
-            ORDER BY week_number, timeslot_id; -- Consistent ordering
-            """, (semester_id, student_major_id)) # Filter by student's major_id
-        raw_entries = cur_dict.fetchall()
-        cur_dict.close() # Close dict cursor
-
-        conn.close() # Close main connection
-
-        if not raw_entries:
-            return jsonify({"message": "当前学期无排课数据可供导出，或学期周数未设置"}), 404
-
-        # Convert fetched dicts to TimetableEntry objects (assuming it's a namedtuple/dataclass)
-        schedule_entries_for_export = [scheduler_module.TimetableEntry(**row) for row in raw_entries]
-
-        # Generate Excel report. Pass student_major_id or user_id if generate_excel_report_for_send_file
-        # needs to filter or format specifically for a student (e.g., hide other majors' data if the raw_entries included them).
-        # Given the query filters by major_id, the generator just needs the list and lookup data.
-        excel_buffer = scheduler_module.generate_excel_report_for_send_file(
-            schedule_entries_for_export, all_data, current_semester
-            # Optionally pass target_major_id=student_major_id or other flags if generator logic depends on it
-        )
-
         # Sanitize names for filename
         safe_student_username = re.sub(r'[^\w\u4e00-\u9fff\s\-]', '_', student_username)
         safe_student_username = safe_student_username.strip(' _').replace(' ', '_')
@@ -1521,13 +1660,32 @@ def export_student_timetable_excel(user_id, semester_id):
 
         filename = f"我的课表_{safe_student_username}_{safe_semester_name}_(全学期).xlsx" # Indicate it's full semester
 
-        send_file_kwargs = {
-            'mimetype': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            'as_attachment': True,
-            'download_name': filename
-        }
+        def generate():
+            # 2. Fetch *all* timetable entries for this student's major and semester
+            # Use DictCursor for fetching raw data to pass to TimetableEntry constructor
+            cur_dict = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            cur_dict.execute("""
+                SELECT id, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id
+                FROM timetable_entries_expanded
+                WHERE semester_id = %s AND major_id = %s
+                ORDER BY week_number, timeslot_id; -- Consistent ordering
+                """, (semester_id, student_major_id)) # Filter by student's major_id
+            raw_entries = cur_dict.fetchall()
+            cur_dict.close() # Close dict cursor
+
+            if not raw_entries:
+                raise ExportNotFound("当前学期无排课数据可供导出，或学期周数未设置")
+
+            # Convert fetched dicts to TimetableEntry objects (assuming it's a namedtuple/dataclass)
+            schedule_entries_for_export = [scheduler_module.TimetableEntry(**row) for row in raw_entries]
+
+            # The query filters by major_id, so the full-semester report holds the major's sheet and the sheets
+            # of the teachers teaching it; every student of the major shares the cached file
+            return scheduler_module.generate_excel_report_for_send_file(
+                schedule_entries_for_export, all_data, current_semester
+            )
 
-        return send_file(excel_buffer, **send_file_kwargs)
+        return send_cached_export(semester_id, 'student_major', student_major_id, 'xlsx', filename, generate)
 
     except ImportError as ie:
         app.logger.error(f"API Export: Missing Excel library: {ie}", exc_info=True)
@@ -1537,6 +1695,109 @@ def export_student_timetable_excel(user_id, semester_id):
         return jsonify({"message": f"导出Excel失败: {str(e)}"}), 500
     finally:
         if conn: conn.close() # Ensure connection is closed
+
+
+# --- iCalendar feeds ---
+# Personal timetables as .ics (ical_export.py): one weekly RRULE event per placement, so a whole semester is a few KB.
+# Calendar clients poll these URLs; the weak ETag is the export cache key, so an unchanged timetable costs one
+# version lookup and a 304. The body is built from the rows already fetched and streamed line by line.
+def send_calendar(semester_id, column, entity_id, calendar_name, download_name):
+    versions = export_cache.current_versions(semester_id, get_db_connection)
+    key = export_cache.ExportKey(semester_id, f'ics-{column}', entity_id, 'ics', versions) if versions else None
+    if key is not None and request.if_none_match.contains_weak(key.etag):
+        response = app.response_class(status=304)
+    else:
+        all_data = reference_cache.get_semester_data(semester_id, get_db_connection)
+        current_semester = all_data.get('semesters', {}).get(semester_id)
+        if not current_semester or not current_semester.start_date:
+            return jsonify({"message": "学期信息未找到或未设置开始日期，无法导出日历"}), 404
+        conn = None
+        cur = None
+        try:
+            conn = get_db_connection()
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            placements, single_entries = ical_export.load_calendar_rows(cur, semester_id, column, entity_id)
+        finally:
+            if cur: cur.close()
+            if conn: conn.close()
+        lines = ical_export.iter_calendar(current_semester, placements, single_entries, all_data,
+                                          f"{calendar_name} {current_semester.name}")
+        response = app.response_class((line.encode('utf-8') for line in lines),
+                                      mimetype='text/calendar', content_type='text/calendar; charset=utf-8')
+        safe_name = re.sub(r'[^\w\u4e00-\u9fff\-]', '_', f"{calendar_name}_{current_semester.name}").strip('_')
+        response.headers['Content-Disposition'] = (
+            f"inline; filename=\"{download_name}.ics\"; filename*=UTF-8''{urllib.parse.quote(safe_name)}.ics")
+    if key is not None:  # no ETag while reference data has uncommitted writes (see send_cached_export)
+        response.set_etag(key.etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/api/timetables/export/teacher/<int:teacher_id>/semester/<int:semester_id>/ics', methods=['GET'])
+def export_teacher_calendar(teacher_id, semester_id):
+    try:
+        all_data = reference_cache.get_semester_data(semester_id, get_db_connection)
+        teacher_info, _ = with_export_entity(all_data, 'teachers', teacher_id)
+        if not teacher_info:
+            return jsonify({"message": "教师信息未找到，无法导出日历"}), 404
+        return send_calendar(semester_id, 'teacher_id', teacher_id, f"教师课表_{teacher_info.name}",
+                             f"teacher_{teacher_id}_semester_{semester_id}")
+    except psycopg2.Error as e:
+        app.logger.error(f"Database error exporting teacher calendar: {e}")
+        return jsonify({"message": "数据库查询失败"}), 500
+    except Exception as e:
+        app.logger.error(f"API Export: Error exporting teacher calendar: {e}", exc_info=True)
+        return jsonify({"message": f"导出日历失败: {str(e)}"}), 500
+
+
+@app.route('/api/timetables/export/major/<int:major_id>/semester/<int:semester_id>/ics', methods=['GET'])
+def export_major_calendar(major_id, semester_id):
+    try:
+        all_data = reference_cache.get_semester_data(semester_id, get_db_connection)
+        major_info, _ = with_export_entity(all_data, 'majors', major_id)
+        if not major_info:
+            return jsonify({"message": "专业信息未找到，无法导出日历"}), 404
+        return send_calendar(semester_id, 'major_id', major_id, f"专业课表_{major_info.name}",
+                             f"major_{major_id}_semester_{semester_id}")
+    except psycopg2.Error as e:
+        app.logger.error(f"Database error exporting major calendar: {e}")
+        return jsonify({"message": "数据库查询失败"}), 500
+    except Exception as e:
+        app.logger.error(f"API Export: Error exporting major calendar: {e}", exc_info=True)
+        return jsonify({"message": f"导出日历失败: {str(e)}"}), 500
+
+
+@app.route('/api/timetables/export/student/<int:user_id>/semester/<int:semester_id>/ics', methods=['GET'])
+def export_student_calendar(user_id, semester_id):
+    """A student's calendar is their major's; the feed (and its ETag) is shared by the whole major."""
+    conn = None
+    cur = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT s.major_id FROM students s JOIN users u ON s.user_id = u.id
+            WHERE u.id = %s AND u.role = 'student'
+        """, (user_id,))
+        student_info = cur.fetchone()
+        cur.close()
+        cur = None
+        conn.close()
+        conn = None
+        if not student_info or student_info[0] is None:
+            return jsonify({"message": "未找到您的学生信息或未指定专业，无法导出日历。"}), 404
+        return send_calendar(semester_id, 'major_id', student_info[0], "我的课表",
+                             f"timetable_semester_{semester_id}")
+    except psycopg2.Error as e:
+        app.logger.error(f"Database error exporting student calendar: {e}")
+        return jsonify({"message": "数据库查询失败"}), 500
+    except Exception as e:
+        app.logger.error(f"API Export: Error exporting student calendar for user {user_id}: {e}", exc_info=True)
+        return jsonify({"message": f"导出日历失败: {str(e)}"}), 500
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
 # 教师登录用
 @app.route('/api/timetables/teacher-dashboard/<int:user_id>/semester/<int:semester_id>', methods=['GET'])
 def get_teacher_weekly_timetable(user_id, semester_id):
@@ -1588,14 +1849,14 @@ def get_teacher_weekly_timetable(user_id, semester_id):
         # --- Step 3: Execute the SQL query with semester_id, teacher_id, and week_number filtering ---
         # Modify the query to filter by teacher_id and week_number
         query = """
-        SELECT te.id, te.week_number, te.assignment_id,
+        SELECT te.id, te.placement_id, te.entry_key, te.week_number, te.assignment_id,
                s.name as semester_name,
                m.id as major_id, m.name as major_name,
                c.id as course_id, c.name as course_name, c.course_type,
                u.username as teacher_name, t.id as teacher_id,
                cl.id as classroom_id, cl.building || '-' || cl.room_number as classroom_name,
                ts.id as timeslot_id, ts.day_of_week, ts.period, ts.start_time, ts.end_time -- TIME fields
-        FROM timetable_entries te
+        FROM timetable_entries_for_week(%s, %s) te -- only the requested week, answered by index
         JOIN semesters s ON te.semester_id = s.id
         LEFT JOIN majors m ON te.major_id = m.id -- Use LEFT JOIN for major
         JOIN courses c ON te.course_id = c.id
@@ -1603,11 +1864,11 @@ def get_teacher_weekly_timetable(user_id, semester_id):
         JOIN users u ON t.user_id = u.id
         LEFT JOIN classrooms cl ON te.classroom_id = cl.id -- Use LEFT JOIN for classroom
         JOIN time_slots ts ON te.timeslot_id = ts.id
-        WHERE te.semester_id = %s AND te.teacher_id = %s AND te.week_number = %s -- ADD week_number filter
+        WHERE te.teacher_id = %s
         ORDER BY ts.day_of_week, ts.period; -- Order by day/period within the selected week
         """
         # Pass the parameters in the correct order for the query
-        cur.execute(query, (semester_id, teacher_id_from_user, week_number))
+        cur.execute(query, (semester_id, week_number, teacher_id_from_user))
 
         fetched_entries = cur.fetchall()
 
@@ -2009,84 +2270,72 @@ def delete_teacher_scheduling_preference(preference_id):
 from flask import abort # 用于返回错误码
 
 # --- Helper function for conflict checking (Simplified Example) ---
-def check_conflict(conn, entry_id_to_update, new_timeslot_id, new_classroom_id, week_number):
+# --- 手动调整的冲突检测 ---
+# 冲突由数据库保证：单周条目之间由唯一约束 (migrations/0005)，放置 (周次集合) 之间、放置与单周条目之间由
+# 按周展开的占用表 timetable_occupancy 的唯一约束 (migrations/0013，触发器在同一语句内维护)。
+# 写入时直接尝试，违反约束 (UniqueViolation) 即为冲突；并发写入同一时间段时后写入的一方在唯一索引上等待并被拒绝。
+# 只有写入失败后才查询冲突的课程，用于生成提示信息。
+
+# 移动单周条目 (周次不变)
+ENTRY_MOVE_QUERY = """
+    UPDATE timetable_entries
+    SET timeslot_id = %(timeslot_id)s, classroom_id = %(classroom_id)s
+    WHERE id = %(entry_id)s
+    RETURNING id
+"""
+
+# 把从放置中移出的一周另存为单周条目
+PLACEMENT_WEEK_MOVE_QUERY = """
+    INSERT INTO timetable_entries
+    (semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id)
+    VALUES (%(semester_id)s, %(major_id)s, %(course_id)s, %(teacher_id)s, %(classroom_id)s, %(timeslot_id)s,
+            %(week_number)s, %(assignment_id)s)
+    RETURNING id
+"""
+
+
+def describe_conflict(cur, semester_id, week_number, timeslot_id, teacher_id, classroom_id, major_id, own_key):
     """
-    检查更新后的条目是否与现有条目冲突 (简化版)。
-    返回冲突描述字符串，如果无冲突则返回 None。
-    注意：这个检查逻辑需要根据你的具体规则细化！
+    查找与目标安排冲突的课程并返回冲突描述，无冲突时返回 None。cur 需为 RealDictCursor。
+    own_key 为被调整条目自身的 entry_key ('e<id>' 或 'p<放置ID>-<周次>')，不算作冲突。
     """
-    cur = None
-    try:
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+    # 同学期、同周次、同时间段内的其他课 (排除自身)，按周次集合索引展开
+    def find_occupant(column, value):
+        cur.execute(f"""
+            SELECT te.entry_key, c.name as course_name, m.name as major_name
+            FROM timetable_entries_for_week(%s, %s) te
+            JOIN courses c ON te.course_id = c.id
+            JOIN majors m ON te.major_id = m.id
+            WHERE te.{column} = %s
+              AND te.timeslot_id = %s
+              AND te.entry_key <> %s
+            LIMIT 1
+        """, (semester_id, week_number, value, timeslot_id, own_key))
+        return cur.fetchone()
 
-        # 获取要更新的条目的基本信息 (教师, 专业, 学期)
-        cur.execute("""
-            SELECT teacher_id, major_id, semester_id
-            FROM timetable_entries
-            WHERE id = %s
-        """, (entry_id_to_update,))
-        entry_info = cur.fetchone()
-        if not entry_info:
-            return "要更新的条目不存在" # 或者在调用前检查
+    # 检查教师冲突
+    teacher_conflict = find_occupant('teacher_id', teacher_id)
+    if teacher_conflict:
+        return f"教师在该时间已有课程: {teacher_conflict['course_name']}"
 
-        teacher_id = entry_info['teacher_id']
-        major_id = entry_info['major_id']
-        semester_id = entry_info['semester_id'] # 用于限定范围
+    # 检查教室冲突: 只有在指定了教室时才检查
+    if classroom_id:
+        classroom_conflict = find_occupant('classroom_id', classroom_id)
+        if classroom_conflict:
+            return f"教室在该时间已被专业 '{classroom_conflict['major_name']}' 的课程 '{classroom_conflict['course_name']}' 占用"
 
-        # 检查教师冲突: 同学期、同周次、新时间段，是否有其他课 (排除自身)
-        cur.execute("""
-            SELECT te.id, c.name as course_name
-            FROM timetable_entries te
-            JOIN courses c ON te.course_id = c.id
-            WHERE te.teacher_id = %s
-              AND te.semester_id = %s
-              AND te.week_number = %s
-              AND te.timeslot_id = %s
-              AND te.id != %s
-        """, (teacher_id, semester_id, week_number, new_timeslot_id, entry_id_to_update))
-        teacher_conflict = cur.fetchone()
-        if teacher_conflict:
-            return f"教师在该时间已有课程: {teacher_conflict['course_name']}"
-
-        # 检查教室冲突: 同学期、同周次、新时间段、新教室，是否已被占用 (排除自身)
-        if new_classroom_id: # 只有在指定了新教室时才检查
-            cur.execute("""
-                SELECT te.id, c.name as course_name, m.name as major_name
-                FROM timetable_entries te
-                JOIN courses c ON te.course_id = c.id
-                JOIN majors m ON te.major_id = m.id
-                WHERE te.classroom_id = %s
-                  AND te.semester_id = %s
-                  AND te.week_number = %s
-                  AND te.timeslot_id = %s
-                  AND te.id != %s
-            """, (new_classroom_id, semester_id, week_number, new_timeslot_id, entry_id_to_update))
-            classroom_conflict = cur.fetchone()
-            if classroom_conflict:
-                return f"教室在该时间已被专业 '{classroom_conflict['major_name']}' 的课程 '{classroom_conflict['course_name']}' 占用"
-
-        # 检查专业/班级冲突: 同学期、同周次、新时间段，该专业是否已有其他课 (排除自身)
-        cur.execute("""
-            SELECT te.id, c.name as course_name
-            FROM timetable_entries te
-            JOIN courses c ON te.course_id = c.id
-            WHERE te.major_id = %s
-              AND te.semester_id = %s
-              AND te.week_number = %s
-              AND te.timeslot_id = %s
-              AND te.id != %s
-        """, (major_id, semester_id, week_number, new_timeslot_id, entry_id_to_update))
-        major_conflict = cur.fetchone()
-        if major_conflict:
-            return f"该专业在该时间已有课程: {major_conflict['course_name']}"
+    # 检查专业/班级冲突
+    major_conflict = find_occupant('major_id', major_id)
+    if major_conflict:
+        return f"该专业在该时间已有课程: {major_conflict['course_name']}"
 
-        return None # 无冲突
+    return None # 无冲突
 
-    except Exception as e:
-        app.logger.error(f"Conflict check error: {e}", exc_info=True)
-        return f"冲突检查时发生错误: {e}" # 返回错误信息
-    finally:
-        if cur: cur.close()
+
+def conflict_response(cur, semester_id, week_number, timeslot_id, teacher_id, classroom_id, major_id, own_key):
+    """写入因冲突被拒绝后返回的 409 响应。"""
+    reason = describe_conflict(cur, semester_id, week_number, timeslot_id, teacher_id, classroom_id, major_id, own_key)
+    return jsonify({"message": f"无法更新，存在冲突: {reason or '该时间段已有其他课程'}"}), 409 # 409 Conflict
 
 
 # --- 添加新的 API 端点 ---
@@ -2142,57 +2391,37 @@ def update_timetable_entry(entry_id):
             return jsonify({"message": "classroom_id 必须是一个有效的整数或 null"}), 400
     # 如果 raw_classroom_id 就是 None, new_classroom_id 保持为 None
 
-    # 3. 获取 week_number (必须是正整数)
-    raw_week_number = data.get('week_number')
-    if raw_week_number is None:
-        return jsonify({"message": "缺少必要参数: week_number"}), 400
-    try:
-        week_number = int(raw_week_number)
-        if week_number <= 0:  # 添加业务逻辑验证
-            raise ValueError("周数必须是正数")
-    except (ValueError, TypeError):
-        return jsonify({"message": "week_number 必须是一个有效的正整数"}), 400
+    # 周次取条目自身的 week_number (请求体中的 week_number 仅供前端使用)
     conn = None
     cur = None
     try:
         conn = get_db_connection()
         if conn is None: return jsonify({"message": "数据库连接失败"}), 500
         conn.autocommit = False # 使用事务
-        cur = conn.cursor()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
 
-        # --- 检查目标 timeslot 和 classroom 是否有效 (如果提供了 classroom) ---
-        cur.execute("SELECT 1 FROM time_slots WHERE id = %s", (new_timeslot_id,))
-        if not cur.fetchone():
+        # --- 乐观写入：冲突由唯一约束在这一条语句中拒绝 ---
+        # 注意：这里只更新 timeslot_id 和 classroom_id，周次不变
+        try:
+            cur.execute(ENTRY_MOVE_QUERY, {'entry_id': entry_id, 'timeslot_id': new_timeslot_id,
+                                           'classroom_id': new_classroom_id})
+            updated = cur.fetchone()
+        except psycopg2.errors.UniqueViolation: # 与其他单周条目或放置冲突
+            updated = None
+        except psycopg2.errors.ForeignKeyViolation:
             conn.rollback()
-            return jsonify({"message": f"无效的时间段 ID: {new_timeslot_id}"}), 400
-        if new_classroom_id is not None:
-            cur.execute("SELECT 1 FROM classrooms WHERE id = %s", (new_classroom_id,))
-            if not cur.fetchone():
-                conn.rollback()
-                return jsonify({"message": f"无效的教室 ID: {new_classroom_id}"}), 400
-
-        # --- 执行冲突检查 ---
-        # 注意：week_number 需要从 data 中获取，因为更新是针对特定周次的
-        conflict_reason = check_conflict(conn, entry_id, new_timeslot_id, new_classroom_id, week_number)
-        if conflict_reason:
-            conn.rollback() # 回滚事务
-            return jsonify({"message": f"无法更新，存在冲突: {conflict_reason}"}), 409 # 409 Conflict
-
-        # --- 更新数据库 ---
-        # 注意：这里只更新 timeslot_id 和 classroom_id
-        # 如果需要更新其他字段（如 week_number），也需要加入 SET 子句
-        # 但通常手动调整是移动到新的时间/地点，周次不变或由用户指定
-        update_query = """
-        UPDATE timetable_entries
-        SET timeslot_id = %s, classroom_id = %s
-        WHERE id = %s
-        """
-        # 使用 new_classroom_id，如果它是 None，数据库字段需要允许 NULL
-        cur.execute(update_query, (new_timeslot_id, new_classroom_id, entry_id))
+            return jsonify({"message": f"无效的时间段 ID ({new_timeslot_id}) 或教室 ID ({new_classroom_id})"}), 400
 
-        if cur.rowcount == 0:
+        if updated is None:
+            # 条目不存在，或者与已有课程冲突
             conn.rollback()
-            return jsonify({"message": "未找到要更新的课表条目，或数据未改变"}), 404
+            cur.execute("SELECT semester_id, week_number, teacher_id, major_id FROM timetable_entries WHERE id = %s",
+                        (entry_id,))
+            entry = cur.fetchone()
+            if not entry:
+                return jsonify({"message": "未找到要更新的课表条目"}), 404
+            return conflict_response(cur, entry['semester_id'], entry['week_number'], new_timeslot_id,
+                                     entry['teacher_id'], new_classroom_id, entry['major_id'], f"e{entry_id}")
 
         conn.commit() # 提交事务
         return jsonify({"message": "课表条目更新成功"}), 200
@@ -2238,10 +2467,126 @@ def delete_timetable_entry(entry_id):
         if cur: cur.close()
         if conn: conn.close()
 
+# --- 放置 (周次集合) 中单周的手动调整 ---
+# 调整或删除放置中的某一周时，把该周从周次集合中移除 (作为例外)，调整后的安排另存为一条单周条目。
+def detach_placement_week(cur, placement_id, week_number):
+    """从放置的周次集合中移除一周 (集合为空时删除整行)，返回放置原来的信息；该周不在集合中时返回 None。"""
+    cur.execute("""
+        SELECT id, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, assignment_id
+        FROM timetable_placements
+        WHERE id = %s AND weeks @> ARRAY[%s]
+        FOR UPDATE
+    """, (placement_id, week_number))
+    placement = cur.fetchone()
+    if not placement:
+        return None
+    cur.execute("""
+        UPDATE timetable_placements SET weeks = array_remove(weeks, %s)
+        WHERE id = %s AND cardinality(weeks) > 1
+    """, (week_number, placement_id))
+    if cur.rowcount == 0:
+        cur.execute("DELETE FROM timetable_placements WHERE id = %s", (placement_id,))
+    return placement
+
+
+@app.route('/api/timetables/placement/<int:placement_id>/week/<int:week_number>', methods=['PUT'])
+def update_placement_week(placement_id, week_number):
+    data = request.get_json()
+    if not data:
+        return jsonify({"message": "请求体不能为空"}), 400
+    try:
+        new_timeslot_id = int(data.get('timeslot_id'))
+        new_classroom_id = int(data['classroom_id']) if data.get('classroom_id') is not None else None
+    except (ValueError, TypeError):
+        return jsonify({"message": "timeslot_id 必须是有效的整数，classroom_id 必须是有效的整数或 null"}), 400
+
+    conn = None
+    cur = None
+    try:
+        conn = get_db_connection()
+        if conn is None: return jsonify({"message": "数据库连接失败"}), 500
+        conn.autocommit = False # 使用事务
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+
+        placement = detach_placement_week(cur, placement_id, week_number)
+        if not placement:
+            conn.rollback()
+            return jsonify({"message": "未找到要更新的课表条目"}), 404
+
+        # 乐观写入：放置自身的这一周已移出 (占用随之删除)，其余冲突由唯一约束拒绝
+        params = {key: placement[key] for key in ('semester_id', 'major_id', 'course_id', 'teacher_id', 'assignment_id')}
+        params.update(classroom_id=new_classroom_id if new_classroom_id is not None else placement['classroom_id'],
+                      timeslot_id=new_timeslot_id, week_number=week_number)
+        try:
+            cur.execute(PLACEMENT_WEEK_MOVE_QUERY, params)
+            inserted = cur.fetchone()
+        except psycopg2.errors.UniqueViolation: # 与其他单周条目或放置冲突
+            inserted = None
+        except psycopg2.errors.ForeignKeyViolation:
+            conn.rollback()
+            return jsonify({"message": f"无效的时间段 ID ({new_timeslot_id}) 或教室 ID ({new_classroom_id})"}), 400
+        if inserted is None:
+            conn.rollback() # 同时撤销对放置周次集合的修改
+            return conflict_response(cur, params['semester_id'], week_number, new_timeslot_id, params['teacher_id'],
+                                     params['classroom_id'], params['major_id'], f"p{placement_id}-{week_number}")
+        new_entry_id = inserted['id']
+
+        conn.commit()
+        return jsonify({"message": "课表条目更新成功", "entry_id": new_entry_id}), 200
+
+    except psycopg2.Error as db_err:
+        if conn: conn.rollback()
+        app.logger.error(f"DB error updating placement {placement_id} week {week_number}: {db_err}", exc_info=True)
+        return jsonify({"message": f"数据库操作失败: {db_err}"}), 500
+    except Exception as e:
+        if conn: conn.rollback()
+        app.logger.error(f"Error updating placement {placement_id} week {week_number}: {e}", exc_info=True)
+        return jsonify({"message": f"服务器内部错误: {e}"}), 500
+    finally:
+        if cur: cur.close()
+        if conn:
+            conn.autocommit = True # 恢复 autocommit 状态
+            conn.close()
+
+
+@app.route('/api/timetables/placement/<int:placement_id>/week/<int:week_number>', methods=['DELETE'])
+def delete_placement_week(placement_id, week_number):
+    conn = None
+    cur = None
+    try:
+        conn = get_db_connection()
+        if conn is None: return jsonify({"message": "数据库连接失败"}), 500
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+
+        placement = detach_placement_week(cur, placement_id, week_number)
+        if not placement:
+            conn.rollback()
+            return jsonify({"message": "删除失败，课表条目可能不存在"}), 404
+        conn.commit()
+        return jsonify({"message": f"第 {week_number} 周的课表条目删除成功"}), 200
+
+    except psycopg2.Error as db_err:
+        if conn: conn.rollback()
+        app.logger.error(f"DB error deleting placement {placement_id} week {week_number}: {db_err}", exc_info=True)
+        return jsonify({"message": f"数据库操作失败: {db_err}"}), 500
+    except Exception as e:
+        if conn: conn.rollback()
+        app.logger.error(f"Error deleting placement {placement_id} week {week_number}: {e}", exc_info=True)
+        return jsonify({"message": f"服务器内部错误: {e}"}), 500
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
 @app.route('/')
 def index():
     return "Timetable Scheduling Backend API is running."
 
 
 if __name__ == '__main__':
+    # With the debug reloader only the serving child process (WERKZEUG_RUN_MAIN) prepares the schema and starts workers
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        migrate.apply_migrations(get_db_connection)
+        reference_cache.start_listener(connect_db)
+        if JOB_WORKER_THREADS > 0:
+            job_queue.start_worker_threads(get_db_connection, JOB_WORKER_THREADS)
     app.run(debug=True, port=5000)
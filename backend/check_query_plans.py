@@ -0,0 +1,208 @@
+# check_query_plans.py
+# -*- coding: utf-8 -*-
+# 查询计划检查：在独立的 schema 中按 migrations/ 建表、生成大规模合成数据，
+# 对热点接口的查询执行 EXPLAIN，出现以下情况时以非 0 状态退出：
+#   - 课表表 (timetable_entries / timetable_placements 及其分区) 或其他大表上出现 Seq Scan；
+#   - 查询扫描了目标学期以外的分区 (分区裁剪失效)。
+# 用法: python check_query_plans.py [--keep]
+import argparse
+import json
+import re
+import sys
+
+import app
+import migrate
+import scheduler_module
+from app import get_db_connection
+
+CHECK_SCHEMA = 'query_plan_check'
+LARGE_TABLE_ROWS = 10000  # 超过该行数的表不允许顺序扫描 (小的维表如 time_slots 顺序扫描是正常的)
+PARTITION_NAME_PATTERN = re.compile(r'^timetable_(?:entries|placements)_s(\d+)$')
+OCCUPANCY_TRIGGERS = [(table, f"{table}_occupancy_{event}")
+                      for table in ('timetable_placements', 'timetable_entries') for event in ('insert', 'sync')]
+
+# 合成数据规模：6 个学期，每学期 1 万个教学任务、2 万条放置 (每条 16 周) 和 9600 条单周条目
+SYNTHETIC_DATA_SQL = """
+INSERT INTO semesters (id, name, start_date, end_date)
+SELECT s, '学期' || s, DATE '2020-09-01' + s * 182, DATE '2020-09-01' + s * 182 + 119 FROM generate_series(1, 6) s;
+INSERT INTO majors (id, name) SELECT m, '专业' || m FROM generate_series(1, 300) m;
+INSERT INTO courses (id, name, total_sessions, course_type) SELECT c, '课程' || c, 32, '理论课' FROM generate_series(1, 2000) c;
+INSERT INTO users (id, username, password, role) SELECT u, 'user' || u, 'x', 'teacher' FROM generate_series(1, 3000) u;
+INSERT INTO teachers (id, user_id) SELECT t, t FROM generate_series(1, 3000) t;
+INSERT INTO users (id, username, password, role) SELECT 3000 + u, 'student' || u, 'x', 'student' FROM generate_series(1, 30000) u;
+INSERT INTO students (user_id, major_id, student_id_number) SELECT 3000 + u, 1 + u % 300, 'S' || u FROM generate_series(1, 30000) u;
+INSERT INTO classrooms (id, building, room_number, capacity)
+SELECT r, '教学楼' || (r / 100), 'R' || r, 60 FROM generate_series(1, 600) r;
+INSERT INTO time_slots (id, day_of_week, period, start_time, end_time)
+SELECT (d - 1) * 8 + p, '周' || d, p, TIME '08:00' + (p - 1) * INTERVAL '1 hour', TIME '08:50' + (p - 1) * INTERVAL '1 hour'
+FROM generate_series(1, 5) d, generate_series(1, 8) p;
+INSERT INTO course_assignments (id, major_id, course_id, teacher_id, semester_id, is_core_course, expected_students)
+SELECT a, 1 + a % 300, 1 + a % 2000, 1 + a % 3000, 1 + a % 6, a % 3 = 0, 50 FROM generate_series(1, 60000) a;
+INSERT INTO timetable_placements (semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, weeks, assignment_id)
+SELECT ca.semester_id, ca.major_id, ca.course_id, ca.teacher_id, 1 + (ca.id * 7 + k) % 600, 1 + (ca.id * 13 + k * 17) % 40,
+       ARRAY(SELECT generate_series(1, 16)), ca.id
+FROM course_assignments ca, generate_series(0, 1) k;
+-- 单周条目满足唯一约束：同一 (周次, 时间段) 内的教师、教室、专业互不相同
+INSERT INTO timetable_entries (semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id)
+SELECT s, 1 + (q * 17 + r) % 300, 1 + n % 2000, 1 + (q * 191 + r) % 3000, 1 + (q * 37 + r) % 600, 1 + r / 16, 1 + r % 16,
+       6 * (1 + n % 1000) + s - 1
+FROM generate_series(1, 6) s, generate_series(0, 9599) n, LATERAL (SELECT n % 640 AS r, n / 640 AS q) k;
+"""
+
+# 热点接口使用的查询 (与 app.py 中对应接口的 FROM / JOIN / WHERE 一致)，参数取合成数据中存在的值。
+# 手动调整的写入语句直接取自 app.py；按条目 ID 更新时不知道学期，不检查分区裁剪 (各分区走主键索引)。
+SEMESTER_ID, WEEK, TEACHER_ID, MAJOR_ID, CLASSROOM_ID, TIMESLOT_ID, STUDENT_USER_ID = 3, 5, 3, 3, 10, 7, 3003
+ENTRY_ID = 100
+UNPRUNED_QUERIES = {"update_timetable_entry: 乐观写入"}
+HOT_QUERIES = [
+    ("update_timetable_entry: 乐观写入", app.ENTRY_MOVE_QUERY,
+     {'entry_id': ENTRY_ID, 'timeslot_id': TIMESLOT_ID, 'classroom_id': CLASSROOM_ID}),
+    ("update_placement_week: 乐观写入", app.PLACEMENT_WEEK_MOVE_QUERY,
+     {'semester_id': SEMESTER_ID, 'major_id': MAJOR_ID, 'course_id': 1, 'teacher_id': TEACHER_ID, 'assignment_id': 3,
+      'classroom_id': CLASSROOM_ID, 'timeslot_id': TIMESLOT_ID, 'week_number': WEEK}),
+    ("describe_conflict: 教师占用", """
+        SELECT te.entry_key, c.name, m.name FROM timetable_entries_for_week(%s, %s) te
+        JOIN courses c ON te.course_id = c.id JOIN majors m ON te.major_id = m.id
+        WHERE te.teacher_id = %s AND te.timeslot_id = %s AND te.entry_key <> %s LIMIT 1
+    """, (SEMESTER_ID, WEEK, TEACHER_ID, TIMESLOT_ID, 'e0')),
+    ("describe_conflict: 教室占用", """
+        SELECT te.entry_key, c.name, m.name FROM timetable_entries_for_week(%s, %s) te
+        JOIN courses c ON te.course_id = c.id JOIN majors m ON te.major_id = m.id
+        WHERE te.classroom_id = %s AND te.timeslot_id = %s AND te.entry_key <> %s LIMIT 1
+    """, (SEMESTER_ID, WEEK, CLASSROOM_ID, TIMESLOT_ID, 'e0')),
+    ("describe_conflict: 专业占用", """
+        SELECT te.entry_key, c.name, m.name FROM timetable_entries_for_week(%s, %s) te
+        JOIN courses c ON te.course_id = c.id JOIN majors m ON te.major_id = m.id
+        WHERE te.major_id = %s AND te.timeslot_id = %s AND te.entry_key <> %s LIMIT 1
+    """, (SEMESTER_ID, WEEK, MAJOR_ID, TIMESLOT_ID, 'e0')),
+    ("get_major_timetable (按周)", """
+        SELECT te.*, ts.day_of_week, c.name, u.username, cl.room_number, m.name
+        FROM timetable_entries_for_week(%s, %s) te
+        JOIN time_slots ts ON te.timeslot_id = ts.id JOIN courses c ON te.course_id = c.id
+        JOIN teachers t ON te.teacher_id = t.id JOIN users u ON t.user_id = u.id
+        JOIN classrooms cl ON te.classroom_id = cl.id JOIN majors m ON te.major_id = m.id
+        WHERE te.major_id = %s AND te.semester_id = %s ORDER BY ts.day_of_week, ts.period
+    """, (SEMESTER_ID, WEEK, MAJOR_ID, SEMESTER_ID)),
+    ("get_major_timetable (整学期) / export_major_timetable", """
+        SELECT te.*, ts.day_of_week, c.name, u.username, cl.room_number, m.name
+        FROM timetable_entries_expanded te
+        JOIN time_slots ts ON te.timeslot_id = ts.id JOIN courses c ON te.course_id = c.id
+        JOIN teachers t ON te.teacher_id = t.id JOIN users u ON t.user_id = u.id
+        JOIN classrooms cl ON te.classroom_id = cl.id JOIN majors m ON te.major_id = m.id
+        WHERE te.major_id = %s AND te.semester_id = %s ORDER BY ts.day_of_week, ts.period
+    """, (MAJOR_ID, SEMESTER_ID)),
+    ("get_student_timetable: 查询学生专业", """
+        SELECT s.major_id FROM students s JOIN users u ON s.user_id = u.id WHERE u.id = %s AND u.role = 'student'
+    """, (STUDENT_USER_ID,)),
+    ("get_teacher_timetable / export_teacher_timetable", """
+        SELECT te.*, s.name, m.name, c.name, u.username, cl.room_number, ts.day_of_week
+        FROM timetable_entries_expanded te
+        JOIN semesters s ON te.semester_id = s.id JOIN majors m ON te.major_id = m.id
+        JOIN courses c ON te.course_id = c.id JOIN teachers t ON te.teacher_id = t.id
+        JOIN users u ON t.user_id = u.id JOIN classrooms cl ON te.classroom_id = cl.id
+        JOIN time_slots ts ON te.timeslot_id = ts.id
+        WHERE te.semester_id = %s AND te.teacher_id = %s ORDER BY te.week_number, ts.day_of_week, ts.period
+    """, (SEMESTER_ID, TEACHER_ID)),
+    ("get_teacher_dashboard_timetable (按周)", """
+        SELECT te.*, s.name, m.name, c.name, u.username, cl.room_number, ts.day_of_week
+        FROM timetable_entries_for_week(%s, %s) te
+        JOIN semesters s ON te.semester_id = s.id LEFT JOIN majors m ON te.major_id = m.id
+        JOIN courses c ON te.course_id = c.id JOIN teachers t ON te.teacher_id = t.id
+        JOIN users u ON t.user_id = u.id LEFT JOIN classrooms cl ON te.classroom_id = cl.id
+        JOIN time_slots ts ON te.timeslot_id = ts.id
+        WHERE te.teacher_id = %s ORDER BY ts.day_of_week, ts.period
+    """, (SEMESTER_ID, WEEK, TEACHER_ID)),
+]
+
+
+def scoped_connection():
+    """连接到检查用的 schema (search_path 只包含 CHECK_SCHEMA)；会话设置会改变，所以不从连接池借用。"""
+    conn = app.connect_db()
+    cur = conn.cursor()
+    cur.execute(f"SET search_path TO {CHECK_SCHEMA}")
+    conn.commit()
+    cur.close()
+    return conn
+
+
+def walk_plan(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from walk_plan(child)
+
+
+def plan_problems(cur, plan, semester_id):
+    """返回计划中的问题描述列表；semester_id 为 None 时不检查分区裁剪。"""
+    problems = []
+    for node in walk_plan(plan):
+        relation = node.get('Relation Name')
+        if not relation:
+            continue
+        partition = PARTITION_NAME_PATTERN.match(relation)
+        if partition and semester_id is not None and int(partition.group(1)) != semester_id:
+            problems.append(f"扫描了其他学期的分区 {relation}")
+        if node['Node Type'] == 'Seq Scan':
+            cur.execute("SELECT reltuples FROM pg_class WHERE oid = to_regclass(%s)", (relation,))
+            row = cur.fetchone()
+            rows = row[0] if row else 0
+            if relation.startswith('timetable_') or rows >= LARGE_TABLE_ROWS:
+                problems.append(f"{relation} 上的顺序扫描 (约 {int(rows)} 行)")
+    return problems
+
+
+def run_check():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(f"DROP SCHEMA IF EXISTS {CHECK_SCHEMA} CASCADE")
+    cur.execute(f"CREATE SCHEMA {CHECK_SCHEMA}")
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    migrate.apply_migrations(scoped_connection)
+    conn = scoped_connection()
+    cur = conn.cursor()
+    # 合成的放置只用于检查查询计划，彼此之间并不满足冲突约束：去掉维护占用表的触发器 (migrations/0013)，
+    # 这只影响检查用的 schema；EXPLAIN 不执行触发器，热点查询的计划不受影响
+    for table, trigger in OCCUPANCY_TRIGGERS:
+        cur.execute(f"DROP TRIGGER {trigger} ON {table}")
+    print("正在生成合成数据...")
+    cur.execute(SYNTHETIC_DATA_SQL.split(";", 1)[0])  # 先插入学期，再按学期建分区
+    for semester_id in range(1, 7):
+        scheduler_module.ensure_semester_partitions(cur, semester_id)
+    cur.execute(SYNTHETIC_DATA_SQL.split(";", 1)[1])
+    cur.execute("ANALYZE")
+    conn.commit()
+
+    failures = 0
+    for name, query, params in HOT_QUERIES:
+        cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+        plan_json = cur.fetchone()[0]
+        plan = (plan_json if isinstance(plan_json, list) else json.loads(plan_json))[0]['Plan']
+        problems = plan_problems(cur, plan, None if name in UNPRUNED_QUERIES else SEMESTER_ID)
+        if problems:
+            failures += 1
+            print(f"[FAIL] {name}")
+            for problem in problems:
+                print(f"       - {problem}")
+        else:
+            print(f"[ OK ] {name} (估算代价 {plan['Total Cost']:.1f})")
+    cur.close()
+    conn.close()
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="检查热点查询在大数据量下是否走索引")
+    parser.add_argument('--keep', action='store_true', help=f"保留 {CHECK_SCHEMA} schema 以便手动分析")
+    args = parser.parse_args()
+    try:
+        failures = run_check()
+    finally:
+        if not args.keep:
+            conn = get_db_connection()
+            conn.cursor().execute(f"DROP SCHEMA IF EXISTS {CHECK_SCHEMA} CASCADE")
+            conn.commit()
+            conn.close()
+    print("查询计划检查通过。" if failures == 0 else f"查询计划检查失败：{failures} 个查询存在问题。")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,497 @@
+# course_plan_import.py
+# -*- coding: utf-8 -*-
+# 课程计划导入：流式读取上传的 .xlsx (openpyxl read_only) 或 .csv 文件，每 CHUNK_ROWS 行校验并写入一次数据库，
+# 内存占用只与块大小 (以及差异导入时该学期现有的教学任务) 有关，与文件行数无关。
+# 整个导入仍在一个事务中完成，任何数据库错误都会回滚全部写入。
+import csv
+import io
+
+import pandas as pd
+import psycopg2
+from psycopg2.extras import execute_values
+
+# --- 检查 openpyxl 库 ---
+try:
+    import openpyxl
+
+    OPENPYXL_AVAILABLE = True
+except ImportError:
+    OPENPYXL_AVAILABLE = False
+
+EXPECTED_COLUMNS = [
+    '学期名称', '专业名称', '课程名称', '总课时',
+    '课程类型', '授课教师姓名', '是否核心课程', '预计学生人数'
+]
+SUPPORTED_EXTENSIONS = ('.xlsx', '.xls', '.csv')
+CHUNK_ROWS = 1000
+CORE_COURSE_VALUES = ['是', 'yes', 'true', '1']
+
+# replace: 删除学期的全部教学任务后重新插入 (课表条目随教学任务级联删除)；
+# diff: 按 (专业, 课程, 教师) 与现有教学任务匹配，只插入、更新、删除有变化的任务，未变化任务的课表保留
+IMPORT_MODE_REPLACE = 'replace'
+IMPORT_MODE_DIFF = 'diff'
+IMPORT_MODES = (IMPORT_MODE_REPLACE, IMPORT_MODE_DIFF)
+DIFF_DETAIL_LIMIT = 500  # 差异明细每类最多返回的条数 (计数不受限制)
+
+
+class CoursePlanImportError(ValueError):
+    """文件无法解析、缺少必需的列或学期无效；消息可直接返回给前端。"""
+
+
+# ==================================
+# 1. 辅助函数
+# ==================================
+def get_ids_by_names(cur, table_name, name_column, names, id_column='id', additional_conditions=None):
+    """用一条 `= ANY(%s)` 查询按名称查找多个 ID (可附加等值条件)，返回 {名称: ID}。"""
+    names = list(names)
+    if not names:
+        return {}
+    query = f"SELECT {name_column}, {id_column} FROM {table_name} WHERE {name_column} = ANY(%s)"
+    params = [names]
+    if additional_conditions:
+        for col, val in additional_conditions.items():
+            query += f" AND {col} = %s"
+            params.append(val)
+    cur.execute(query, tuple(params))
+    return dict(cur.fetchall())
+
+
+def resolve_names(cur, cache, names, table_name, name_column, **kwargs):
+    """只查询 cache 中还没有的名称；找不到的名称以 None 记入 cache，后续块不再重复查询。"""
+    unseen = {name for name in names if name not in cache and name != ''}
+    if unseen:
+        found = get_ids_by_names(cur, table_name, name_column, unseen, **kwargs)
+        cache.update({name: found.get(name) for name in unseen})
+    return cache
+
+
+def clean_text_column(series):
+    """Excel 列 -> 去除首尾空白的字符串，空单元格为 ''。"""
+    return series.fillna('').astype(str).str.strip()
+
+
+def parse_count_column(series):
+    """数值列 -> (数值, 不是非负数的单元格掩码)。"""
+    values = pd.to_numeric(series, errors='coerce')
+    return values, values.isna() | (values < 0)
+
+
+# ==================================
+# 2. 流式读取
+# ==================================
+def _rows_to_chunks(rows, columns, chunk_rows):
+    """把 (数据行号, 值元组) 序列切成 DataFrame 块；索引为从 0 开始的数据行号 (Excel 行号 = 索引 + 2)。"""
+    index, values = [], []
+    for row_index, row in rows:
+        if all(value is None or (isinstance(value, str) and not value.strip()) for value in row):
+            continue  # 与 pd.read_excel 一致，跳过空行
+        index.append(row_index)
+        values.append(row[:len(columns)] + (None,) * (len(columns) - len(row)))
+        if len(values) >= chunk_rows:
+            yield pd.DataFrame(values, index=index, columns=columns)
+            index, values = [], []
+    if values:
+        yield pd.DataFrame(values, index=index, columns=columns)
+
+
+def _open_xlsx(stream, chunk_rows):
+    if not OPENPYXL_AVAILABLE:
+        raise CoursePlanImportError("服务器未安装 openpyxl，无法读取 .xlsx 文件。")
+    try:
+        workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+    except Exception as e:  # openpyxl 对损坏的文件会抛出多种异常 (zipfile.BadZipFile, KeyError 等)
+        raise CoursePlanImportError(f"无法解析上传的 Excel 文件: {e}")
+    sheet = workbook.worksheets[0]
+    rows = sheet.iter_rows(values_only=True)
+    header = next(rows, None)
+    if header is None:
+        workbook.close()
+        raise CoursePlanImportError("上传的 Excel 文件为空或无法解析。")
+    columns = [str(value).strip() if value is not None else '' for value in header]
+    total_rows = sheet.max_row - 1 if sheet.max_row else None  # 取自文件中的 dimension 记录，可能缺失
+
+    def chunks():
+        try:
+            yield from _rows_to_chunks(enumerate(rows), columns, chunk_rows)
+        finally:
+            workbook.close()
+
+    return columns, total_rows, chunks()
+
+
+def _open_csv(stream, chunk_rows):
+    # 用 csv.reader 逐条读取并按文件行号编号 (与 xlsx 相同，文件行号 = 索引 + 2)：
+    # 空行 (csv.reader 产出 []) 跳过但计入行号，引号内含换行的记录按起始行计
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    reader = csv.reader(text)
+    try:
+        header = next(reader, None)
+        while header is not None and not any(value.strip() for value in header):  # 表头前的空行
+            header = next(reader, None)
+    except (csv.Error, UnicodeDecodeError) as e:
+        raise CoursePlanImportError(f"无法解析上传的 CSV 文件 (需要 UTF-8 编码): {e}")
+    if header is None:
+        raise CoursePlanImportError("上传的 CSV 文件为空或无法解析。")
+    columns = [value.strip() for value in header]
+
+    def numbered_rows():
+        next_line = reader.line_num + 1
+        try:
+            for row in reader:
+                yield next_line - 2, tuple(value if value != '' else None for value in row)
+                next_line = reader.line_num + 1
+        except (csv.Error, UnicodeDecodeError) as e:
+            raise CoursePlanImportError(f"无法解析上传的 CSV 文件第 {next_line} 行 (需要 UTF-8 编码): {e}")
+
+    return columns, None, _rows_to_chunks(numbered_rows(), columns, chunk_rows)
+
+
+def _open_xls(stream, chunk_rows):
+    # 旧版 .xls 是二进制格式，无法流式读取：整表读入后再分块处理
+    df = pd.read_excel(stream, engine='xlrd')
+    df.columns = [str(col).strip() for col in df.columns]
+    chunks = (df.iloc[start:start + chunk_rows] for start in range(0, len(df), chunk_rows))
+    return list(df.columns), len(df), chunks
+
+
+def open_course_plan_reader(stream, filename, chunk_rows=CHUNK_ROWS):
+    """按文件扩展名打开读取器，返回 (列名, 数据行数或 None, DataFrame 块迭代器)。"""
+    lower_name = filename.lower()
+    if lower_name.endswith('.xlsx'):
+        return _open_xlsx(stream, chunk_rows)
+    if lower_name.endswith('.csv'):
+        return _open_csv(stream, chunk_rows)
+    if lower_name.endswith('.xls'):
+        return _open_xls(stream, chunk_rows)
+    raise CoursePlanImportError("不支持的文件类型。请上传 .xlsx、.xls 或 .csv 文件")
+
+
+# ==================================
+# 3. 按块校验与写入
+# ==================================
+def import_chunk(cur, df, semester_id, semester_name, lookups, summary, existing=None):
+    """
+    校验并写入一块数据，返回该块的错误 [(Excel 行号, 错误信息)]。existing 为 None 时直接插入，否则按差异写入。
+    每项检查都是对整块的向量化掩码，一行只保留第一条错误，检查顺序与逐行导入时一致。
+    """
+    row_labels = 'Row ' + pd.Series(df.index + 2, index=df.index).astype(str) + ': '
+    excel_semester_names = clean_text_column(df['学期名称'])
+    major_names = clean_text_column(df['专业名称'])
+    course_names = clean_text_column(df['课程名称'])
+    course_types = clean_text_column(df['课程类型'])
+    teacher_names = clean_text_column(df['授课教师姓名'])
+    total_sessions, invalid_sessions = parse_count_column(df['总课时'])
+    expected_students, invalid_students = parse_count_column(df['预计学生人数'])
+    is_core_course = clean_text_column(df['是否核心课程']).str.lower().isin(CORE_COURSE_VALUES)
+    row_errors = pd.Series('', index=df.index)
+
+    def reject(mask, messages):
+        mask = mask & (row_errors == '')
+        row_errors[mask] = messages[mask]
+
+    majors_map = resolve_names(cur, lookups['majors'], set(major_names), 'majors', 'name')
+    teacher_users_map = resolve_names(cur, lookups['teacher_users'], set(teacher_names), 'users', 'username',
+                                      additional_conditions={'role': 'teacher'})
+    teacher_user_ids = teacher_names.map(teacher_users_map)
+    teachers_map = resolve_names(cur, lookups['teachers'], {int(user_id) for user_id in teacher_user_ids.dropna()},
+                                 'teachers', 'user_id')
+    major_ids = major_names.map(majors_map)
+    teacher_ids = teacher_user_ids.map(teachers_map)
+
+    reject((excel_semester_names == '') | (major_names == '') | (course_names == '') | (teacher_names == ''),
+           row_labels + "必填字段 (学期名称, 专业名称, 课程名称, 授课教师姓名) 不能为空。已跳过。")
+    reject(excel_semester_names != semester_name,
+           row_labels + "Excel中的学期名称 '" + excel_semester_names + f"' 与选定的学期 '{semester_name}' 不匹配。已跳过。")
+    reject(major_ids.isna(), row_labels + "专业 '" + major_names + "' 未找到。已跳过。")
+    reject(invalid_sessions, row_labels + "课程 '" + course_names + "' 的总课时 '" + df['总课时'].astype(str)
+           + "' 无效。必须是非负整数。已跳过。")
+
+    # 通过以上检查的行所引用的课程整批新建或更新 (同名课程以最后一行为准，未变化的课程不改写)
+    course_rows = pd.DataFrame({'name': course_names, 'total_sessions': total_sessions,
+                                'course_type': course_types})[row_errors == '']
+    course_rows = course_rows.drop_duplicates('name', keep='last')
+    if not course_rows.empty:
+        upserted = execute_values(cur, """
+            INSERT INTO courses (name, total_sessions, course_type) VALUES %s
+            ON CONFLICT (name) DO UPDATE
+            SET total_sessions = EXCLUDED.total_sessions, course_type = EXCLUDED.course_type
+            WHERE (courses.total_sessions, courses.course_type)
+                  IS DISTINCT FROM (EXCLUDED.total_sessions, EXCLUDED.course_type)
+            RETURNING xmax = 0 AS inserted
+            """, list(zip(course_rows['name'], course_rows['total_sessions'].astype(int).tolist(),
+                          course_rows['course_type'])), page_size=len(course_rows), fetch=True)
+        created = sum(1 for (inserted,) in upserted if inserted)
+        summary['created_courses'] += created
+        summary['updated_courses'] += len(upserted) - created
+    course_ids = course_names.map(get_ids_by_names(cur, 'courses', 'name', course_rows['name']))
+
+    reject(teacher_user_ids.isna(),
+           row_labels + "教师 '" + teacher_names + "' (角色: Teacher) 未在 users 表中找到。已跳过。")
+    reject(teacher_ids.isna(), row_labels + "教师 '" + teacher_names + "' (User ID: "
+           + teacher_user_ids.astype('Int64').astype(str) + ") 未在 teachers 表中找到 (可能未关联到用户)。已跳过。")
+    reject(invalid_students, row_labels + "课程 '" + course_names + "' 的预计学生人数 '"
+           + df['预计学生人数'].astype(str) + "' 无效。必须是非负整数。已跳过。")
+
+    valid = row_errors == ''
+    errors = list(zip((row_errors.index[~valid] + 2).tolist(), row_errors[~valid].tolist()))
+    rows = zip(major_ids[valid].astype(int).tolist(), course_ids[valid].astype(int).tolist(),
+               teacher_ids[valid].astype(int).tolist(), is_core_course[valid].tolist(),
+               expected_students[valid].astype(int).tolist(),
+               major_names[valid], course_names[valid], teacher_names[valid])
+    if existing is None:
+        assignments = [(major_id, course_id, teacher_id, semester_id, is_core, expected)
+                       for major_id, course_id, teacher_id, is_core, expected, *_ in rows]
+        insert_assignments(cur, assignments)
+        summary['inserted_assignments'] += len(assignments)
+    else:
+        apply_assignment_diff(cur, rows, semester_id, existing, summary)
+    return errors
+
+
+def insert_assignments(cur, assignments):
+    if assignments:
+        execute_values(cur, """
+            INSERT INTO course_assignments (major_id, course_id, teacher_id, semester_id, is_core_course, expected_students)
+            VALUES %s
+            """, assignments, page_size=len(assignments))
+
+
+# ==================================
+# 4. 差异导入
+# ==================================
+def load_existing_assignments(cur, semester_id):
+    """学期现有的教学任务：{(专业ID, 课程ID, 教师ID): [(任务ID, 是否核心课程, 预计学生人数), ...]}，同键多条时按 ID 排列。"""
+    cur.execute("""
+        SELECT id, major_id, course_id, teacher_id, is_core_course, expected_students
+        FROM course_assignments WHERE semester_id = %s ORDER BY id
+    """, (semester_id,))
+    existing = {}
+    for assignment_id, major_id, course_id, teacher_id, is_core, expected in cur.fetchall():
+        existing.setdefault((major_id, course_id, teacher_id), []).append((assignment_id, is_core, expected))
+    return existing
+
+
+def record_diff(summary, kind, item):
+    details = summary['diff'][kind]
+    if len(details) < DIFF_DETAIL_LIMIT:
+        details.append(item)
+    else:
+        summary['diff']['truncated'] = True
+
+
+def apply_assignment_diff(cur, rows, semester_id, existing, summary):
+    """
+    把一块有效行与现有教学任务按多重集合匹配：同一个 (专业, 课程, 教师) 出现几次就依次匹配几条现有任务，
+    匹配上且字段相同的保持不变，字段不同的更新，没有可匹配任务的插入。匹配过的任务从 existing 中移除。
+    """
+    inserts, updates = [], []
+    for major_id, course_id, teacher_id, is_core, expected, major_name, course_name, teacher_name in rows:
+        item = {'major_name': major_name, 'course_name': course_name, 'teacher_name': teacher_name,
+                'is_core_course': is_core, 'expected_students': expected}
+        matches = existing.get((major_id, course_id, teacher_id))
+        if not matches:
+            inserts.append((major_id, course_id, teacher_id, semester_id, is_core, expected))
+            record_diff(summary, 'inserted', item)
+            continue
+        assignment_id, old_is_core, old_expected = matches.pop(0)
+        if old_is_core == is_core and old_expected == expected:
+            summary['unchanged_assignments'] += 1
+            continue
+        updates.append((assignment_id, is_core, expected))
+        record_diff(summary, 'updated', dict(item, assignment_id=assignment_id, previous={
+            'is_core_course': old_is_core, 'expected_students': old_expected}))
+
+    insert_assignments(cur, inserts)
+    if updates:
+        execute_values(cur, """
+            UPDATE course_assignments ca
+            SET is_core_course = v.is_core_course, expected_students = v.expected_students
+            FROM (VALUES %s) AS v (id, is_core_course, expected_students)
+            WHERE ca.id = v.id
+            """, updates, page_size=len(updates))
+    summary['inserted_assignments'] += len(inserts)
+    summary['updated_assignments'] += len(updates)
+
+
+def delete_unmatched_assignments(cur, existing, summary):
+    """删除文件中没有出现的现有教学任务 (其课表条目随之级联删除)。"""
+    stale_ids = [assignment_id for matches in existing.values() for assignment_id, _, _ in matches]
+    if not stale_ids:
+        return
+    cur.execute("""
+        DELETE FROM course_assignments ca
+        USING majors m, courses c, teachers t, users u
+        WHERE ca.id = ANY(%s) AND m.id = ca.major_id AND c.id = ca.course_id
+          AND t.id = ca.teacher_id AND u.id = t.user_id
+        RETURNING ca.id, m.name, c.name, u.username, ca.is_core_course, ca.expected_students
+    """, (stale_ids,))
+    for assignment_id, major_name, course_name, teacher_name, is_core, expected in cur.fetchall():
+        record_diff(summary, 'deleted', {'assignment_id': assignment_id, 'major_name': major_name,
+                                         'course_name': course_name, 'teacher_name': teacher_name,
+                                         'is_core_course': is_core, 'expected_students': expected})
+    summary['deleted_assignments'] = cur.rowcount
+
+
+def import_course_plans(stream, filename, semester_id, get_connection_func, progress_callback=None,
+                        chunk_rows=CHUNK_ROWS, mode=IMPORT_MODE_REPLACE, error_callback=None):
+    """
+    用上传的文件更新学期的教学任务 (mode 见 IMPORT_MODES)，返回摘要 dict：processed_rows, created_courses,
+    updated_courses, inserted_assignments, updated_assignments, deleted_assignments, unchanged_assignments,
+    kept_unmatched_assignments, error_rows，以及差异导入时的明细 diff ({inserted, updated, deleted, truncated})。
+    被跳过的行逐块交给 error_callback([(Excel 行号, 错误信息)])；未提供 error_callback 时错误信息收集在 errors 中。
+    差异导入中有行被跳过时不删除未匹配的现有任务 (被跳过的行可能正对应它们)，只计入 kept_unmatched_assignments。
+    文件或学期无效时抛出 CoursePlanImportError；每处理完一块调用一次 progress_callback(progress)。
+    """
+    if mode not in IMPORT_MODES:
+        raise CoursePlanImportError(f"不支持的导入方式: {mode}")
+    columns, total_rows, chunks = open_course_plan_reader(stream, filename, chunk_rows)
+    missing_cols = [col for col in EXPECTED_COLUMNS if col not in columns]
+    if missing_cols:
+        raise CoursePlanImportError(f"Excel 文件缺少必需的列: {', '.join(missing_cols)}")
+
+    summary = {'mode': mode, 'processed_rows': 0, 'created_courses': 0, 'updated_courses': 0,
+               'inserted_assignments': 0, 'updated_assignments': 0, 'deleted_assignments': 0,
+               'unchanged_assignments': 0, 'kept_unmatched_assignments': 0, 'error_rows': 0, 'errors': [],
+               'diff': {'inserted': [], 'updated': [], 'deleted': [], 'truncated': False}
+               if mode == IMPORT_MODE_DIFF else None}
+    progress = {'stage': 'importing', 'total_rows': total_rows, 'processed_rows': 0, 'chunks': 0,
+                'inserted_assignments': 0, 'updated_assignments': 0, 'error_rows': 0}
+    lookups = {'majors': {}, 'teacher_users': {}, 'teachers': {}}
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM semesters WHERE id = %s", (semester_id,))
+        semester_row = cur.fetchone()
+        if not semester_row:
+            raise CoursePlanImportError(f"选定的学期ID {semester_id} 无效")
+
+        existing = None
+        if mode == IMPORT_MODE_DIFF:
+            existing = load_existing_assignments(cur, semester_id)
+        else:
+            cur.execute("DELETE FROM course_assignments WHERE semester_id = %s", (semester_id,))
+            summary['deleted_assignments'] = cur.rowcount
+        if progress_callback: progress_callback(dict(progress))
+
+        for chunk in chunks:
+            chunk_errors = import_chunk(cur, chunk, semester_id, semester_row[0], lookups, summary, existing)
+            summary['processed_rows'] += len(chunk)
+            summary['error_rows'] += len(chunk_errors)
+            if error_callback:
+                if chunk_errors: error_callback(chunk_errors)
+            else:
+                summary['errors'] += [message for _, message in chunk_errors]
+            progress.update(processed_rows=summary['processed_rows'], chunks=progress['chunks'] + 1,
+                            inserted_assignments=summary['inserted_assignments'],
+                            updated_assignments=summary['updated_assignments'], error_rows=summary['error_rows'])
+            if progress_callback: progress_callback(dict(progress))
+
+        if existing is not None:
+            if summary['error_rows']:
+                summary['kept_unmatched_assignments'] = sum(len(matches) for matches in existing.values())
+            else:
+                delete_unmatched_assignments(cur, existing, summary)
+
+        conn.commit()
+        print(f"IMPORT: 学期 {semester_id} 导入完成 ({mode})：{summary['processed_rows']} 行，"
+              f"新增 {summary['inserted_assignments']}、更新 {summary['updated_assignments']}、"
+              f"删除 {summary['deleted_assignments']} 条教学任务，{summary['error_rows']} 行被跳过。")
+        if progress_callback: progress_callback(dict(progress, stage='done'))
+        return summary
+    except Exception:
+        if conn: conn.rollback()
+        if progress_callback: progress_callback(dict(progress, stage='failed'))
+        raise
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+# ==================================
+# 5. 后台导入任务的上传文件与错误记录 (表结构见 migrations/0009_course_plan_import_jobs.sql)
+# ==================================
+UPLOAD_PART_SIZE = 1024 * 1024  # 上传文件按 1MB 分块保存
+
+
+def save_upload_parts(cur, job_id, stream):
+    """在提交任务的事务中按块保存上传的文件，返回字节数。"""
+    total = 0
+    part_number = 0
+    while True:
+        data = stream.read(UPLOAD_PART_SIZE)
+        if not data:
+            return total
+        part_number += 1
+        cur.execute("INSERT INTO import_upload_parts (job_id, part_number, data) VALUES (%s, %s, %s)",
+                    (job_id, part_number, psycopg2.Binary(data)))
+        total += len(data)
+
+
+def spool_upload(get_connection_func, job_id, target):
+    """把任务的上传文件逐块写入 target (本地临时文件)，每次只取一块。"""
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor(name=f"import_upload_{job_id}")  # 服务端游标
+        cur.itersize = 1
+        cur.execute("SELECT data FROM import_upload_parts WHERE job_id = %s ORDER BY part_number", (job_id,))
+        for (data,) in cur:
+            target.write(data)
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+def delete_upload_parts(get_connection_func, job_id):
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        cur.execute("DELETE FROM import_upload_parts WHERE job_id = %s", (job_id,))
+        conn.commit()
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+def record_import_errors(get_connection_func, job_id, errors, clear=False):
+    """提交一块的错误 (独立事务，任务运行期间即可查询)；clear=True 时先清除该任务以前的错误 (任务被重新执行)。"""
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        if clear:
+            cur.execute("DELETE FROM import_job_errors WHERE job_id = %s", (job_id,))
+        if errors:
+            execute_values(cur, """
+                INSERT INTO import_job_errors (job_id, row_number, message) VALUES %s
+                ON CONFLICT (job_id, row_number) DO NOTHING
+                """, [(job_id, row_number, message) for row_number, message in errors], page_size=len(errors))
+        conn.commit()
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+def get_import_errors(get_connection_func, job_id, offset, limit):
+    """按行号分页读取任务的错误，返回 (错误总数, [{row_number, message}])。"""
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        cur.execute("SELECT count(*) FROM import_job_errors WHERE job_id = %s", (job_id,))
+        total = cur.fetchone()[0]
+        cur.execute("""
+            SELECT row_number, message FROM import_job_errors WHERE job_id = %s
+            ORDER BY row_number OFFSET %s LIMIT %s
+        """, (job_id, offset, limit))
+        return total, [{'row_number': row_number, 'message': message} for row_number, message in cur.fetchall()]
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
@@ -0,0 +1,233 @@
+# db_pool.py
+# -*- coding: utf-8 -*-
+# 进程内共享的 PostgreSQL 连接池。
+# 借出的连接包装为 PooledConnection：接口与 psycopg2 连接相同，close() 把连接归还连接池而不是断开，
+# 因此现有 "conn = get_connection_func() ... finally: conn.close()" 的写法不需要修改。
+# 没有直接使用 psycopg2.pool.ThreadedConnectionPool：它在连接池满时立即抛出 PoolError 而不是等待，
+# 并且归还时会断开超过 minconn 的空闲连接，无法统计等待时间。
+import collections
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    """在 timeout 秒内没有可用连接。"""
+
+
+class ConnectionPool:
+    """
+    最多 maxconn 个连接 (借出 + 空闲)，启动时预先建立 minconn 个。
+    借出时对空闲超过 healthcheck_idle 秒的连接执行 SELECT 1，失效的连接被丢弃并重新建立。
+    """
+
+    def __init__(self, connect_func, minconn=1, maxconn=10, timeout=10.0, healthcheck_idle=30.0):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError(f"连接池大小无效: minconn={minconn}, maxconn={maxconn}")
+        self.connect_func = connect_func
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._idle = collections.deque()  # (连接, 归还时间)，从右端借出以优先复用最近使用的连接
+        self._stats = {
+            'checkouts': 0, 'waited_checkouts': 0, 'timeouts': 0,
+            'total_wait_seconds': 0.0, 'max_wait_seconds': 0.0,
+            'connections_opened': 0, 'connections_discarded': 0, 'in_use': 0,
+        }
+        for _ in range(minconn):
+            self._idle.append((self._open(), time.monotonic()))
+
+    def _open(self):
+        conn = self.connect_func()
+        with self._lock:
+            self._stats['connections_opened'] += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._stats['connections_discarded'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.healthcheck_idle:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """借出一个原始连接 (阻塞至多 timeout 秒)；一般通过 checkout() 使用。"""
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise PoolTimeout(f"{self.timeout} 秒内没有可用的数据库连接 (maxconn={self.maxconn})")
+        waited = time.monotonic() - started
+        try:
+            while True:
+                with self._lock:
+                    conn, idle_since = self._idle.pop() if self._idle else (None, None)
+                if conn is None:
+                    conn = self._open()
+                    break
+                if self._is_healthy(conn, idle_since):
+                    break
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            stats = self._stats
+            stats['checkouts'] += 1
+            stats['in_use'] += 1
+            stats['total_wait_seconds'] += waited
+            stats['max_wait_seconds'] = max(stats['max_wait_seconds'], waited)
+            if waited >= 0.001:
+                stats['waited_checkouts'] += 1
+        return conn
+
+    def putconn(self, conn):
+        """归还原始连接：回滚未结束的事务并恢复为新连接的默认状态，失效的连接直接丢弃。"""
+        try:
+            status = conn.info.transaction_status if not conn.closed else None
+            if status is None or status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                self._discard(conn)
+                return
+            try:
+                if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except psycopg2.Error:
+                self._discard(conn)
+                return
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        finally:
+            with self._lock:
+                self._stats['in_use'] -= 1
+            self._slots.release()
+
+    def checkout(self, keep=False):
+        """
+        借出一个连接，返回 Lease。keep=False 时最后一个 PooledConnection 关闭即归还连接池；
+        keep=True 时连接在 lease.release() 之前一直保留 (用于同一个请求内多次取连接)。
+        """
+        return Lease(self, self.getconn(), keep)
+
+    def connection(self):
+        """借出一个连接，close() 时归还连接池；可直接作为 get_connection_func 使用。"""
+        return self.checkout().handle()
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = list(self._idle), collections.deque()
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+    def stats(self):
+        """连接池状态与借出等待时间统计。"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+        stats['minconn'] = self.minconn
+        stats['maxconn'] = self.maxconn
+        stats['avg_wait_ms'] = round(stats['total_wait_seconds'] * 1000 / stats['checkouts'], 3) \
+            if stats['checkouts'] else 0.0
+        stats['max_wait_ms'] = round(stats.pop('max_wait_seconds') * 1000, 3)
+        stats['total_wait_seconds'] = round(stats['total_wait_seconds'], 3)
+        return stats
+
+
+class Lease:
+    """一次借出：可以派生多个 PooledConnection，共用同一个底层连接。"""
+
+    def __init__(self, pool, conn, keep):
+        self.pool = pool
+        self.conn = conn
+        self.keep = keep
+        self.open_handles = 0
+
+    def handle(self):
+        if self.conn is None:
+            raise psycopg2.InterfaceError("连接已归还连接池")
+        self.open_handles += 1
+        return PooledConnection(self)
+
+    def _handle_closed(self):
+        self.open_handles -= 1
+        if self.open_handles > 0 or self.conn is None:
+            return
+        if not self.keep:
+            self.release()
+            return
+        # 与关闭一个独立连接的效果一致：未提交的事务被放弃，下一次取用时是新连接的默认状态
+        conn = self.conn
+        try:
+            if not conn.closed:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+        except psycopg2.Error:
+            pass
+
+    def release(self):
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            self.pool.putconn(conn)
+
+
+class PooledConnection:
+    """借出的连接：属性与方法转发给底层 psycopg2 连接；close() 可重复调用，只归还一次。"""
+
+    __slots__ = ('_lease', '_conn')
+
+    def __init__(self, lease):
+        object.__setattr__(self, '_lease', lease)
+        object.__setattr__(self, '_conn', lease.conn)
+
+    def __getattr__(self, name):
+        conn = object.__getattribute__(self, '_conn')
+        if conn is None:
+            raise psycopg2.InterfaceError("connection already closed")
+        return getattr(conn, name)
+
+    def __setattr__(self, name, value):  # conn.autocommit = True 等
+        if self._conn is None:
+            raise psycopg2.InterfaceError("connection already closed")
+        setattr(self._conn, name, value)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._conn.__exit__(exc_type, exc_value, traceback)
+
+    @property
+    def closed(self):
+        return 1 if self._conn is None else self._conn.closed
+
+    def close(self):
+        if self._conn is not None:
+            object.__setattr__(self, '_conn', None)
+            self._lease._handle_closed()
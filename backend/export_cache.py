@@ -0,0 +1,175 @@
+# export_cache.py
+# -*- coding: utf-8 -*-
+# 导出文件 (xlsx / zip) 的磁盘缓存。
+# 缓存键为 (学期, 范围, 对象ID, 格式, 课表版本号, 基础数据版本号)：
+#   - 课表版本号 (timetable_versions，见 migrations/0010) 在排课写入和手动调课时递增；
+#   - 基础数据版本号 (reference_data_version_seq，见 migrations/0007、0012) 在名称、教学任务等变化时递增。
+# 基础数据有未提交的写入时 current_versions 返回 None，这时生成的导出不写入缓存。
+# 任何一个版本号变化后键随之改变，旧文件不会再被返回 (在下一次写入同一导出或按容量淘汰时删除)；
+# 因此无论写入发生在哪个进程或主机，缓存都不会返回过期内容。
+# 同一主机上的各进程共用缓存目录，总大小超过 EXPORT_CACHE_MAX_BYTES 时按最近使用时间 (atime) 淘汰。
+# 键的摘要同时作为 ETag；文件生成时间作为 Last-Modified。
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+import reference_cache
+
+EXPORT_CACHE_DIR = os.environ.get('EXPORT_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'course_scheduling_exports')
+EXPORT_CACHE_MAX_BYTES = int(os.environ.get('EXPORT_CACHE_MAX_MB', '512')) * 1024 * 1024
+FILE_SUFFIX = '.export'
+
+_lock = threading.Lock()
+_generating = {}  # 文件名 -> Lock：同一进程内同一导出只生成一次，不同导出互不等待
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def current_versions(semester_id, get_connection_func):
+    """
+    返回 (课表版本号, 基础数据版本号)；学期还没有课表写入时课表版本号为 0。
+    基础数据版本号未稳定 (有未提交的写入，见 reference_cache.read_version) 时返回 None。
+    """
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        reference_version, settled = reference_cache.read_version(cur)
+        if not settled:
+            return None
+        cur.execute("SELECT COALESCE((SELECT version FROM timetable_versions WHERE semester_id = %s), 0)",
+                    (semester_id,))
+        return cur.fetchone()[0], reference_version
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+class ExportKey:
+    """一个导出文件的缓存键。entity_id 为 None 表示整学期 (范围内的全部专业/教师)。"""
+
+    def __init__(self, semester_id, scope, entity_id, export_format, versions):
+        self.prefix = f"s{int(semester_id)}-{scope}-{entity_id if entity_id is not None else 'all'}-{export_format}-"
+        self.digest = hashlib.sha1(f"{self.prefix}{versions[0]}-{versions[1]}".encode()).hexdigest()[:20]
+
+    @property
+    def etag(self):
+        return self.digest
+
+    @property
+    def filename(self):
+        return f"{self.prefix}{self.digest}{FILE_SUFFIX}"
+
+
+def _path(name):
+    return os.path.join(EXPORT_CACHE_DIR, name)
+
+
+def _touch(path):
+    """记录最近使用时间 (atime)，mtime 保持为生成时间。"""
+    try:
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+    except OSError:
+        pass
+
+
+def open_or_create(key, generate):
+    """
+    返回缓存文件 (以二进制只读方式打开)；不存在时调用 generate() (返回 BytesIO) 生成并写入缓存。
+    写入先落到临时文件再改名，其他进程不会读到写了一半的文件；返回的是已打开的文件，之后被淘汰也不影响读取。
+    """
+    path = _path(key.filename)
+    with _lock:
+        key_lock = _generating.setdefault(key.filename, threading.Lock())
+    try:
+        with key_lock:
+            try:
+                cached = open(path, 'rb')
+                _count('hits')
+                _touch(path)
+                return cached
+            except FileNotFoundError:
+                _count('misses')
+            buffer = generate()
+            os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=EXPORT_CACHE_DIR, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as temp_file:
+                    temp_file.write(buffer.getvalue())
+                os.replace(temp_path, path)
+            except OSError:
+                if os.path.exists(temp_path): os.remove(temp_path)
+                raise
+            cached = open(path, 'rb')
+            _remove_superseded(key)
+            _evict()
+            return cached
+    finally:
+        with _lock:
+            _generating.pop(key.filename, None)
+
+
+def _count(name, amount=1):
+    with _lock:
+        _stats[name] += amount
+
+
+def _remove_superseded(key):
+    """删除同一导出的旧版本文件。"""
+    for name in os.listdir(EXPORT_CACHE_DIR):
+        if name.startswith(key.prefix) and name.endswith(FILE_SUFFIX) and name != key.filename:
+            _remove(name)
+
+
+def _remove(name):
+    try:
+        os.remove(_path(name))
+        return True
+    except FileNotFoundError:  # 其他进程已删除
+        return False
+
+
+def _evict():
+    """总大小超过上限时按最近使用时间从旧到新删除。"""
+    entries = []
+    total = 0
+    for name in os.listdir(EXPORT_CACHE_DIR):
+        if not name.endswith(FILE_SUFFIX): continue
+        try:
+            stat = os.stat(_path(name))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_atime, stat.st_size, name))
+        total += stat.st_size
+    entries.sort()
+    for _, size, name in entries:
+        if total <= EXPORT_CACHE_MAX_BYTES: break
+        if _remove(name): _count('evictions')
+        total -= size
+
+
+def invalidate(semester_id=None):
+    """删除某个学期 (或全部) 的缓存文件，返回删除的文件数。版本号变化后不调用也不会返回旧内容，这里只是尽早释放空间。"""
+    if not os.path.isdir(EXPORT_CACHE_DIR):
+        return 0
+    prefix = f"s{int(semester_id)}-" if semester_id is not None else ''
+    return sum(1 for name in os.listdir(EXPORT_CACHE_DIR)
+               if name.startswith(prefix) and name.endswith(FILE_SUFFIX) and _remove(name))
+
+
+def stats():
+    files = 0
+    total = 0
+    if os.path.isdir(EXPORT_CACHE_DIR):
+        for name in os.listdir(EXPORT_CACHE_DIR):
+            if name.endswith(FILE_SUFFIX):
+                try:
+                    total += os.stat(_path(name)).st_size
+                    files += 1
+                except FileNotFoundError:
+                    pass
+    with _lock:
+        counters = dict(_stats)
+    return dict(counters, files=files, total_bytes=total, max_bytes=EXPORT_CACHE_MAX_BYTES, directory=EXPORT_CACHE_DIR)
@@ -0,0 +1,138 @@
+# ical_export.py
+# -*- coding: utf-8 -*-
+# 个人课表的 iCalendar (.ics) 导出。
+# 直接读取按周次集合保存的放置 (timetable_placements)，每个放置输出一个每周重复的事件 (RRULE)，
+# 周次集合中缺少的周 (被调走或删除的周) 输出为 EXDATE；单周条目 (timetable_entries) 各输出一个单次事件。
+# 日期按学期 start_date 推算：第 1 周为 start_date 所在的周 (周一为一周的第一天)，时间取自 time_slots。
+# 整学期的课表因此只有几十个事件，适合作为日历客户端定期拉取的订阅源。
+import datetime
+import os
+
+import scheduler_module
+
+# 课表时间为当地时间；VTIMEZONE 只描述一个固定偏移 (学期开始时的偏移)，适用于不实行夏令时的时区
+ICS_TIMEZONE = os.environ.get('ICS_TIMEZONE', 'Asia/Shanghai')
+PRODUCT_ID = '-//course_scheduling//timetable//ZH'
+UID_DOMAIN = 'course-scheduling'
+CALENDAR_COLUMNS = ('teacher_id', 'major_id')  # 可以按哪一列筛选课表
+
+
+def load_calendar_rows(cur, semester_id, column, value):
+    """返回 (放置行, 单周条目行)，只读取该教师或专业的记录。"""
+    if column not in CALENDAR_COLUMNS:
+        raise ValueError(f"不支持按 {column} 导出日历")
+    cur.execute(f"""
+        SELECT id, major_id, course_id, teacher_id, classroom_id, timeslot_id, weeks
+        FROM timetable_placements WHERE semester_id = %s AND {column} = %s ORDER BY id
+    """, (semester_id, value))
+    placements = cur.fetchall()
+    cur.execute(f"""
+        SELECT id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number
+        FROM timetable_entries WHERE semester_id = %s AND {column} = %s ORDER BY id
+    """, (semester_id, value))
+    return placements, cur.fetchall()
+
+
+def week_date(semester, week_number, day_of_week):
+    first_monday = semester.start_date - datetime.timedelta(days=semester.start_date.weekday())
+    day_offset = scheduler_module.EXPORT_DAY_ORDER.get(day_of_week, 1) - 1
+    return first_monday + datetime.timedelta(weeks=week_number - 1, days=day_offset)
+
+
+def escape_text(value):
+    return (str(value).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def fold_line(line):
+    """按 RFC 5545 把内容行折叠为不超过 75 字节的物理行 (不拆开多字节字符)，行尾为 CRLF。"""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line + '\r\n'
+    parts = []
+    current = ''
+    limit = 75
+    size = 0
+    for char in line:
+        char_size = len(char.encode('utf-8'))
+        if size + char_size > limit:
+            parts.append(current)
+            current = ''
+            size = 0
+            limit = 74  # 续行开头的空格占一个字节
+        current += char
+        size += char_size
+    parts.append(current)
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def _local(value):
+    return value.strftime('%Y%m%dT%H%M%S')
+
+
+def _timezone_lines(semester):
+    try:
+        from zoneinfo import ZoneInfo
+        offset = datetime.datetime.combine(semester.start_date, datetime.time(12), ZoneInfo(ICS_TIMEZONE)).utcoffset()
+    except Exception:  # 没有时区数据时按 UTC+8 处理
+        offset = datetime.timedelta(hours=8)
+    minutes = int(offset.total_seconds() // 60)
+    formatted = f"{'+' if minutes >= 0 else '-'}{abs(minutes) // 60:02d}{abs(minutes) % 60:02d}"
+    return ['BEGIN:VTIMEZONE', f'TZID:{ICS_TIMEZONE}', 'BEGIN:STANDARD', 'DTSTART:19700101T000000',
+            f'TZOFFSETFROM:{formatted}', f'TZOFFSETTO:{formatted}', 'END:STANDARD', 'END:VTIMEZONE']
+
+
+def _event_lines(uid, stamp, start, end, row, all_data, recurrence=None, exdates=None):
+    course = all_data['courses'].get(row['course_id'])
+    teacher = all_data['teachers'].get(row['teacher_id'])
+    major = all_data['majors'].get(row['major_id'])
+    classroom = all_data['classrooms'].get(row['classroom_id'])
+    lines = ['BEGIN:VEVENT', f'UID:{uid}', f'DTSTAMP:{stamp}',
+             f'DTSTART;TZID={ICS_TIMEZONE}:{_local(start)}', f'DTEND;TZID={ICS_TIMEZONE}:{_local(end)}']
+    if recurrence:
+        lines.append(recurrence)
+    if exdates:
+        lines.append(f'EXDATE;TZID={ICS_TIMEZONE}:' + ','.join(_local(value) for value in exdates))
+    lines.append(f"SUMMARY:{escape_text(course.name if course else '?')}")
+    lines.append(f"LOCATION:{escape_text(classroom.name if classroom else '?')}")
+    lines.append('DESCRIPTION:' + escape_text(f"教师: {teacher.name if teacher else '?'}\n专业: {major.name if major else '?'}"))
+    lines.append('END:VEVENT')
+    return lines
+
+
+def iter_calendar(semester, placements, single_entries, all_data, calendar_name):
+    """逐行产出 .ics 内容 (已折叠、以 CRLF 结尾)。"""
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    header = ['BEGIN:VCALENDAR', 'VERSION:2.0', f'PRODID:{PRODUCT_ID}', 'CALSCALE:GREGORIAN', 'METHOD:PUBLISH',
+              f'X-WR-CALNAME:{escape_text(calendar_name)}', f'X-WR-TIMEZONE:{ICS_TIMEZONE}']
+    for line in header + _timezone_lines(semester):
+        yield fold_line(line)
+
+    def slot_times(row, week_number):
+        timeslot = all_data['timeslots'].get(row['timeslot_id'])
+        if timeslot is None:
+            return None
+        day = week_date(semester, week_number, timeslot.day_of_week)
+        return datetime.datetime.combine(day, timeslot.start_time), datetime.datetime.combine(day, timeslot.end_time)
+
+    for row in placements:
+        weeks = sorted(set(row['weeks']))
+        if not weeks or slot_times(row, weeks[0]) is None:
+            continue
+        start, end = slot_times(row, weeks[0])
+        recurrence = f"RRULE:FREQ=WEEKLY;COUNT={weeks[-1] - weeks[0] + 1}" if len(weeks) > 1 else None
+        present = set(weeks)
+        exdates = [start + datetime.timedelta(weeks=week - weeks[0])
+                   for week in range(weeks[0], weeks[-1] + 1) if week not in present]
+        for line in _event_lines(f"placement-{row['id']}-s{semester.id}@{UID_DOMAIN}", stamp, start, end, row,
+                                 all_data, recurrence, exdates):
+            yield fold_line(line)
+
+    for row in single_entries:
+        times = slot_times(row, row['week_number'])
+        if times is None:
+            continue
+        for line in _event_lines(f"entry-{row['id']}-s{semester.id}@{UID_DOMAIN}", stamp, times[0], times[1], row,
+                                 all_data):
+            yield fold_line(line)
+    yield fold_line('END:VCALENDAR')
@@ -0,0 +1,356 @@
+# job_queue.py
+# -*- coding: utf-8 -*-
+# 基于 PostgreSQL background_jobs 表的后台任务队列。
+# 任务领取使用 SELECT ... FOR UPDATE SKIP LOCKED，同一数据库上的多个工作线程/进程可以安全地共享队列。
+import os
+import socket
+import threading
+import time
+import traceback
+
+import psycopg2
+import psycopg2.extras
+
+# ==================================
+# 1. 任务状态 (表结构见 migrations/0002_background_jobs.sql)
+# ==================================
+JOB_STATUS_QUEUED = 'queued'
+JOB_STATUS_RUNNING = 'running'
+JOB_STATUS_SUCCEEDED = 'succeeded'
+JOB_STATUS_FAILED = 'failed'
+JOB_STATUS_CANCELLED = 'cancelled'
+FINISHED_JOB_STATUSES = (JOB_STATUS_SUCCEEDED, JOB_STATUS_FAILED, JOB_STATUS_CANCELLED)
+
+PROGRESS_WRITE_INTERVAL = 0.5  # 秒；进度写库的最小间隔 (阶段变化时立即写入)
+HEARTBEAT_INTERVAL = 30  # 秒；任务运行期间由心跳线程刷新 heartbeat_at，与是否上报进度无关
+STALE_AFTER_SECONDS = 600  # 心跳超过这么久未刷新的运行中任务视为工作者已退出
+REQUEUE_CHECK_INTERVAL = 60  # 秒；空闲的工作者检查超时任务的最小间隔 (其它工作进程退出后留下的任务)
+
+# job_type -> handler(params, report_progress)，params 中附带 job_id；handler 返回可 JSON 序列化的结果
+JOB_HANDLERS = {}
+
+
+class JobCancelled(Exception):
+    """任务处理函数在检测到取消请求后抛出。"""
+
+
+class JobFailed(Exception):
+    """任务处理函数以失败结束时抛出，result 仍会保存到任务记录中 (例如排课失败时的摘要)。"""
+
+    def __init__(self, message, result=None):
+        super().__init__(message)
+        self.result = result
+
+
+def register_job_handler(job_type, handler):
+    JOB_HANDLERS[job_type] = handler
+
+
+# ==================================
+# 2. 任务的提交、查询与取消
+# ==================================
+def enqueue_job(get_connection_func, job_type, params=None, before_commit=None):
+    """
+    提交任务，返回任务 ID。before_commit(cur, job_id) 在同一事务中执行 (例如保存任务需要的上传文件)，
+    任务在提交之后才对工作者可见。
+    """
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        cur.execute("INSERT INTO background_jobs (job_type, params) VALUES (%s, %s) RETURNING id",
+                    (job_type, psycopg2.extras.Json(params or {})))
+        job_id = cur.fetchone()[0]
+        if before_commit: before_commit(cur, job_id)
+        conn.commit()
+        return job_id
+    except psycopg2.Error:
+        if conn: conn.rollback()
+        raise
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+def get_job(get_connection_func, job_id):
+    """返回任务记录字典，不存在时返回 None。"""
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute("""
+            SELECT id, job_type, params, status, progress, result, error, cancel_requested, worker_id,
+                   created_at, started_at, finished_at, heartbeat_at
+            FROM background_jobs WHERE id = %s
+        """, (job_id,))
+        row = cur.fetchone()
+        return dict(row) if row else None
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+def request_job_cancel(get_connection_func, job_id):
+    """
+    请求取消任务：排队中的任务直接标记为已取消；运行中的任务设置 cancel_requested，
+    由工作线程在下一次上报进度时中止。返回取消后的任务状态，任务不存在时返回 None。
+    """
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE background_jobs
+            SET cancel_requested = TRUE,
+                status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END,
+                finished_at = CASE WHEN status = 'queued' THEN CURRENT_TIMESTAMP ELSE finished_at END
+            WHERE id = %s
+            RETURNING status
+        """, (job_id,))
+        row = cur.fetchone()
+        conn.commit()
+        return row[0] if row else None
+    except psycopg2.Error:
+        if conn: conn.rollback()
+        raise
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+# ==================================
+# 3. 工作线程使用的队列操作
+# ==================================
+def claim_next_job(get_connection_func, worker_id, job_types=None):
+    """
+    领取最早排队的一个任务并标记为运行中，没有可领取的任务时返回 None。
+    被其它工作者锁定的行会被 SKIP LOCKED 跳过，因此多个工作者不会领到同一任务。
+    """
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        type_filter = "AND job_type = ANY(%s)" if job_types else ""
+        cur.execute(f"""
+            UPDATE background_jobs
+            SET status = 'running', worker_id = %s, started_at = CURRENT_TIMESTAMP, heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = (
+                SELECT id FROM background_jobs
+                WHERE status = 'queued' {type_filter}
+                ORDER BY created_at, id
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING id, job_type, params, worker_id
+        """, (worker_id, list(job_types)) if job_types else (worker_id,))
+        row = cur.fetchone()
+        conn.commit()
+        return dict(row) if row else None
+    except psycopg2.Error:
+        if conn: conn.rollback()
+        raise
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+def update_job_progress(get_connection_func, job_id, worker_id, progress):
+    """
+    写入最新进度并刷新心跳，返回任务是否应当中止：已被请求取消，
+    或已不再由该工作者持有 (心跳超时后被重新排队，可能已由其它工作者领取)。
+    """
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE background_jobs SET progress = %s, heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = %s AND status = 'running' AND worker_id = %s RETURNING cancel_requested
+        """, (psycopg2.extras.Json(progress), job_id, worker_id))
+        row = cur.fetchone()
+        conn.commit()
+        return row is None or bool(row[0])
+    except psycopg2.Error:
+        if conn: conn.rollback()
+        raise
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+def touch_job_heartbeat(get_connection_func, job_id, worker_id):
+    """刷新运行中任务的心跳，返回任务是否仍由该工作者持有 (已结束或已被重新排队时返回 False)。"""
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE background_jobs SET heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = %s AND status = 'running' AND worker_id = %s
+        """, (job_id, worker_id))
+        held = cur.rowcount == 1
+        conn.commit()
+        return held
+    except psycopg2.Error:
+        if conn: conn.rollback()
+        raise
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+def _heartbeat_loop(get_connection_func, job_id, worker_id, stop_event):
+    """每隔 HEARTBEAT_INTERVAL 秒刷新一次心跳，直到 stop_event 被设置或任务不再由该工作者持有。"""
+    while not stop_event.wait(HEARTBEAT_INTERVAL):
+        try:
+            if not touch_job_heartbeat(get_connection_func, job_id, worker_id):
+                print(f"JOBS: 任务 {job_id} 已不再由工作者 {worker_id} 持有，停止心跳")
+                return
+        except Exception as e:  # 数据库暂时不可用：下一轮再试
+            print(f"JOBS: 任务 {job_id} 心跳写入失败: {e}")
+
+
+def finish_job(get_connection_func, job_id, worker_id, status, result=None, error=None):
+    """
+    记录任务的最终状态，返回是否写入。任务已不再由该工作者持有 (被重新排队后由其它工作者领取，或已结束) 时不写入，
+    不会覆盖新持有者的结果。
+    """
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE background_jobs
+            SET status = %s, result = %s, error = %s, finished_at = CURRENT_TIMESTAMP, heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = %s AND status = 'running' AND worker_id = %s
+        """, (status, psycopg2.extras.Json(result) if result is not None else None, error, job_id, worker_id))
+        written = cur.rowcount == 1
+        conn.commit()
+        if not written:
+            print(f"JOBS: 任务 {job_id} 已不再由工作者 {worker_id} 持有，结果 ({status}) 未写入")
+        return written
+    except psycopg2.Error:
+        if conn: conn.rollback()
+        raise
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+def requeue_stale_jobs(get_connection_func, stale_after_seconds=STALE_AFTER_SECONDS):
+    """
+    把心跳超时的运行中任务 (工作进程异常退出) 重新放回队列，返回重新排队的任务数。
+    运行中的任务由 run_job 的心跳线程每 HEARTBEAT_INTERVAL 秒刷新心跳，长时间不上报进度的阶段不会被误判。
+    """
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE background_jobs SET status = 'queued', worker_id = NULL, started_at = NULL
+            WHERE status = 'running' AND heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+        """, (stale_after_seconds,))
+        count = cur.rowcount
+        conn.commit()
+        return count
+    except psycopg2.Error:
+        if conn: conn.rollback()
+        raise
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+def run_job(get_connection_func, job):
+    """执行一个已领取的任务并记录最终状态。"""
+    job_id = job['id']
+    worker_id = job['worker_id']
+    handler = JOB_HANDLERS.get(job['job_type'])
+    if handler is None:
+        finish_job(get_connection_func, job_id, worker_id, JOB_STATUS_FAILED,
+                   error=f"未知的任务类型: {job['job_type']}")
+        return
+
+    last_write = {'at': 0.0, 'stage': None}
+
+    def report_progress(progress):
+        """写入进度 (节流)；任务已被请求取消或已不再由该工作者持有时抛出 JobCancelled。"""
+        now = time.monotonic()
+        stage = progress.get('stage')
+        if stage == last_write['stage'] and now - last_write['at'] < PROGRESS_WRITE_INTERVAL:
+            return
+        last_write.update(at=now, stage=stage)
+        if update_job_progress(get_connection_func, job_id, worker_id, progress):
+            raise JobCancelled()
+
+    print(f"JOBS: 开始执行任务 {job_id} ({job['job_type']})")
+    heartbeat_stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat_loop, name=f"job-{job_id}-heartbeat", daemon=True,
+                                 args=(get_connection_func, job_id, worker_id, heartbeat_stop))
+    heartbeat.start()
+    try:
+        result = handler(dict(job['params'] or {}, job_id=job_id), report_progress)
+        if finish_job(get_connection_func, job_id, worker_id, JOB_STATUS_SUCCEEDED, result=result):
+            print(f"JOBS: 任务 {job_id} 已完成")
+    except JobCancelled as cancelled:
+        if finish_job(get_connection_func, job_id, worker_id, JOB_STATUS_CANCELLED, error=str(cancelled) or "任务已取消"):
+            print(f"JOBS: 任务 {job_id} 已取消")
+    except JobFailed as failed:
+        if finish_job(get_connection_func, job_id, worker_id, JOB_STATUS_FAILED, result=failed.result, error=str(failed)):
+            print(f"JOBS: 任务 {job_id} 执行失败: {failed}")
+    except Exception as e:
+        traceback.print_exc()
+        if finish_job(get_connection_func, job_id, worker_id, JOB_STATUS_FAILED, error=str(e)):
+            print(f"JOBS: 任务 {job_id} 执行失败: {e}")
+    finally:
+        heartbeat_stop.set()
+        heartbeat.join()
+
+
+def run_worker(get_connection_func, worker_id=None, poll_interval=1.0, stop_event=None, job_types=None):
+    """
+    工作者主循环：不断领取并执行任务，队列为空时按 poll_interval 轮询，直到 stop_event 被设置。
+    空闲时每 REQUEUE_CHECK_INTERVAL 秒把心跳超时的任务重新排队：某个工作进程退出而其它进程仍在运行时，
+    它留下的任务不必等到下一次进程启动。
+    """
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+    stop_event = stop_event or threading.Event()
+    print(f"JOBS: 工作者 {worker_id} 已启动")
+    last_requeue_check = time.monotonic()
+    while not stop_event.is_set():
+        try:
+            job = claim_next_job(get_connection_func, worker_id, job_types)
+        except Exception as e:
+            print(f"JOBS: 工作者 {worker_id} 领取任务失败: {e}")
+            job = None
+        if job is None:
+            if time.monotonic() - last_requeue_check >= REQUEUE_CHECK_INTERVAL:
+                last_requeue_check = time.monotonic()
+                try:
+                    requeued = requeue_stale_jobs(get_connection_func)
+                    if requeued:
+                        print(f"JOBS: 工作者 {worker_id} 把 {requeued} 个心跳超时的任务重新排队")
+                except Exception as e:
+                    print(f"JOBS: 工作者 {worker_id} 检查超时任务失败: {e}")
+            stop_event.wait(poll_interval)
+            continue
+        run_job(get_connection_func, job)
+
+
+def start_worker_threads(get_connection_func, count, poll_interval=1.0):
+    """在当前进程中启动 count 个守护工作线程，返回用于停止它们的 Event。"""
+    requeue_stale_jobs(get_connection_func)
+    stop_event = threading.Event()
+    for index in range(count):
+        threading.Thread(target=run_worker, name=f"job-worker-{index + 1}", daemon=True,
+                         kwargs={'get_connection_func': get_connection_func, 'poll_interval': poll_interval,
+                                 'stop_event': stop_event}).start()
+    return stop_event
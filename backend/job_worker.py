@@ -0,0 +1,33 @@
+# job_worker.py
+# -*- coding: utf-8 -*-
+# 独立的后台任务工作进程，与 Flask 服务共享同一个 background_jobs 队列。
+# 用法: python job_worker.py --processes 4
+import argparse
+import multiprocessing
+
+import job_queue
+import migrate
+from app import get_db_connection, get_db_pool  # 导入 app 时会注册各类任务的处理函数
+
+
+def worker_process_main(poll_interval):
+    job_queue.run_worker(get_db_connection, poll_interval=poll_interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="运行后台任务工作进程")
+    parser.add_argument('--processes', type=int, default=1, help="工作进程数")
+    parser.add_argument('--poll-interval', type=float, default=1.0, help="队列为空时的轮询间隔 (秒)")
+    args = parser.parse_args()
+
+    migrate.apply_migrations(get_db_connection)
+    job_queue.requeue_stale_jobs(get_db_connection)
+    get_db_pool().closeall()  # 子进程各自建立连接池，不继承父进程的连接
+    if args.processes <= 1:
+        worker_process_main(args.poll_interval)
+    else:
+        processes = [multiprocessing.Process(target=worker_process_main, args=(args.poll_interval,),
+                                             name=f"job-worker-{index + 1}")
+                     for index in range(args.processes)]
+        for process in processes: process.start()
+        for process in processes: process.join()
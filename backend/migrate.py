@@ -0,0 +1,142 @@
+# migrate.py
+# -*- coding: utf-8 -*-
+# 版本化的数据库结构迁移。迁移文件位于 migrations/ 目录，文件名为 <4 位版本号>_<说明>.sql 或 .py：
+#   .sql 文件整体执行；.py 文件需定义 upgrade(cur)。
+# 每个迁移在单独的事务中执行并记录到 schema_migrations 表；多个进程同时启动时用 advisory lock 串行化。
+# 用法: python migrate.py            应用所有未执行的迁移
+#       python migrate.py --status   查看迁移状态
+import argparse
+import importlib.util
+import os
+import re
+from collections import namedtuple
+
+import psycopg2
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE_PATTERN = re.compile(r'^(\d{4})_(\w+)\.(sql|py)$')
+MIGRATION_LOCK_KEY = 7302401  # pg_advisory_lock 的键，只用于迁移
+
+# 0001 对应最初的 创建数据库.py 建表语句；迁移工具出现之前建好的库 (已有 semesters 表) 直接记为已应用
+BASELINE_VERSION = 1
+BASELINE_MARKER_TABLE = 'semesters'
+
+SCHEMA_MIGRATIONS_DDL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INT PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+Migration = namedtuple('Migration', ['version', 'name', 'path'])
+
+
+def list_migrations():
+    """按版本号返回 migrations/ 目录中的全部迁移。"""
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE_PATTERN.match(filename)
+        if match:
+            migrations.append(Migration(int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    migrations.sort(key=lambda m: m.version)
+    versions = [m.version for m in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f"迁移版本号重复: {versions}")
+    return migrations
+
+
+def _run_migration(cur, migration):
+    if migration.path.endswith('.sql'):
+        with open(migration.path, encoding='utf-8') as f:
+            cur.execute(f.read())
+    else:
+        spec = importlib.util.spec_from_file_location(f"migration_{migration.version:04d}", migration.path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module.upgrade(cur)
+
+
+def _applied_versions(cur):
+    cur.execute("SELECT version, applied_at FROM schema_migrations")
+    return dict(cur.fetchall())
+
+
+def apply_migrations(get_connection_func, target_version=None):
+    """应用所有 (或截至 target_version 的) 未执行迁移，返回本次应用的版本号列表。"""
+    conn = None
+    cur = None
+    applied_now = []
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+        cur.execute(SCHEMA_MIGRATIONS_DDL)
+        applied = _applied_versions(cur)
+        if not applied:
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL", (BASELINE_MARKER_TABLE,))
+            if cur.fetchone()[0]:
+                baseline = next(m for m in list_migrations() if m.version == BASELINE_VERSION)
+                cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                            (baseline.version, baseline.name))
+                applied[baseline.version] = None
+                print(f"MIGRATE: 检测到已有数据库，版本 {baseline.version:04d} ({baseline.name}) 记为已应用。")
+        conn.commit()
+
+        for migration in list_migrations():
+            if migration.version in applied:
+                continue
+            if target_version is not None and migration.version > target_version:
+                break
+            print(f"MIGRATE: 正在应用 {migration.version:04d}_{migration.name} ...")
+            try:
+                _run_migration(cur, migration)
+                cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                            (migration.version, migration.name))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                print(f"MIGRATE: 迁移 {migration.version:04d}_{migration.name} 失败，已回滚。")
+                raise
+            applied_now.append(migration.version)
+        if not applied_now:
+            print("MIGRATE: 数据库结构已是最新版本。")
+        return applied_now
+    finally:
+        if cur:
+            try:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+                conn.commit()
+            except psycopg2.Error:
+                pass
+            cur.close()
+        if conn: conn.close()
+
+
+def migration_status(get_connection_func):
+    """返回 [(版本号, 名称, 应用时间或 None)]，未建 schema_migrations 表时全部视为未应用。"""
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+        applied = _applied_versions(cur) if cur.fetchone()[0] else {}
+        return [(m.version, m.name, applied.get(m.version)) for m in list_migrations()]
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="数据库结构迁移")
+    parser.add_argument('--status', action='store_true', help="只显示迁移状态")
+    parser.add_argument('--target', type=int, default=None, help="只迁移到指定版本")
+    args = parser.parse_args()
+
+    from app import get_db_connection
+    if args.status:
+        for version, name, applied_at in migration_status(get_db_connection):
+            print(f"{version:04d}  {name:<40} {applied_at or '未应用'}")
+    else:
+        apply_migrations(get_db_connection, args.target)
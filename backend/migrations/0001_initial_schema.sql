@@ -0,0 +1,116 @@
+-- 0001: 初始表结构 (与最初版本 创建数据库.py 中的建表语句相同)。
+-- 在迁移工具之前用 创建数据库.py 建好的数据库会直接把本版本记为已应用。
+
+CREATE TABLE semesters (
+    id INT PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    start_date DATE NOT NULL,
+    end_date DATE NOT NULL
+);
+
+CREATE TABLE majors (
+    id INT PRIMARY KEY,
+    name VARCHAR(255) NOT NULL UNIQUE
+);
+
+CREATE TABLE courses (
+    id SERIAL PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    total_sessions INT NOT NULL CHECK (total_sessions >= 0),
+    course_type VARCHAR(50) DEFAULT '理论课'
+);
+
+CREATE TABLE users (
+    id SERIAL PRIMARY KEY,
+    username VARCHAR(255) NOT NULL UNIQUE,
+    password VARCHAR(255) NOT NULL, -- WARNING: Plain text password! Use hashing in production.
+    role VARCHAR(50) NOT NULL
+);
+
+CREATE TABLE teachers (
+    id SERIAL PRIMARY KEY,
+    user_id INT NOT NULL UNIQUE REFERENCES users(id) ON DELETE CASCADE -- Link to the user account
+);
+
+-- Junction table for M:N relationship between teachers and the courses they can teach
+CREATE TABLE teacher_course_permissions (
+    teacher_id INT NOT NULL REFERENCES teachers(id) ON DELETE CASCADE,
+    course_id INT NOT NULL REFERENCES courses(id) ON DELETE CASCADE,
+    PRIMARY KEY (teacher_id, course_id) -- Ensure unique pairings
+);
+
+CREATE TABLE classrooms (
+    id INT PRIMARY KEY,
+    building VARCHAR(100) NOT NULL,
+    room_number VARCHAR(50) NOT NULL,
+    capacity INT DEFAULT 0 CHECK (capacity >= 0),
+    room_type VARCHAR(50) DEFAULT '普通教室',
+    UNIQUE (building, room_number) -- Optional: Ensure building/room combo is unique
+);
+
+CREATE TABLE time_slots (
+    id INT PRIMARY KEY,
+    day_of_week VARCHAR(10) NOT NULL, -- e.g., '周一', '周二'
+    period INT NOT NULL, -- e.g., 1, 2, 3, 4
+    start_time TIME NOT NULL,
+    end_time TIME NOT NULL,
+    UNIQUE (day_of_week, period) -- Ensure unique day/period combo
+);
+
+-- Use SERIAL for automatic ID generation if preferred, otherwise manage IDs manually
+-- CREATE SEQUENCE course_assignments_id_seq; -- Or use SERIAL directly
+CREATE TABLE course_assignments (
+    id SERIAL PRIMARY KEY, -- Or: id SERIAL PRIMARY KEY
+    major_id INT NOT NULL REFERENCES majors(id),
+    course_id INT NOT NULL REFERENCES courses(id),
+    teacher_id INT NOT NULL REFERENCES teachers(id),
+    semester_id INT NOT NULL REFERENCES semesters(id),
+    is_core_course BOOLEAN DEFAULT FALSE,
+    expected_students INT DEFAULT 0 CHECK (expected_students >= 0)
+    -- Optional: UNIQUE constraint if a specific combo shouldn't be duplicated
+    -- UNIQUE (major_id, course_id, teacher_id, semester_id)
+);
+
+-- Table to store the final schedule results (optional, if you want to save results to DB)
+CREATE TABLE timetable_entries (
+    id SERIAL PRIMARY KEY, -- Auto-incrementing ID
+    semester_id INT NOT NULL REFERENCES semesters(id),
+    major_id INT NOT NULL REFERENCES majors(id),
+    course_id INT NOT NULL REFERENCES courses(id),
+    teacher_id INT NOT NULL REFERENCES teachers(id),
+    classroom_id INT NOT NULL REFERENCES classrooms(id),
+    timeslot_id INT NOT NULL REFERENCES time_slots(id),
+    week_number INT NOT NULL CHECK (week_number > 0),
+    assignment_id INT NOT NULL REFERENCES course_assignments(id) ON DELETE CASCADE -- Link back to the assignment
+);
+create TABLE students
+(
+	id SERIAL PRIMARY KEY,
+	user_id INT NOT NULL	REFERENCES users(id) ON DELETE CASCADE,
+	major_id INT NOT NULL REFERENCES majors(id),
+	student_id_number VARCHAR(100) UNIQUE
+);
+create TABLE teacher_scheduling_preferences
+(
+	id SERIAL PRIMARY KEY,
+	teacher_id INT NOT NULL REFERENCES teachers(id) ON DELETE CASCADE,
+	semester_id INT NOT NULL REFERENCES semesters(id) ON DELETE CASCADE,
+	timeslot_id INT NOT NULL REFERENCES time_slots(id) ON DELETE CASCADE,
+	preference_type VARCHAR(50) NOT NULL,
+	reason TEXT,
+	status VARCHAR(50) DEFAULT 'pending'::character varying,
+	created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+	updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+	constraint teacher_scheduling_preference_teacher_id_semester_id_timesl_key
+		unique (teacher_id, semester_id, timeslot_id, preference_type)
+);
+
+-- Add indexes for performance on foreign keys and frequently queried columns
+CREATE INDEX idx_course_assignments_major ON course_assignments (major_id);
+CREATE INDEX idx_course_assignments_course ON course_assignments (course_id);
+CREATE INDEX idx_course_assignments_teacher ON course_assignments (teacher_id);
+CREATE INDEX idx_course_assignments_semester ON course_assignments (semester_id);
+CREATE INDEX idx_timetable_entries_week ON timetable_entries (week_number);
+CREATE INDEX idx_timetable_entries_timeslot ON timetable_entries (timeslot_id);
+CREATE INDEX idx_timetable_entries_classroom ON timetable_entries (classroom_id);
+CREATE INDEX idx_teacher_course_permissions_course ON teacher_course_permissions (course_id);
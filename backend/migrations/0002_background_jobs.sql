@@ -0,0 +1,17 @@
+-- 0002: 后台任务队列表 (排课等任务)，工作者通过 SELECT ... FOR UPDATE SKIP LOCKED 领取任务。
+CREATE TABLE IF NOT EXISTS background_jobs (
+    id SERIAL PRIMARY KEY,
+    job_type VARCHAR(50) NOT NULL,                    -- 例如 'schedule'
+    params JSONB NOT NULL DEFAULT '{}'::jsonb,        -- 任务参数
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',     -- queued / running / succeeded / failed / cancelled
+    progress JSONB NOT NULL DEFAULT '{}'::jsonb,      -- 最近一次上报的进度
+    result JSONB,                                     -- 任务完成后的结果摘要
+    error TEXT,
+    cancel_requested BOOLEAN NOT NULL DEFAULT FALSE,
+    worker_id VARCHAR(255),
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP WITH TIME ZONE,
+    finished_at TIMESTAMP WITH TIME ZONE,
+    heartbeat_at TIMESTAMP WITH TIME ZONE
+);
+CREATE INDEX IF NOT EXISTS idx_background_jobs_queued ON background_jobs (created_at, id) WHERE status = 'queued';
@@ -0,0 +1,108 @@
+# 0003: 课表存储改为“放置 + 周次集合”(timetable_placements)，两张课表表按 semester_id 做 LIST 分区，
+# 并创建按周展开的视图 timetable_entries_expanded 与按周查询函数 timetable_entries_for_week()。
+# 旧的非分区表会在本事务中转换：数据先暂存到临时表，删表重建为分区表后再写回，ID 序列保留。
+
+TIMETABLE_TABLES = ('timetable_entries', 'timetable_placements')
+
+STORAGE_DDL = """
+CREATE SEQUENCE IF NOT EXISTS timetable_entries_id_seq;
+CREATE TABLE IF NOT EXISTS timetable_entries (
+    id INT NOT NULL DEFAULT nextval('timetable_entries_id_seq'),
+    semester_id INT NOT NULL REFERENCES semesters(id),
+    major_id INT NOT NULL REFERENCES majors(id),
+    course_id INT NOT NULL REFERENCES courses(id),
+    teacher_id INT NOT NULL REFERENCES teachers(id),
+    classroom_id INT NOT NULL REFERENCES classrooms(id),
+    timeslot_id INT NOT NULL REFERENCES time_slots(id),
+    week_number INT NOT NULL CHECK (week_number > 0),
+    assignment_id INT NOT NULL REFERENCES course_assignments(id) ON DELETE CASCADE,
+    PRIMARY KEY (id, semester_id)
+) PARTITION BY LIST (semester_id);
+ALTER SEQUENCE timetable_entries_id_seq OWNED BY timetable_entries.id;
+CREATE INDEX IF NOT EXISTS idx_timetable_entries_semester_week ON timetable_entries (semester_id, week_number);
+
+CREATE SEQUENCE IF NOT EXISTS timetable_placements_id_seq;
+CREATE TABLE IF NOT EXISTS timetable_placements (
+    id INT NOT NULL DEFAULT nextval('timetable_placements_id_seq'),
+    semester_id INT NOT NULL REFERENCES semesters(id),
+    major_id INT NOT NULL REFERENCES majors(id),
+    course_id INT NOT NULL REFERENCES courses(id),
+    teacher_id INT NOT NULL REFERENCES teachers(id),
+    classroom_id INT NOT NULL REFERENCES classrooms(id),
+    timeslot_id INT NOT NULL REFERENCES time_slots(id),
+    weeks INT[] NOT NULL CHECK (cardinality(weeks) > 0),
+    assignment_id INT NOT NULL REFERENCES course_assignments(id) ON DELETE CASCADE,
+    PRIMARY KEY (id, semester_id)
+) PARTITION BY LIST (semester_id);
+ALTER SEQUENCE timetable_placements_id_seq OWNED BY timetable_placements.id;
+CREATE INDEX IF NOT EXISTS idx_timetable_placements_semester ON timetable_placements (semester_id, timeslot_id);
+CREATE INDEX IF NOT EXISTS idx_timetable_placements_weeks ON timetable_placements USING GIN (weeks);
+
+CREATE OR REPLACE VIEW timetable_entries_expanded AS
+SELECT te.id, NULL::INT AS placement_id, 'e' || te.id AS entry_key,
+       te.semester_id, te.major_id, te.course_id, te.teacher_id, te.classroom_id, te.timeslot_id,
+       te.week_number, te.assignment_id
+FROM timetable_entries te
+UNION ALL
+SELECT NULL::INT, p.id, 'p' || p.id || '-' || w.week_number,
+       p.semester_id, p.major_id, p.course_id, p.teacher_id, p.classroom_id, p.timeslot_id,
+       w.week_number, p.assignment_id
+FROM timetable_placements p CROSS JOIN LATERAL unnest(p.weeks) AS w(week_number);
+
+CREATE OR REPLACE FUNCTION timetable_entries_for_week(p_semester_id INT, p_week INT)
+RETURNS SETOF timetable_entries_expanded LANGUAGE sql STABLE AS $$
+    SELECT te.id, NULL::INT, 'e' || te.id, te.semester_id, te.major_id, te.course_id, te.teacher_id,
+           te.classroom_id, te.timeslot_id, te.week_number, te.assignment_id
+    FROM timetable_entries te
+    WHERE te.semester_id = p_semester_id AND te.week_number = p_week
+    UNION ALL
+    SELECT NULL::INT, p.id, 'p' || p.id || '-' || p_week, p.semester_id, p.major_id, p.course_id, p.teacher_id,
+           p.classroom_id, p.timeslot_id, p_week, p.assignment_id
+    FROM timetable_placements p
+    WHERE p.semester_id = p_semester_id AND p.weeks @> ARRAY[p_week]
+$$;
+"""
+
+
+def _relation_exists(cur, name):
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+    return cur.fetchone()[0]
+
+
+def _is_partitioned(cur, table):
+    cur.execute("""
+        SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid
+        WHERE c.oid = to_regclass(%s)
+    """, (table,))
+    return cur.fetchone() is not None
+
+
+def upgrade(cur):
+    stashed = []
+    for table in TIMETABLE_TABLES:
+        if not _relation_exists(cur, table) or _is_partitioned(cur, table):
+            continue
+        cur.execute(f"CREATE TEMP TABLE {table}_migration ON COMMIT DROP AS SELECT * FROM {table}")
+        cur.execute("SELECT pg_get_serial_sequence(%s, 'id')", (table,))
+        sequence = cur.fetchone()[0]
+        if sequence:
+            cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY NONE")
+            if sequence.split('.')[-1] != f"{table}_id_seq":
+                cur.execute(f"ALTER SEQUENCE {sequence} RENAME TO {table}_id_seq")
+        cur.execute(f"DROP TABLE {table} CASCADE")  # 依赖它的视图/函数随后由 STORAGE_DDL 重建
+        stashed.append(table)
+
+    cur.execute(STORAGE_DDL)
+    cur.execute("SELECT id FROM semesters ORDER BY id")
+    for (semester_id,) in cur.fetchall():
+        for table in TIMETABLE_TABLES:
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {table}_s{int(semester_id)} "
+                        f"PARTITION OF {table} FOR VALUES IN ({int(semester_id)})")
+
+    for table in stashed:
+        cur.execute("SELECT column_name FROM information_schema.columns "
+                    "WHERE table_name = %s AND table_schema = current_schema() ORDER BY ordinal_position", (table,))
+        columns = ', '.join(row[0] for row in cur.fetchall())
+        cur.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {table}_migration")
+        print(f"MIGRATE: {table} 已转换为按学期分区的表，迁移 {cur.rowcount} 行。")
+        cur.execute(f"SELECT setval('{table}_id_seq', COALESCE((SELECT max(id) FROM {table}), 0) + 1, false)")
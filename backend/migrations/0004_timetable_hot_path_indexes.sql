@@ -0,0 +1,33 @@
+-- 0004: 与热点查询访问路径一致的复合索引。
+-- 冲突检查按 (教师|教室|专业, 学期, 周次, 时间段) 查找占用，按周课表按 (专业|教师, 学期, 周次) 过滤。
+-- 单周条目以 week_number 为键；放置以周次集合保存，键为 (…, 学期, 时间段)，weeks 放在 INCLUDE 中，
+-- weeks @> ARRAY[周次] 可以直接在索引元组上判断。INCLUDE 中包含查询用到的其余列，以便走 Index Only Scan。
+-- 索引建在分区父表上，会自动建到每个学期分区。
+
+CREATE INDEX IF NOT EXISTS idx_timetable_entries_teacher_slot
+    ON timetable_entries (teacher_id, semester_id, week_number, timeslot_id)
+    INCLUDE (id, major_id, course_id, classroom_id, assignment_id);
+CREATE INDEX IF NOT EXISTS idx_timetable_entries_classroom_slot
+    ON timetable_entries (classroom_id, semester_id, week_number, timeslot_id)
+    INCLUDE (id, major_id, course_id, teacher_id, assignment_id);
+CREATE INDEX IF NOT EXISTS idx_timetable_entries_major_slot
+    ON timetable_entries (major_id, semester_id, week_number, timeslot_id)
+    INCLUDE (id, course_id, teacher_id, classroom_id, assignment_id);
+
+CREATE INDEX IF NOT EXISTS idx_timetable_placements_teacher_slot
+    ON timetable_placements (teacher_id, semester_id, timeslot_id)
+    INCLUDE (weeks, id, major_id, course_id, classroom_id, assignment_id);
+CREATE INDEX IF NOT EXISTS idx_timetable_placements_classroom_slot
+    ON timetable_placements (classroom_id, semester_id, timeslot_id)
+    INCLUDE (weeks, id, major_id, course_id, teacher_id, assignment_id);
+CREATE INDEX IF NOT EXISTS idx_timetable_placements_major_slot
+    ON timetable_placements (major_id, semester_id, timeslot_id)
+    INCLUDE (weeks, id, course_id, teacher_id, classroom_id, assignment_id);
+
+-- 被上面的复合索引覆盖的单列索引 (0001)
+DROP INDEX IF EXISTS idx_timetable_entries_week;
+DROP INDEX IF EXISTS idx_timetable_entries_timeslot;
+DROP INDEX IF EXISTS idx_timetable_entries_classroom;
+
+-- 按 user_id 查询学生所在专业 (学生课表的第一步)
+CREATE INDEX IF NOT EXISTS idx_students_user ON students (user_id);
@@ -0,0 +1,34 @@
+# 0005: 由数据库保证单周条目不冲突：同一学期、同一周、同一时间段内，教师/教室/专业各自只能出现一次。
+# 唯一约束取代 0004 中单周条目的三个同列复合索引 (INCLUDE 列保持不变，仍可走 Index Only Scan)。
+# 已有数据中存在冲突时迁移失败并列出冲突，需要先手动调整课表。
+
+CONFLICT_CONSTRAINTS = (
+    ('timetable_entries_teacher_slot_key', 'teacher_id', 'idx_timetable_entries_teacher_slot',
+     'id, major_id, course_id, classroom_id, assignment_id'),
+    ('timetable_entries_classroom_slot_key', 'classroom_id', 'idx_timetable_entries_classroom_slot',
+     'id, major_id, course_id, teacher_id, assignment_id'),
+    ('timetable_entries_major_slot_key', 'major_id', 'idx_timetable_entries_major_slot',
+     'id, course_id, teacher_id, classroom_id, assignment_id'),
+)
+
+
+def upgrade(cur):
+    conflicts = []
+    for _, column, _, _ in CONFLICT_CONSTRAINTS:
+        cur.execute(f"""
+            SELECT {column}, semester_id, week_number, timeslot_id, count(*)
+            FROM timetable_entries
+            GROUP BY {column}, semester_id, week_number, timeslot_id
+            HAVING count(*) > 1
+            LIMIT 10
+        """)
+        conflicts += [f"{column}={row[0]} 学期={row[1]} 第{row[2]}周 时间段={row[3]} ({row[4]} 条)" for row in cur.fetchall()]
+    if conflicts:
+        raise RuntimeError("timetable_entries 中存在冲突的课表条目，请先调整后再迁移:\n  " + "\n  ".join(conflicts))
+
+    for name, column, replaced_index, include in CONFLICT_CONSTRAINTS:
+        cur.execute(f"DROP INDEX IF EXISTS {replaced_index}")
+        cur.execute(f"""
+            ALTER TABLE timetable_entries ADD CONSTRAINT {name}
+            UNIQUE ({column}, semester_id, week_number, timeslot_id) INCLUDE ({include})
+        """)
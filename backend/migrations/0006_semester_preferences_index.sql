@@ -0,0 +1,4 @@
+-- 0006: 按学期加载排课数据时，'避免'偏好按 (学期, 偏好类型) 查找；
+-- 原有唯一约束以 teacher_id 开头，无法用于这一过滤条件。
+CREATE INDEX IF NOT EXISTS idx_teacher_preferences_semester_type
+    ON teacher_scheduling_preferences (semester_id, preference_type);
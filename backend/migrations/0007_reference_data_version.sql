@@ -0,0 +1,31 @@
+-- 0007: 基础数据版本号。对学期、专业、课程、教室、时间段、用户、教师、教学任务和教师偏好的任何写入
+-- (语句级触发器，包括 TRUNCATE) 都会把版本号加一，并在提交时通过 NOTIFY reference_data_changed 通知各进程，
+-- 各进程据此使缓存的 all_data 失效 (见 reference_cache.py)。
+-- 课表表 (timetable_*) 不在其中：排课写入量大，且课表行引用的专业/课程/教师都来自教学任务。
+CREATE TABLE IF NOT EXISTS reference_data_version (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    version BIGINT NOT NULL DEFAULT 1
+);
+INSERT INTO reference_data_version (id) VALUES (TRUE) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_reference_data_version() RETURNS trigger AS $$
+DECLARE
+    new_version BIGINT;
+BEGIN
+    UPDATE reference_data_version SET version = version + 1 RETURNING version INTO new_version;
+    PERFORM pg_notify('reference_data_changed', new_version::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    table_name TEXT;
+BEGIN
+    FOREACH table_name IN ARRAY ARRAY['semesters', 'majors', 'courses', 'classrooms', 'time_slots', 'users',
+                                      'teachers', 'course_assignments', 'teacher_scheduling_preferences'] LOOP
+        EXECUTE format('CREATE TRIGGER %I AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON %I '
+                       'FOR EACH STATEMENT EXECUTE FUNCTION bump_reference_data_version()',
+                       table_name || '_bump_reference_version', table_name);
+    END LOOP;
+END $$;
@@ -0,0 +1,12 @@
+# 0008: 课程名称唯一。课程计划导入按名称整批 INSERT ... ON CONFLICT (name) 新建或更新课程，需要该唯一约束。
+# 已有数据中存在同名课程时迁移失败并列出重复的名称，需要先手动合并。
+
+
+def upgrade(cur):
+    cur.execute("""
+        SELECT name, count(*) FROM courses GROUP BY name HAVING count(*) > 1 ORDER BY name LIMIT 10
+    """)
+    duplicates = [f"'{row[0]}' ({row[1]} 门)" for row in cur.fetchall()]
+    if duplicates:
+        raise RuntimeError("courses 中存在同名课程，请先合并后再迁移:\n  " + "\n  ".join(duplicates))
+    cur.execute("ALTER TABLE courses ADD CONSTRAINT courses_name_key UNIQUE (name)")
@@ -0,0 +1,16 @@
+-- 0009: 课程计划导入改为后台任务。
+-- 上传的文件按块保存在 import_upload_parts 中 (与任务在同一事务中写入)，任何主机上的工作者都能读取；任务结束后删除。
+-- 校验错误逐块写入 import_job_errors，任务运行期间即可分页查询。
+CREATE TABLE IF NOT EXISTS import_upload_parts (
+    job_id INT NOT NULL REFERENCES background_jobs(id) ON DELETE CASCADE,
+    part_number INT NOT NULL,
+    data BYTEA NOT NULL,
+    PRIMARY KEY (job_id, part_number)
+);
+
+CREATE TABLE IF NOT EXISTS import_job_errors (
+    job_id INT NOT NULL REFERENCES background_jobs(id) ON DELETE CASCADE,
+    row_number INT NOT NULL,                          -- Excel 行号 (表头为第 1 行)
+    message TEXT NOT NULL,
+    PRIMARY KEY (job_id, row_number)
+);
@@ -0,0 +1,37 @@
+-- 0010: 每个学期的课表版本号，用作导出文件缓存的键 (见 export_cache.py)。
+-- 对 timetable_placements / timetable_entries 的 INSERT (含 COPY)、UPDATE、DELETE 由语句级触发器按受影响的学期加一：
+-- 触发器建在分区父表上，转换表 (transition table) 中包含所有被修改分区的行。
+-- 直接作用于分区的操作不会触发父表的语句级触发器：清空学期课表 (scheduler_module.clear_db_for_semester)
+-- 时对分区的 TRUNCATE 由 bump_timetable_version 在同一事务中显式加一；删除教学任务级联删除的课表行
+-- 由 course_assignments 上的基础数据版本号 (0007) 覆盖，导出缓存的键同时包含两个版本号。
+CREATE TABLE IF NOT EXISTS timetable_versions (
+    semester_id INT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 1
+);
+
+CREATE OR REPLACE FUNCTION bump_timetable_versions() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO timetable_versions (semester_id)
+    SELECT DISTINCT semester_id FROM changed_rows
+    ON CONFLICT (semester_id) DO UPDATE SET version = timetable_versions.version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    table_name TEXT;
+BEGIN
+    -- 带转换表的触发器只能对应一种事件，因此每张表建三个
+    FOREACH table_name IN ARRAY ARRAY['timetable_placements', 'timetable_entries'] LOOP
+        EXECUTE format('CREATE TRIGGER %I AFTER INSERT ON %I REFERENCING NEW TABLE AS changed_rows '
+                       'FOR EACH STATEMENT EXECUTE FUNCTION bump_timetable_versions()',
+                       table_name || '_bump_version_insert', table_name);
+        EXECUTE format('CREATE TRIGGER %I AFTER UPDATE ON %I REFERENCING OLD TABLE AS changed_rows '
+                       'FOR EACH STATEMENT EXECUTE FUNCTION bump_timetable_versions()',
+                       table_name || '_bump_version_update', table_name);
+        EXECUTE format('CREATE TRIGGER %I AFTER DELETE ON %I REFERENCING OLD TABLE AS changed_rows '
+                       'FOR EACH STATEMENT EXECUTE FUNCTION bump_timetable_versions()',
+                       table_name || '_bump_version_delete', table_name);
+    END LOOP;
+END $$;
@@ -0,0 +1,13 @@
+-- 0011: 教师偏好的 status 不影响缓存的基础数据 (按学期加载'避免'偏好时不按状态过滤)。
+-- 每次排课结束都会把该学期的偏好标记为 applied；0007 的语句级触发器对任何 UPDATE 都会递增基础数据版本号，
+-- 使所有学期的基础数据缓存和导出缓存失效。UPDATE 触发器改为只在更新了 status 以外的业务列时触发
+-- (语句级触发器的 UPDATE OF 按 SET 中出现的列判断)。
+DROP TRIGGER IF EXISTS teacher_scheduling_preferences_bump_reference_version ON teacher_scheduling_preferences;
+
+CREATE TRIGGER teacher_scheduling_preferences_bump_reference_version
+    AFTER INSERT OR DELETE OR TRUNCATE ON teacher_scheduling_preferences
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_reference_data_version();
+
+CREATE TRIGGER teacher_scheduling_preferences_bump_reference_version_update
+    AFTER UPDATE OF teacher_id, semester_id, timeslot_id, preference_type, reason ON teacher_scheduling_preferences
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_reference_data_version();
@@ -0,0 +1,19 @@
+-- 0012: 基础数据版本号改为序列。0007 的触发器每条语句都 UPDATE 同一行，行锁持有到提交：
+-- 课程计划导入这样的长事务运行期间，其它所有基础数据写入 (另一个学期的导入、教师提交偏好等) 都要等它结束。
+-- nextval 不受事务约束、不加行锁；触发器改为取下一个序列值并 NOTIFY (通知仍在提交时送达)。
+-- 序列值在语句执行时就可见，数据要到提交后才可见，因此写入方同时持有共享 advisory lock 到事务结束：
+-- 读取方先读序列、再尝试获取同一个锁并立即释放，获取失败说明有未提交的写入，这时读到的数据不能按该版本号缓存
+-- (见 reference_cache.read_version)。共享锁之间互不等待，读取方只尝试不等待，写入之间、写入与读取之间都不会阻塞。
+CREATE SEQUENCE IF NOT EXISTS reference_data_version_seq;
+-- 从旧版本号之后开始，升级前缓存的内容全部失效
+SELECT setval('reference_data_version_seq', (SELECT version FROM reference_data_version) + 1);
+
+CREATE OR REPLACE FUNCTION bump_reference_data_version() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock_shared(7302402);  -- reference_cache.WRITE_LOCK_KEY
+    PERFORM pg_notify('reference_data_changed', nextval('reference_data_version_seq')::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TABLE reference_data_version;
@@ -0,0 +1,118 @@
+# 0013: 由数据库保证放置 (周次集合) 不冲突。0005 的唯一约束只覆盖单周条目之间；放置的 weeks 是数组，
+# 唯一约束无法表达“周次有交集”，exclusion constraint (btree_gist + intarray) 在分区表上要求较新的 PostgreSQL，
+# 且不能跨两张表。这里改为按周展开的占用表 timetable_occupancy：放置的每一周、每个单周条目各一行，
+# 教师/教室/专业各一个唯一约束 (与 0005 相同)，放置之间、放置与单周条目之间的冲突都由约束拒绝。
+# 并发写入同一占用时后写入的事务在唯一索引上等待，前者提交后报 UniqueViolation，READ COMMITTED 下同样成立。
+# 占用行由课表两张表上的触发器维护：INSERT (含 COPY) 用语句级触发器和转换表整批写入；UPDATE/DELETE 用行级触发器，
+# 删除教学任务时级联删除的课表行 (直接作用于分区，不触发父表的语句级触发器) 也会同步。
+# 占用表同样按学期分区 (scheduler_module.ensure_semester_partitions 一并创建)，清空学期时与课表分区一起 TRUNCATE。
+# 已有数据中存在冲突时迁移失败并列出冲突，需要先手动调整课表。
+
+OCCUPANCY_DDL = """
+CREATE TABLE timetable_occupancy (
+    semester_id INT NOT NULL,
+    week_number INT NOT NULL,
+    timeslot_id INT NOT NULL,
+    teacher_id INT NOT NULL,
+    classroom_id INT NOT NULL,
+    major_id INT NOT NULL,
+    placement_id INT,
+    entry_id INT,
+    CHECK ((placement_id IS NULL) <> (entry_id IS NULL)),
+    CONSTRAINT timetable_occupancy_teacher_slot_key UNIQUE (teacher_id, semester_id, week_number, timeslot_id),
+    CONSTRAINT timetable_occupancy_classroom_slot_key UNIQUE (classroom_id, semester_id, week_number, timeslot_id),
+    CONSTRAINT timetable_occupancy_major_slot_key UNIQUE (major_id, semester_id, week_number, timeslot_id)
+) PARTITION BY LIST (semester_id);
+CREATE INDEX idx_timetable_occupancy_placement ON timetable_occupancy (semester_id, placement_id);
+CREATE INDEX idx_timetable_occupancy_entry ON timetable_occupancy (semester_id, entry_id);
+"""
+
+# 放置按周展开为占用行 (列顺序与 timetable_occupancy 相同)
+OCCUPANCY_ROWS = """SELECT p.semester_id, w.week_number, p.timeslot_id, p.teacher_id, p.classroom_id, p.major_id, p.id, NULL::INT
+    FROM {placements} p CROSS JOIN LATERAL (SELECT DISTINCT unnest(p.weeks) AS week_number) w"""
+
+TRIGGER_DDL = """
+CREATE OR REPLACE FUNCTION insert_placement_occupancy() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO timetable_occupancy
+        (semester_id, week_number, timeslot_id, teacher_id, classroom_id, major_id, placement_id, entry_id)
+    """ + OCCUPANCY_ROWS.format(placements='new_rows') + """;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION insert_entry_occupancy() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO timetable_occupancy
+        (semester_id, week_number, timeslot_id, teacher_id, classroom_id, major_id, placement_id, entry_id)
+    SELECT semester_id, week_number, timeslot_id, teacher_id, classroom_id, major_id, NULL, id FROM new_rows;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION sync_placement_occupancy() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM timetable_occupancy WHERE semester_id = OLD.semester_id AND placement_id = OLD.id;
+    IF TG_OP = 'UPDATE' THEN
+        INSERT INTO timetable_occupancy
+            (semester_id, week_number, timeslot_id, teacher_id, classroom_id, major_id, placement_id)
+        SELECT DISTINCT NEW.semester_id, w, NEW.timeslot_id, NEW.teacher_id, NEW.classroom_id, NEW.major_id, NEW.id
+        FROM unnest(NEW.weeks) AS w;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION sync_entry_occupancy() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM timetable_occupancy WHERE semester_id = OLD.semester_id AND entry_id = OLD.id;
+    IF TG_OP = 'UPDATE' THEN
+        INSERT INTO timetable_occupancy
+            (semester_id, week_number, timeslot_id, teacher_id, classroom_id, major_id, entry_id)
+        VALUES (NEW.semester_id, NEW.week_number, NEW.timeslot_id, NEW.teacher_id, NEW.classroom_id, NEW.major_id, NEW.id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER timetable_placements_occupancy_insert AFTER INSERT ON timetable_placements
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION insert_placement_occupancy();
+CREATE TRIGGER timetable_placements_occupancy_sync AFTER UPDATE OR DELETE ON timetable_placements
+    FOR EACH ROW EXECUTE FUNCTION sync_placement_occupancy();
+CREATE TRIGGER timetable_entries_occupancy_insert AFTER INSERT ON timetable_entries
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION insert_entry_occupancy();
+CREATE TRIGGER timetable_entries_occupancy_sync AFTER UPDATE OR DELETE ON timetable_entries
+    FOR EACH ROW EXECUTE FUNCTION sync_entry_occupancy();
+"""
+
+CONFLICT_COLUMNS = ('teacher_id', 'classroom_id', 'major_id')
+
+
+def upgrade(cur):
+    conflicts = []
+    for column in CONFLICT_COLUMNS:
+        cur.execute(f"""
+            SELECT {column}, semester_id, week_number, timeslot_id, count(*)
+            FROM timetable_entries_expanded
+            GROUP BY {column}, semester_id, week_number, timeslot_id
+            HAVING count(*) > 1
+            LIMIT 10
+        """)
+        conflicts += [f"{column}={row[0]} 学期={row[1]} 第{row[2]}周 时间段={row[3]} ({row[4]} 条)" for row in cur.fetchall()]
+    if conflicts:
+        raise RuntimeError("课表中存在冲突的安排，请先调整后再迁移:\n  " + "\n  ".join(conflicts))
+
+    cur.execute(OCCUPANCY_DDL)
+    # 已有课表分区的学期都建立占用表分区 (其余学期在第一次写入课表时由 ensure_semester_partitions 创建)
+    cur.execute("SELECT id FROM semesters ORDER BY id")
+    for (semester_id,) in cur.fetchall():
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (f"timetable_placements_s{int(semester_id)}",))
+        if cur.fetchone()[0]:
+            cur.execute(f"CREATE TABLE timetable_occupancy_s{int(semester_id)} "
+                        f"PARTITION OF timetable_occupancy FOR VALUES IN ({int(semester_id)})")
+    cur.execute("INSERT INTO timetable_occupancy " + OCCUPANCY_ROWS.format(placements='timetable_placements'))
+    cur.execute("""
+        INSERT INTO timetable_occupancy
+        SELECT semester_id, week_number, timeslot_id, teacher_id, classroom_id, major_id, NULL, id FROM timetable_entries
+    """)
+    cur.execute(TRIGGER_DDL)
@@ -0,0 +1,158 @@
+# reference_cache.py
+# -*- coding: utf-8 -*-
+# 进程内的 all_data (scheduler_module.load_semester_data_from_db 的结果) 缓存，按学期保存。
+# 缓存项带有加载时的基础数据版本号 (reference_data_version_seq 序列，见 migrations/0007、0012)。
+# 版本号由数据库触发器在基础数据写入时递增，并在提交时通过 NOTIFY reference_data_changed 通知：
+#   - 启动了监听线程 (start_listener) 的进程收到通知后读取一次版本号，命中缓存时不访问数据库；
+#   - 没有监听线程或监听连接断开时，每次取用前读取一次版本号。
+# 有未提交的基础数据写入时 (read_version 返回未稳定)，读到的数据照常返回但不缓存。
+# 返回的 all_data 在多个请求之间共享，调用方不能修改。
+import collections
+import select
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+import scheduler_module
+
+CHANGE_CHANNEL = 'reference_data_changed'
+MAX_CACHED_SEMESTERS = 8
+LISTEN_POLL_INTERVAL = 5.0  # 秒；监听线程检查停止信号的间隔
+LISTEN_RECONNECT_DELAY = 5.0  # 秒；监听连接断开后重连前的等待时间
+WRITE_LOCK_KEY = 7302402  # 基础数据写入方持有到事务结束的共享 advisory lock 的键 (migrations/0012)
+
+_lock = threading.Lock()
+_entries = collections.OrderedDict()  # semester_id -> (版本号, all_data)，按最近使用排序
+_pushed_version = None  # 监听线程读到的已稳定版本号；None 表示当前没有可用的监听或有未提交的写入
+_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+
+def read_version(cur):
+    """
+    返回 (版本号, 是否已稳定)。先读序列再尝试获取写入锁 (获取后立即释放，不等待)：
+    获取成功说明不超过该版本号的写入都已提交，按该版本号缓存之后读到的数据是安全的；
+    获取失败说明有写入尚未提交，它的序列值可能已经计入版本号而数据还不可见。
+    """
+    cur.execute("SELECT last_value FROM reference_data_version_seq")
+    version = cur.fetchone()[0]
+    cur.execute("SELECT CASE WHEN pg_try_advisory_lock(%s) THEN pg_advisory_unlock(%s) ELSE FALSE END",
+                (WRITE_LOCK_KEY, WRITE_LOCK_KEY))
+    return version, cur.fetchone()[0]
+
+
+def _read_version(get_connection_func):
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        return read_version(cur)
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+def _set_pushed_version(version):
+    global _pushed_version
+    with _lock:
+        _pushed_version = version
+        if version is None:
+            return
+        stale = [semester_id for semester_id, (cached_version, _) in _entries.items() if cached_version != version]
+        for semester_id in stale:
+            del _entries[semester_id]
+        _stats['invalidations'] += len(stale)
+
+
+def get_semester_data(semester_id, get_connection_func):
+    """返回该学期的 all_data；基础数据未变化时直接使用缓存。"""
+    with _lock:
+        version = _pushed_version
+    settled = True
+    if version is None:
+        version, settled = _read_version(get_connection_func)
+    with _lock:
+        cached = _entries.get(semester_id)
+        if settled and cached is not None and cached[0] == version:
+            _entries.move_to_end(semester_id)
+            _stats['hits'] += 1
+            return cached[1]
+        _stats['misses'] += 1
+
+    # 先读版本号再加载：加载期间若有写入，缓存项的版本号偏旧，会在下一次通知或版本检查时被丢弃
+    all_data = scheduler_module.load_semester_data_from_db(semester_id, get_connection_func)
+    if not settled:
+        return all_data
+    with _lock:
+        if _pushed_version is None or _pushed_version == version:
+            _entries[semester_id] = (version, all_data)
+            _entries.move_to_end(semester_id)
+            while len(_entries) > MAX_CACHED_SEMESTERS:
+                _entries.popitem(last=False)
+    return all_data
+
+
+def invalidate():
+    with _lock:
+        _stats['invalidations'] += len(_entries)
+        _entries.clear()
+
+
+def stats():
+    with _lock:
+        return dict(_stats, cached_semesters=sorted(_entries), version=_pushed_version,
+                    listening=_pushed_version is not None)
+
+
+def _push_settled_version(cur):
+    """有未提交的写入时不推送版本号 (取用方回到每次读取版本号)，等它提交的通知或下一次定期检查。"""
+    version, settled = read_version(cur)
+    _set_pushed_version(version if settled else None)
+
+
+def _listen(connect_func, stop_event):
+    """
+    监听线程主循环：LISTEN 后先读取当前版本号 (补上连接之前错过的通知)，再等待通知。
+    通知只表示有写入已提交：事务提交的顺序与取得序列值的顺序不一定相同，因此收到通知后重新读取版本号，不使用通知中的值。
+    """
+    while not stop_event.is_set():
+        conn = None
+        try:
+            conn = connect_func()
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cur = conn.cursor()
+            cur.execute(f"LISTEN {CHANGE_CHANNEL}")
+            _push_settled_version(cur)
+            while not stop_event.is_set():
+                if select.select([conn], [], [], LISTEN_POLL_INTERVAL) == ([], [], []):
+                    if _pushed_version is None:  # 回滚的写入不会发通知，定期重新检查
+                        _push_settled_version(cur)
+                    continue
+                conn.poll()
+                changed = any(notify.channel == CHANGE_CHANNEL for notify in conn.notifies)
+                conn.notifies.clear()
+                if changed:
+                    _push_settled_version(cur)
+        except (psycopg2.Error, OSError) as e:
+            print(f"CACHE: 基础数据变更监听中断 ({e})，{LISTEN_RECONNECT_DELAY:.0f} 秒后重连。")
+            _set_pushed_version(None)
+            stop_event.wait(LISTEN_RECONNECT_DELAY)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+    _set_pushed_version(None)
+
+
+def start_listener(connect_func):
+    """
+    启动监听线程，返回用于停止它的 Event。
+    connect_func 应返回独立的新连接 (不要使用连接池)：监听连接会一直占用。
+    """
+    stop_event = threading.Event()
+    threading.Thread(target=_listen, args=(connect_func, stop_event), name="reference-cache-listener",
+                     daemon=True).start()
+    return stop_event
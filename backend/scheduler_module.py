@@ -2,20 +2,31 @@
 # -*- coding: utf-8 -*-
 import psycopg2
 import psycopg2.extras
+import psycopg2.errors
 import datetime
 import math
 import random
+import time
 import copy
-import pandas as pd
-from collections import defaultdict, namedtuple
+import numpy as np
+from collections import defaultdict, namedtuple, Counter
 import re
 import io
+import os
+import bisect
+import multiprocessing
+import struct
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 
 # --- 检查 openpyxl 库 ---
 try:
     import openpyxl
+    from openpyxl.cell import WriteOnlyCell
     from openpyxl.utils import get_column_letter
-    from openpyxl.styles import Alignment, Font, Border, Side
+    from openpyxl.styles import Alignment, Font, Border, Side, NamedStyle
 
     OPENPYXL_AVAILABLE = True
 except ImportError:
@@ -39,114 +50,105 @@ TimetableEntry = namedtuple('TimetableEntry',
                              'week_number', 'assignment_id'])
 TeacherPreference = namedtuple('TeacherPreference', ['id', 'teacher_id', 'semester_id', 'timeslot_id', 'preference_type', 'status', 'reason'])
 
+class SchedulingCancelled(Exception):
+    """由进度回调抛出，用于中止正在进行的排课 (例如后台任务被取消)。"""
+
 # ==================================
 # 3. 数据加载函数 (保持不变)
 # ==================================
-def load_data_from_db(get_connection_func):
-    """从数据库加载所有基础数据，包括教师偏好"""
-    print("SCHEDULER: 开始从数据库加载数据...")
+def _semester_from_row(row):
+    """学期行 -> Semester，总周数按起止日期向上取整计算。"""
+    start_date = row['start_date']
+    end_date = row['end_date']
+    calculated_weeks = 0
+    if isinstance(start_date, datetime.date) and isinstance(end_date, datetime.date):
+        if end_date >= start_date:
+            delta_days = (end_date - start_date).days + 1
+            calculated_weeks = math.ceil(delta_days / 7)
+    return Semester(id=row['id'], name=row['name'], start_date=start_date,
+                    end_date=end_date, total_weeks=calculated_weeks)
+
+def _classroom_from_row(row):
+    building_name = row['building'] if row['building'] else '未知楼'
+    room_num = row['room_number'] if row['room_number'] else '未知号'
+    return Classroom(id=row['id'], name=f"{building_name}-{room_num}", capacity=row['capacity'], type=row['room_type'])
+
+# 学期内引用到的专业/课程/教师：本学期的教学任务，以及课表中已有的条目 (手动调整后可能与任务不一致)
+SEMESTER_REFS_CTE = """
+    WITH semester_refs AS (
+        SELECT major_id, course_id, teacher_id FROM course_assignments WHERE semester_id = %(semester_id)s
+        UNION SELECT major_id, course_id, teacher_id FROM timetable_placements WHERE semester_id = %(semester_id)s
+        UNION SELECT major_id, course_id, teacher_id FROM timetable_entries WHERE semester_id = %(semester_id)s
+    )
+"""
+
+def load_semester_data_from_db(semester_id, get_connection_func):
+    """
+    只加载一个学期排课/导出所需的数据，返回按 ID 索引的字典 (semesters、course_assignments、majors、courses、
+    teachers、classrooms、timeslots)，以及 timeslot_lookup 与 approved_avoid_preferences：
+    semesters 只含该学期；教学任务与'避免'偏好只取该学期；专业、课程、教师只取该学期引用到的；
+    教室和时间段是全校共用的资源，仍全部加载。学期不存在时 semesters 为空字典。
+    """
+    print(f"SCHEDULER: 开始加载学期 {semester_id} 的数据...")
+    params = {'semester_id': semester_id}
     all_data = {}
     conn = None
-    cur = None # Define cur outside try
+    cur = None
     try:
-        conn = get_connection_func()  # 使用传入的函数获取连接
+        conn = get_connection_func()
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-        # 加载学期 (计算 total_weeks)
-        cur.execute("SELECT id, name, start_date, end_date FROM semesters")
-        raw_semesters = cur.fetchall()
-        all_data['semesters'] = {}
-        # print("  - 正在加载学期信息并计算总周数...")
-        for row in raw_semesters:
-            start_date = row['start_date']
-            end_date = row['end_date']
-            calculated_weeks = 0
-            if isinstance(start_date, datetime.date) and isinstance(end_date, datetime.date):
-                if end_date >= start_date:
-                    delta_days = (end_date - start_date).days + 1
-                    calculated_weeks = math.ceil(delta_days / 7)
-            all_data['semesters'][row['id']] = Semester(
-                id=row['id'], name=row['name'], start_date=start_date,
-                end_date=end_date, total_weeks=calculated_weeks
-            )
-        # print(f"  - 加载并处理了 {len(all_data['semesters'])} 个学期信息")
-
-        # 加载专业
-        cur.execute("SELECT id, name FROM majors")
+        cur.execute("SELECT id, name, start_date, end_date FROM semesters WHERE id = %(semester_id)s", params)
+        all_data['semesters'] = {row['id']: _semester_from_row(row) for row in cur.fetchall()}
+
+        cur.execute("""
+            SELECT id, major_id, course_id, teacher_id, semester_id, is_core_course, expected_students
+            FROM course_assignments WHERE semester_id = %(semester_id)s
+        """, params)
+        all_data['course_assignments'] = {row['id']: CourseAssignment(**row) for row in cur.fetchall()}
+
+        cur.execute(SEMESTER_REFS_CTE + """
+            SELECT id, name FROM majors WHERE id IN (SELECT major_id FROM semester_refs)
+        """, params)
         all_data['majors'] = {row['id']: Major(**row) for row in cur.fetchall()}
-        # print(f"  - 加载了 {len(all_data['majors'])} 个专业信息")
-
-        # 加载教师
-        cur.execute("SELECT id, username FROM users")
-        user_id_to_name = {row['id']: row['username'] for row in cur.fetchall()}
-        cur.execute("SELECT id, user_id FROM teachers")
-        raw_teachers = cur.fetchall()
-        all_data['teachers'] = {}
-        for row in raw_teachers:
-            teacher_id = row['id']
-            user_id = row['user_id']
-            teacher_name = user_id_to_name.get(user_id, f"未知用户(ID:{user_id})")
-            all_data['teachers'][teacher_id] = Teacher(id=teacher_id, user_id=user_id, name=teacher_name)
-        # print(f"  - 加载并处理了 {len(all_data['teachers'])} 个教师信息")
-
-        # 加载教室
-        cur.execute("SELECT id, building, room_number, capacity, room_type FROM classrooms")
-        all_data['classrooms'] = {}
-        for row in cur.fetchall():
-            classroom_id = row['id']
-            building_name = row['building'] if row['building'] else '未知楼'
-            room_num = row['room_number'] if row['room_number'] else '未知号'
-            classroom_name = f"{building_name}-{room_num}"
-            all_data['classrooms'][classroom_id] = Classroom(
-                id=classroom_id, name=classroom_name, capacity=row['capacity'], type=row['room_type']
-            )
-        # print(f"  - 加载了 {len(all_data['classrooms'])} 个教室信息")
-
-        # 加载课程
-        cur.execute("SELECT id, name, total_sessions, course_type FROM courses")
+
+        cur.execute(SEMESTER_REFS_CTE + """
+            SELECT id, name, total_sessions, course_type FROM courses WHERE id IN (SELECT course_id FROM semester_refs)
+        """, params)
         all_data['courses'] = {row['id']: Course(**row) for row in cur.fetchall()}
-        # print(f"  - 加载了 {len(all_data['courses'])} 个课程信息")
 
-        # 加载时间段
+        cur.execute(SEMESTER_REFS_CTE + """
+            SELECT t.id, t.user_id, u.username
+            FROM teachers t LEFT JOIN users u ON u.id = t.user_id
+            WHERE t.id IN (SELECT teacher_id FROM semester_refs)
+        """, params)
+        all_data['teachers'] = {
+            row['id']: Teacher(id=row['id'], user_id=row['user_id'],
+                               name=row['username'] or f"未知用户(ID:{row['user_id']})")
+            for row in cur.fetchall()
+        }
+
+        cur.execute("SELECT id, building, room_number, capacity, room_type FROM classrooms")
+        all_data['classrooms'] = {row['id']: _classroom_from_row(row) for row in cur.fetchall()}
+
         cur.execute("SELECT id, day_of_week, period, start_time, end_time FROM time_slots ORDER BY day_of_week, period")
         all_data['timeslots'] = {row['id']: TimeSlot(**row) for row in cur.fetchall()}
         all_data['timeslot_lookup'] = {(ts.day_of_week, ts.period): ts.id for ts in all_data['timeslots'].values()}
-        # print(f"  - 加载了 {len(all_data['timeslots'])} 个时间段信息")
-
-        # 加载教学任务
-        cur.execute("""
-            SELECT id, major_id, course_id, teacher_id, semester_id, is_core_course, expected_students
-            FROM course_assignments
-        """)
-        all_data['course_assignments'] = {row['id']: CourseAssignment(**row) for row in cur.fetchall()}
-        # print(f"  - 加载了 {len(all_data['course_assignments'])} 个教学任务")
 
-        # --- 新增：加载教师排课偏好 ---
+        # 不按状态过滤：每次排课结束后该学期的偏好都会被标记为 applied
         cur.execute("""
-            SELECT id, teacher_id, semester_id, timeslot_id, preference_type, status, reason
-            FROM teacher_scheduling_preferences
-            WHERE preference_type = 'avoid'
-        """)
-        # Store approved 'avoid' preferences in a set for quick lookup: (teacher_id, timeslot_id, semester_id)
-        all_data['approved_avoid_preferences'] = set()
-        raw_preferences = cur.fetchall()
-        for row in raw_preferences:
-             all_data['approved_avoid_preferences'].add((row['teacher_id'], row['timeslot_id'], row['semester_id']))
-        # print(f"  - 加载并过滤了 {len(raw_preferences)} 条教师偏好记录 (其中 {len(all_data['approved_avoid_preferences'])} 条已批准的'避免'偏好将作为约束)")
-        # --- 新增结束 ---
-
-        cur.close()
-        print("SCHEDULER: 数据加载成功!")
+            SELECT teacher_id, timeslot_id, semester_id FROM teacher_scheduling_preferences
+            WHERE semester_id = %(semester_id)s AND preference_type = 'avoid'
+        """, params)
+        all_data['approved_avoid_preferences'] = {(row['teacher_id'], row['timeslot_id'], row['semester_id'])
+                                                  for row in cur.fetchall()}
+
+        print(f"SCHEDULER: 学期 {semester_id} 数据加载成功 ({len(all_data['course_assignments'])} 个教学任务, "
+              f"{len(all_data['teachers'])} 名教师, {len(all_data['courses'])} 门课程)。")
         return all_data
-
     except psycopg2.Error as e:
         print(f"SCHEDULER: 数据库连接或查询错误: {e}")
-        # import traceback; traceback.print_exc() # For more detailed server-side logs if needed
-        raise  # Re-raise the exception to be caught by the Flask route
-    except Exception as e:
-        print(f"SCHEDULER: 数据加载过程中发生未知错误: {e}")
-        # import traceback; traceback.print_exc()
-        raise # Re-raise
+        raise
     finally:
         if cur: cur.close()
         if conn: conn.close()
@@ -157,6 +159,154 @@ def load_data_from_db(get_connection_func):
 def find_timeslot_id(day_str, period_num, all_data):
     return all_data['timeslot_lookup'].get((day_str, period_num))
 
+# --- 全局占用状态 (教师/教室/专业 × 周次 × 时间段 的布尔数组) ---
+def create_timetable_state(all_data, total_weeks):
+    """
+    创建排课全局占用状态。
+    三个布尔数组分别按 (实体下标, 周次, 时间段下标) 记录教师、教室、专业是否已被占用，
+    周次直接作为下标使用 (第 0 周不使用)，探测和批量查询都不需要再构造元组。
+    """
+    teacher_ids = set(all_data['teachers'].keys())
+    major_ids = set(all_data['majors'].keys())
+    for assign in all_data.get('course_assignments', {}).values():
+        teacher_ids.add(assign.teacher_id)
+        major_ids.add(assign.major_id)
+    classroom_ids = sorted(all_data['classrooms'].keys())
+    timeslot_ids = sorted(all_data['timeslots'].keys())
+    week_dim = max(int(total_weeks or 0), 0) + 1
+
+    # 空闲教室索引的初始形态：按教室类型分桶，桶内按 (容量, 教室ID) 升序
+    room_buckets = defaultdict(list)
+    classroom_room_info = {}
+    for cid in classroom_ids:
+        classroom = all_data['classrooms'][cid]
+        classroom_room_info[cid] = (classroom.type or '', classroom.capacity or 0)
+        room_buckets[classroom.type or ''].append((classroom.capacity or 0, cid))
+    for bucket in room_buckets.values():
+        bucket.sort()
+
+    return {
+        'total_weeks': week_dim - 1,
+        'teacher_index': {tid: idx for idx, tid in enumerate(sorted(teacher_ids))},
+        'classroom_index': {cid: idx for idx, cid in enumerate(classroom_ids)},
+        'major_index': {mid: idx for idx, mid in enumerate(sorted(major_ids))},
+        'timeslot_index': {ts_id: idx for idx, ts_id in enumerate(timeslot_ids)},
+        'teacher_schedule': np.zeros((len(teacher_ids), week_dim, len(timeslot_ids)), dtype=bool),
+        'classroom_schedule': np.zeros((len(classroom_ids), week_dim, len(timeslot_ids)), dtype=bool),
+        'major_schedule': np.zeros((len(major_ids), week_dim, len(timeslot_ids)), dtype=bool),
+        # 空闲教室索引：free_rooms[(week, timeslot_id)] 仅在该时段第一次有教室被占用时才从 room_buckets 复制
+        'classroom_room_info': classroom_room_info,
+        'room_buckets': dict(room_buckets),
+        'free_rooms': {},
+    }
+
+def _ensure_state_entity(timetable_state, schedule_key, entity_id):
+    """返回实体在占用数组中的下标；未登记的实体 (如数据不一致时) 追加一行。"""
+    index_key = schedule_key.replace('_schedule', '_index')
+    index = timetable_state[index_key]
+    if entity_id not in index:
+        array = timetable_state[schedule_key]
+        index[entity_id] = array.shape[0]
+        timetable_state[schedule_key] = np.concatenate(
+            [array, np.zeros((1,) + array.shape[1:], dtype=bool)], axis=0)
+    return index[entity_id]
+
+def is_resource_busy(timetable_state, schedule_key, entity_id, week, timeslot_id):
+    """O(1) 探测某个教师/教室/专业在指定周次和时间段是否已被占用。"""
+    entity_idx = timetable_state[schedule_key.replace('_schedule', '_index')].get(entity_id)
+    ts_idx = timetable_state['timeslot_index'].get(timeslot_id)
+    if entity_idx is None or ts_idx is None or not 0 < week <= timetable_state['total_weeks']:
+        return False
+    return bool(timetable_state[schedule_key][entity_idx, week, ts_idx])
+
+def mark_slot_occupied(timetable_state, teacher_id, classroom_id, major_id, weeks, timeslot_id):
+    """将教师、教室、专业在给定周次 (单个周次或周次序列) 的时间段标记为已占用。"""
+    ts_idx = timetable_state['timeslot_index'][timeslot_id]
+    for schedule_key, entity_id in (('teacher_schedule', teacher_id),
+                                    ('classroom_schedule', classroom_id),
+                                    ('major_schedule', major_id)):
+        entity_idx = _ensure_state_entity(timetable_state, schedule_key, entity_id)
+        timetable_state[schedule_key][entity_idx, weeks, ts_idx] = True
+    # 同步维护空闲教室索引
+    for week in np.atleast_1d(weeks).tolist():
+        _remove_free_room(timetable_state, week, timeslot_id, classroom_id)
+
+def release_slot_occupied(timetable_state, teacher_id, classroom_id, major_id, weeks, timeslot_id):
+    """mark_slot_occupied 的逆操作：释放教师、教室、专业在给定周次该时间段的占用，并把教室放回空闲索引。"""
+    ts_idx = timetable_state['timeslot_index'][timeslot_id]
+    for schedule_key, entity_id in (('teacher_schedule', teacher_id),
+                                    ('classroom_schedule', classroom_id),
+                                    ('major_schedule', major_id)):
+        entity_idx = timetable_state[schedule_key.replace('_schedule', '_index')].get(entity_id)
+        if entity_idx is not None:
+            timetable_state[schedule_key][entity_idx, weeks, ts_idx] = False
+    room_info = timetable_state['classroom_room_info'].get(classroom_id)
+    if room_info is None: return
+    room_type, capacity = room_info
+    for week in np.atleast_1d(weeks).tolist():
+        free_bucket = _free_room_buckets(timetable_state, week, timeslot_id, for_update=True)[room_type]
+        pos = bisect.bisect_left(free_bucket, (capacity, classroom_id))
+        if pos >= len(free_bucket) or free_bucket[pos] != (capacity, classroom_id):
+            free_bucket.insert(pos, (capacity, classroom_id))
+
+def _free_room_buckets(timetable_state, week, timeslot_id, for_update=False):
+    """返回某 (周次, 时间段) 的空闲教室分桶；只读访问未被修改过的时段时直接共享初始分桶。"""
+    buckets = timetable_state['free_rooms'].get((week, timeslot_id))
+    if buckets is None:
+        if not for_update:
+            return timetable_state['room_buckets']
+        buckets = {room_type: list(bucket) for room_type, bucket in timetable_state['room_buckets'].items()}
+        timetable_state['free_rooms'][(week, timeslot_id)] = buckets
+    return buckets
+
+def _remove_free_room(timetable_state, week, timeslot_id, classroom_id):
+    """教室被占用后，将其从对应 (周次, 时间段) 的空闲桶中移除 (二分定位)。"""
+    room_info = timetable_state['classroom_room_info'].get(classroom_id)
+    if room_info is None: return
+    room_type, capacity = room_info
+    free_bucket = _free_room_buckets(timetable_state, week, timeslot_id, for_update=True)[room_type]
+    pos = bisect.bisect_left(free_bucket, (capacity, classroom_id))
+    if pos < len(free_bucket) and free_bucket[pos] == (capacity, classroom_id):
+        del free_bucket[pos]
+
+def find_smallest_free_classroom(timetable_state, week, timeslot_id, room_types, min_capacity):
+    """
+    在给定类型的空闲教室中查找容量 >= min_capacity 的最小教室，返回 (容量, 教室ID)；没有则返回 None。
+    每个类型桶内是一次二分查找。
+    """
+    buckets = _free_room_buckets(timetable_state, week, timeslot_id)
+    best = None
+    for room_type in room_types:
+        bucket = buckets.get(room_type)
+        if not bucket: continue
+        pos = bisect.bisect_left(bucket, (min_capacity, -math.inf))
+        if pos < len(bucket) and (best is None or bucket[pos] < best):
+            best = bucket[pos]
+    return best
+
+def free_weeks_mask(timetable_state, teacher_id, classroom_id, major_id, timeslot_id, first_week, last_week):
+    """
+    向量化查询：返回第 first_week 至 last_week 周中，教师、教室、专业在该时间段均空闲的布尔掩码。
+    掩码下标 i 对应第 first_week + i 周。
+    """
+    last_week = min(last_week, timetable_state['total_weeks'])
+    if last_week < first_week:
+        return np.zeros(0, dtype=bool)
+    ts_idx = timetable_state['timeslot_index'][timeslot_id]
+    busy = np.zeros(last_week - first_week + 1, dtype=bool)
+    for schedule_key, entity_id in (('teacher_schedule', teacher_id),
+                                    ('classroom_schedule', classroom_id),
+                                    ('major_schedule', major_id)):
+        entity_idx = timetable_state[schedule_key.replace('_schedule', '_index')].get(entity_id)
+        if entity_idx is not None:
+            busy |= timetable_state[schedule_key][entity_idx, first_week:last_week + 1, ts_idx]
+    return ~busy
+
+def is_slot_free_for_weeks(timetable_state, teacher_id, classroom_id, major_id, timeslot_id, first_week, last_week):
+    """判断该时间段在第 first_week 至 last_week 周是否全部空闲 (例如“剩余所有周次”)。"""
+    return bool(free_weeks_mask(timetable_state, teacher_id, classroom_id, major_id, timeslot_id,
+                                first_week, last_week).all())
+
 def check_constraints(timetable_state, assignment, week, timeslot_id, classroom_id, all_data):
     teacher_id = assignment.teacher_id
     major_id = assignment.major_id
@@ -169,42 +319,31 @@ def check_constraints(timetable_state, assignment, week, timeslot_id, classroom_
     # --- 新增结束 ---
 
     # 检查全局状态中教师、教室、专业是否已被占用
-    if (teacher_id, week, timeslot_id) in timetable_state['teacher_schedule']:
+    if is_resource_busy(timetable_state, 'teacher_schedule', teacher_id, week, timeslot_id):
         # print(f"[CONFLICT] Teacher {teacher_id} busy week {week} slot {timeslot_id}")
         return False, "教师冲突 (已安排其它课程)"
-    if (classroom_id, week, timeslot_id) in timetable_state['classroom_schedule']:
+    if is_resource_busy(timetable_state, 'classroom_schedule', classroom_id, week, timeslot_id):
         # print(f"[CONFLICT] Classroom {classroom_id} busy week {week} slot {timeslot_id}")
         return False, "教室冲突 (已被占用)"
-    if (major_id, week, timeslot_id) in timetable_state['major_schedule']:
+    if is_resource_busy(timetable_state, 'major_schedule', major_id, week, timeslot_id):
         # print(f"[CONFLICT] Major {major_id} busy week {week} slot {timeslot_id}")
         return False, "专业冲突 (已安排其它课程)"
 
     return True, None # 没有冲突
 
 def find_available_classroom(timetable_state, assignment, week, timeslot_id, all_data):
-    required_capacity = assignment.expected_students
+    required_capacity = assignment.expected_students or 0
     course = all_data['courses'].get(assignment.course_id)
     is_lab_course = course and course.course_type == '实验课'
-    preferred_type_available, other_type_available = [], []
-
-    # 确定在当前周次和时间段已经被占用的教室集合，检查全局状态
-    busy_classrooms = {cid for (cid, w, tid) in timetable_state['classroom_schedule'] if
-                       w == week and tid == timeslot_id}
-
-    for classroom_id, classroom in all_data['classrooms'].items():
-        # 检查教室是否在全局状态中已被占用
-        if classroom_id in busy_classrooms: continue
-        if classroom.capacity < required_capacity: continue
-        classroom_type_match = (is_lab_course and classroom.type == '实验室') or \
-                               (not is_lab_course and classroom.type == '普通教室')
-        if classroom_type_match:
-            preferred_type_available.append(classroom_id)
-        else:
-            other_type_available.append(classroom_id)
+    preferred_type = '实验室' if is_lab_course else '普通教室'
 
-    if preferred_type_available: return random.choice(preferred_type_available)
-    if other_type_available: return random.choice(other_type_available)
-    return None
+    # 从空闲教室索引中取容量足够的最小教室：优先匹配类型，其次任意其它类型
+    if not 0 < week <= timetable_state['total_weeks']: return None
+    found = find_smallest_free_classroom(timetable_state, week, timeslot_id, (preferred_type,), required_capacity)
+    if found is None:
+        other_types = [room_type for room_type in timetable_state['room_buckets'] if room_type != preferred_type]
+        found = find_smallest_free_classroom(timetable_state, week, timeslot_id, other_types, required_capacity)
+    return found[1] if found else None
 
 # ==================================
 # 5. 自动生成初始模板函数 (保持不变)
@@ -410,9 +549,8 @@ def schedule_with_generated_template(assignments_for_major, current_semester, cu
                     week1_fixed_template[timeslot_id] = (assignment_to_attempt_id, suitable_classroom_id)
 
                     # 更新全局状态
-                    global_timetable_state['teacher_schedule'].add((assignment.teacher_id, week, timeslot_id))
-                    global_timetable_state['classroom_schedule'].add((suitable_classroom_id, week, timeslot_id))
-                    global_timetable_state['major_schedule'].add((assignment.major_id, week, timeslot_id))
+                    mark_slot_occupied(global_timetable_state, assignment.teacher_id, suitable_classroom_id,
+                                       assignment.major_id, week, timeslot_id)
 
                     # 减少剩余课时
                     assignment_sessions_remaining[assignment_to_attempt_id] -= 1
@@ -457,51 +595,50 @@ def schedule_with_generated_template(assignments_for_major, current_semester, cu
     if not week1_fixed_template:
          print(f"SCHEDULER:   - 警告：专业 '{current_major.name}' 未能在第 1 周排入任何课程，无法生成固定模板。")
     else:
-        for week in range(2, total_weeks + 1):
-            # print(f"SCHEDULER:     - 正在复制模板到第 {week} 周...")
-            for timeslot_id, (assignment_id, classroom_id) in week1_fixed_template.items():
-                # 检查模板中的任务是否还有剩余课时
-                if assignment_sessions_remaining.get(assignment_id, 0) > 0:
-                    assignment = assignments_for_major.get(assignment_id)
-                    if not assignment: continue # 任务数据丢失？
-
-                    # 检查全局状态，看这个资源是否已被 *其他专业* 在本周本时段占用 (理论上不应检查自身冲突，因为是复制)
-                    # 注意：这里简化处理，不完全重新检查所有约束，主要防止与其他专业冲突
-                    teacher_busy = (assignment.teacher_id, week, timeslot_id) in global_timetable_state['teacher_schedule']
-                    classroom_busy = (classroom_id, week, timeslot_id) in global_timetable_state['classroom_schedule']
-                    major_busy = (assignment.major_id, week, timeslot_id) in global_timetable_state['major_schedule'] # 理论上不应发生
-
-                    if teacher_busy or classroom_busy or major_busy:
-                         # 记录潜在的周间冲突（通常是由于其他专业抢占了资源）
-                         reason = []
-                         if teacher_busy: reason.append("教师已被占用")
-                         if classroom_busy: reason.append("教室已被占用")
-                         if major_busy: reason.append("专业时段已被占用")
-                         # 这里选择记录冲突并跳过，还是强制覆盖？目前选择跳过以避免硬冲突
-                         ts_info = all_data['timeslots'].get(timeslot_id)
-                         day_str = ts_info.day_of_week if ts_info else '?'
-                         period_num = ts_info.period if ts_info else '?'
-                         conflicts_log_week1.append( # 把周间冲突也加入日志
-                             {'major_id': assignment.major_id, 'week': week, 'day': day_str, 'period': period_num,
-                              'assignment_id': assignment_id,
-                              'reason': f"W{week}模板复制冲突: {', '.join(reason)} (被其他专业占用?)"})
-                         # print(f"  SKIP W{week}: Template slot {day_str}-{period_num} for {assignment_id} skipped due to conflict: {', '.join(reason)}")
-                         continue # 跳过这个时段的复制
-
-                    # 创建排课条目 (直接使用模板信息)
-                    entry = TimetableEntry(None, current_semester.id, assignment.major_id, assignment.course_id,
-                                           assignment.teacher_id, classroom_id, timeslot_id, week,
-                                           assignment_id)
-                    final_schedule.append(entry)
-
-                    # 更新全局状态 (重要！通知其他专业此资源已占用)
-                    global_timetable_state['teacher_schedule'].add((assignment.teacher_id, week, timeslot_id))
-                    global_timetable_state['classroom_schedule'].add((classroom_id, week, timeslot_id))
-                    global_timetable_state['major_schedule'].add((assignment.major_id, week, timeslot_id))
-
-                    # 减少剩余课时
-                    assignment_sessions_remaining[assignment_id] -= 1
-                    # print(f"  REPLICATED W{week}: Slot {day_str}-{period_num} assigned {assignment_id} in C{classroom_id}. Remaining: {assignment_sessions_remaining[assignment_id]}")
+        # 模板中各条目的时间段互不相同，彼此不会争用同一 (周次, 时间段)，
+        # 因此可以逐个模板条目一次性查询第 2 至 N 周的空闲掩码，再按周次顺序复制。
+        for timeslot_id, (assignment_id, classroom_id) in week1_fixed_template.items():
+            # 检查模板中的任务是否还有剩余课时
+            if assignment_sessions_remaining.get(assignment_id, 0) <= 0: continue
+            assignment = assignments_for_major.get(assignment_id)
+            if not assignment: continue # 任务数据丢失？
+
+            # 检查全局状态，看这个资源是否已被 *其他专业* 在这些周本时段占用 (理论上不应检查自身冲突，因为是复制)
+            # 注意：这里简化处理，不完全重新检查所有约束，主要防止与其他专业冲突
+            free_mask = free_weeks_mask(global_timetable_state, assignment.teacher_id, classroom_id,
+                                        assignment.major_id, timeslot_id, 2, total_weeks)
+            replicated_weeks = []
+            for offset, is_free in enumerate(free_mask.tolist()):
+                if assignment_sessions_remaining[assignment_id] <= 0: break
+                week = offset + 2
+                if not is_free:
+                    # 记录潜在的周间冲突（通常是由于其他专业抢占了资源）
+                    reason = []
+                    if is_resource_busy(global_timetable_state, 'teacher_schedule', assignment.teacher_id, week, timeslot_id): reason.append("教师已被占用")
+                    if is_resource_busy(global_timetable_state, 'classroom_schedule', classroom_id, week, timeslot_id): reason.append("教室已被占用")
+                    if is_resource_busy(global_timetable_state, 'major_schedule', assignment.major_id, week, timeslot_id): reason.append("专业时段已被占用") # 理论上不应发生
+                    # 这里选择记录冲突并跳过，还是强制覆盖？目前选择跳过以避免硬冲突
+                    ts_info = all_data['timeslots'].get(timeslot_id)
+                    day_str = ts_info.day_of_week if ts_info else '?'
+                    period_num = ts_info.period if ts_info else '?'
+                    conflicts_log_week1.append( # 把周间冲突也加入日志
+                        {'major_id': assignment.major_id, 'week': week, 'day': day_str, 'period': period_num,
+                         'assignment_id': assignment_id,
+                         'reason': f"W{week}模板复制冲突: {', '.join(reason)} (被其他专业占用?)"})
+                    continue # 跳过这个时段的复制
+
+                # 创建排课条目 (直接使用模板信息)
+                final_schedule.append(TimetableEntry(None, current_semester.id, assignment.major_id, assignment.course_id,
+                                                     assignment.teacher_id, classroom_id, timeslot_id, week,
+                                                     assignment_id))
+                replicated_weeks.append(week)
+                # 减少剩余课时
+                assignment_sessions_remaining[assignment_id] -= 1
+
+            # 更新全局状态 (重要！通知其他专业此资源已占用)
+            if replicated_weeks:
+                mark_slot_occupied(global_timetable_state, assignment.teacher_id, classroom_id,
+                                   assignment.major_id, replicated_weeks, timeslot_id)
 
     # --- Final Check: 未完成的任务 ---
     unscheduled_final = []
@@ -524,362 +661,1131 @@ def schedule_with_generated_template(assignments_for_major, current_semester, cu
 
 
 # ==================================
-# 7. 导出到 Excel 函数 (保持不变)
+# 6.1 冲突图分解与并行排课
+# ==================================
+COMPONENT_SCARCE_ROOM_LIMIT = 2  # 任务可用的首选类型教室不超过这么多间时，视为硬约束参与分解
+
+def build_major_conflict_components(sorted_major_ids, all_assignments_in_semester, all_data):
+    """
+    按硬约束把专业划分为可以独立求解的子问题 (连通分量)。
+    两个专业有共同的授课教师时连一条边；某个任务可用的首选类型教室 (容量足够) 不超过
+    COMPONENT_SCARCE_ROOM_LIMIT 间时 (如唯一的大阶梯教室、少量实验室)，这些稀缺教室也作为共享资源连边。
+    普通教室人人可用，不参与分解 (否则所有专业都会连成一个分量)，分量之间对它们的争用
+    由 merge_component_results 在合并结果时解决。
+    返回分量列表，分量内和分量之间都保持 sorted_major_ids 的顺序。
+    """
+    parent = {major_id: major_id for major_id in sorted_major_ids}
+
+    def find(major_id):
+        while parent[major_id] != major_id:
+            parent[major_id] = parent[parent[major_id]]
+            major_id = parent[major_id]
+        return major_id
+
+    def union(a, b):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b: parent[root_b] = root_a
+
+    classrooms = list(all_data['classrooms'].values())
+    first_major_by_resource = {}
+    for major_id in sorted_major_ids:
+        resources = set()
+        for assign in all_assignments_in_semester.get(major_id, {}).values():
+            resources.add(('teacher', assign.teacher_id))
+            course = all_data['courses'].get(assign.course_id)
+            preferred_type = '实验室' if course and course.course_type == '实验课' else '普通教室'
+            rooms = [c.id for c in classrooms
+                     if c.type == preferred_type and (c.capacity or 0) >= (assign.expected_students or 0)]
+            if len(rooms) <= COMPONENT_SCARCE_ROOM_LIMIT:
+                resources.update(('classroom', room_id) for room_id in rooms)
+        for resource in resources:
+            if resource in first_major_by_resource:
+                union(first_major_by_resource[resource], major_id)
+            else:
+                first_major_by_resource[resource] = major_id
+
+    components = defaultdict(list)
+    for major_id in sorted_major_ids:
+        components[find(major_id)].append(major_id)
+    position = {major_id: i for i, major_id in enumerate(sorted_major_ids)}
+    return sorted(components.values(), key=lambda component: position[component[0]])
+
+def merge_component_results(component_results, all_data, current_semester):
+    """
+    把各分量在各自占用状态上得到的结果按分量顺序放入同一个占用状态。
+    分量之间不共享教师和专业，只可能争用教室：某个放置 (任务, 时间段, 教室) 的部分周次教室已被先合并的分量占用时，
+    这些周次整体换到同一间空闲的候选教室 (首选类型在前、容量升序)；没有这样的教室时逐周用
+    find_available_classroom 另找，仍找不到的课时计为未排并记录冲突。
+    返回 ({major_id: 合并后的结果}, 换教室的放置数, 因此未排的课时数)。
+    """
+    timetable_state = create_timetable_state(all_data, current_semester.total_weeks)
+    merged, moved, dropped_total = {}, 0, 0
+    for component_result in component_results:
+        for major_id, result in component_result.items():
+            placements = defaultdict(list)
+            for entry in result.get('schedule', []):
+                placements[(entry.assignment_id, entry.timeslot_id, entry.classroom_id)].append(entry)
+            schedule, conflicts, dropped = [], list(result.get('conflicts', [])), Counter()
+            for (assignment_id, timeslot_id, classroom_id), entries in placements.items():
+                ts_idx = timetable_state['timeslot_index'][timeslot_id]
+                room_idx = _ensure_state_entity(timetable_state, 'classroom_schedule', classroom_id)
+                weeks = np.array([entry.week_number for entry in entries], dtype=np.intp)
+                taken = timetable_state['classroom_schedule'][room_idx, weeks, ts_idx]
+                if not taken.any():
+                    mark_slot_occupied(timetable_state, entries[0].teacher_id, classroom_id, major_id, weeks, timeslot_id)
+                    schedule.extend(entries)
+                    continue
+                moved += 1
+                kept = [entry for entry, is_taken in zip(entries, taken.tolist()) if not is_taken]
+                if kept:
+                    mark_slot_occupied(timetable_state, entries[0].teacher_id, classroom_id, major_id,
+                                       [entry.week_number for entry in kept], timeslot_id)
+                    schedule.extend(kept)
+                contested = [entry for entry, is_taken in zip(entries, taken.tolist()) if is_taken]
+                contested_weeks = np.array([entry.week_number for entry in contested], dtype=np.intp)
+                assignment = all_data['course_assignments'].get(assignment_id)
+                room_ids, room_rows = assignment_placement_options(timetable_state, assignment, all_data)[1] \
+                    if assignment else ([], np.zeros(0, dtype=np.intp))
+                room_free = ~timetable_state['classroom_schedule'][room_rows][:, contested_weeks, ts_idx].any(axis=1)
+                if room_free.any():
+                    new_room = room_ids[int(np.argmax(room_free))]
+                    mark_slot_occupied(timetable_state, entries[0].teacher_id, new_room, major_id, contested_weeks, timeslot_id)
+                    schedule.extend(entry._replace(classroom_id=new_room) for entry in contested)
+                    continue
+                for entry in contested:
+                    new_room = find_available_classroom(timetable_state, assignment, entry.week_number, timeslot_id, all_data) \
+                        if assignment else None
+                    if new_room is None:
+                        dropped[assignment_id] += 1
+                        ts_info = all_data['timeslots'].get(timeslot_id)
+                        conflicts.append({'major_id': major_id, 'week': entry.week_number,
+                                          'day': ts_info.day_of_week if ts_info else '?',
+                                          'period': ts_info.period if ts_info else '?', 'assignment_id': assignment_id,
+                                          'reason': f"W{entry.week_number}合并子问题时教室冲突: 无其它可用教室"})
+                        continue
+                    mark_slot_occupied(timetable_state, entry.teacher_id, new_room, major_id, entry.week_number, timeslot_id)
+                    schedule.append(entry._replace(classroom_id=new_room))
+            unscheduled = [dict(detail) for detail in result.get('unscheduled_details', [])]
+            for detail in unscheduled:
+                detail['remaining_sessions'] += dropped.pop(detail['assignment_id'], 0)
+            unscheduled.extend(_unscheduled_detail(all_data['course_assignments'][assignment_id], count, all_data)
+                               for assignment_id, count in dropped.items())
+            dropped_total += sum(dropped.values())
+            merged[major_id] = {'schedule': schedule, 'unscheduled_details': unscheduled, 'conflicts': conflicts}
+    return merged, moved, dropped_total
+
+def schedule_major_component(component_major_ids, all_data, current_semester, all_assignments_in_semester,
+                             component_seed=None, on_major_done=None):
+    """
+    在独立的全局占用状态上依次为一个分量内的专业排课 (可在子进程中执行)。
+    component_seed 不为 None 时先据此重置随机数，使结果与在哪个进程中执行无关。
+    on_major_done(major_id, result) 在每个专业排完后调用 (仅在当前进程中执行时传入)。
+    返回 {major_id: schedule_with_generated_template 的结果}。
+    """
+    if component_seed is not None:
+        random.seed(component_seed)
+    timetable_state = create_timetable_state(all_data, current_semester.total_weeks)
+    results = {}
+    for major_id in component_major_ids:
+        if _attempt_stop_event is not None and _attempt_stop_event.is_set():
+            raise SchedulingCancelled("多起点排课已放弃本次尝试")
+        assignments_for_this_major = all_assignments_in_semester.get(major_id, {})
+        if not assignments_for_this_major: continue
+        current_major = all_data['majors'].get(major_id)
+        major_name = current_major.name if current_major else f"未知专业ID_{major_id}"
+        major_obj_for_scheduling = current_major if current_major else type('MajorDummy', (object,), {'id': major_id, 'name': major_name})()
+
+        initial_template_dp, unscheduled_pool = generate_initial_template(assignments_for_this_major, all_data)
+        results[major_id] = schedule_with_generated_template(
+            assignments_for_this_major, current_semester,
+            major_obj_for_scheduling,
+            all_data, initial_template_dp, unscheduled_pool,
+            timetable_state  # 分量内共享的占用状态
+        )
+        if on_major_done: on_major_done(major_id, results[major_id])
+    return results
+
+def schedule_components(components, all_data, current_semester, all_assignments_in_semester, max_workers=None,
+                        seed=None, on_major_done=None):
+    """
+    为各个分量排课并合并结果。分量之间不共享教师和稀缺教室，多于一个分量时放入进程池并行求解，
+    再由 merge_component_results 按分量顺序合并并解决普通教室的争用，结果与并行度无关。
+    给定 seed 时每个分量使用 "seed:分量序号" 作为随机种子。
+    on_major_done(major_id, result) 在每个专业的结果可用时调用 (并行时按分量完成顺序，为合并前的结果)。
+    """
+    component_seeds = [None if seed is None else f"{seed}:{index}" for index in range(len(components))]
+    worker_count = min(len(components), max_workers or os.cpu_count() or 1)
+    component_results = None
+    if worker_count > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=worker_count) as executor:
+                futures = [executor.submit(schedule_major_component, component, all_data,
+                                           current_semester, all_assignments_in_semester, component_seed)
+                           for component, component_seed in zip(components, component_seeds)]
+                for future in as_completed(futures):
+                    if on_major_done:
+                        for major_id, result in future.result().items(): on_major_done(major_id, result)
+                component_results = [future.result() for future in futures]
+        except (BrokenProcessPool, OSError) as pool_error:
+            print(f"SCHEDULER: 警告：进程池不可用 ({pool_error})，改为在当前进程中依次排课。")
+
+    if component_results is None:
+        component_results = [schedule_major_component(component, all_data, current_semester,
+                                                      all_assignments_in_semester, component_seed, on_major_done)
+                             for component, component_seed in zip(components, component_seeds)]
+    if len(component_results) == 1:
+        return component_results[0]
+    results_by_major, moved, dropped = merge_component_results(component_results, all_data, current_semester)
+    if moved:
+        print(f"SCHEDULER: 合并 {len(component_results)} 个子问题：{moved} 个放置因教室争用换了教室，"
+              f"{dropped} 个课时找不到其它教室。")
+    return results_by_major
+
+
+# ==================================
+# 6.2 多起点随机排课 (取最优)
+# ==================================
+_attempt_stop_event = None  # 多起点尝试的工作进程中由 _init_attempt_worker 设置；置位后尝试在下一个专业前停止
+
+def _init_attempt_worker(stop_event):
+    global _attempt_stop_event
+    _attempt_stop_event = stop_event
+
+def run_scheduling_attempt(seed, components, all_data, current_semester, all_assignments_in_semester, max_workers=1,
+                           on_major_done=None):
+    """
+    以给定种子完成一次完整的内存排课并打分。
+    评分为 (未排课时总数, 冲突记录数)，越小越好。
+    """
+    results_by_major = schedule_components(components, all_data, current_semester, all_assignments_in_semester,
+                                           max_workers, seed=seed, on_major_done=on_major_done)
+    unscheduled_sessions = sum(detail['remaining_sessions'] for result in results_by_major.values()
+                               for detail in result.get('unscheduled_details', []))
+    conflicts = sum(len(result.get('conflicts', [])) for result in results_by_major.values())
+    return {'seed': seed, 'results_by_major': results_by_major,
+            'unscheduled_sessions': unscheduled_sessions, 'conflicts': conflicts}
+
+def _attempt_score(attempt, attempt_index):
+    return (attempt['unscheduled_sessions'], attempt['conflicts'], attempt_index)
+
+def run_multi_start_scheduling(attempts, base_seed, components, all_data, current_semester,
+                               all_assignments_in_semester, max_workers=None, deadline=None,
+                               on_major_done=None, on_attempt_done=None):
+    """
+    用种子 base_seed, base_seed+1, ... 进行 attempts 次排课，只保留得分最优的一次。
+    多次尝试时每次尝试占用一个工作进程 (尝试内部的分量依次求解，避免嵌套进程池)；
+    只有一次尝试时由 schedule_components 并行求解各分量。
+    deadline 为 time.monotonic() 时间点：到点后不再等待/启动新的尝试，返回已完成尝试中的最优者
+    (至少会完成一次尝试)；仍在工作进程中运行的尝试通过共享的停止事件在下一个专业前退出，
+    返回前等待工作进程结束，不会在任务结束后继续占用 CPU。
+    进度回调：只有一次尝试时逐个专业调用 on_major_done(major_id, result)，
+    多次尝试时每完成一次尝试调用 on_attempt_done(得分)。
+    返回 (最优尝试, 已完成尝试的得分列表)。
+    """
+    seeds = [base_seed + index for index in range(max(int(attempts or 1), 1))]
+    if len(seeds) == 1:
+        best = run_scheduling_attempt(seeds[0], components, all_data, current_semester,
+                                      all_assignments_in_semester, max_workers, on_major_done)
+        return best, [{'seed': best['seed'], 'unscheduled_sessions': best['unscheduled_sessions'],
+                       'conflicts': best['conflicts']}]
+
+    best, best_score, scores = None, None, {}
+
+    def keep_if_better(attempt_index, attempt):
+        nonlocal best, best_score
+        scores[attempt_index] = {'seed': attempt['seed'], 'unscheduled_sessions': attempt['unscheduled_sessions'],
+                                 'conflicts': attempt['conflicts']}
+        score = _attempt_score(attempt, attempt_index)
+        if best_score is None or score < best_score:
+            best, best_score = attempt, score  # 其余尝试的课表随即丢弃
+        if on_attempt_done: on_attempt_done(scores[attempt_index])
+
+    def out_of_time():
+        return best is not None and deadline is not None and time.monotonic() >= deadline
+
+    worker_count = min(len(seeds), max_workers or os.cpu_count() or 1)
+    if worker_count > 1:
+        executor = None
+        abandon_running = True  # 超时或被中止时停止仍在运行的尝试
+        stop_event = multiprocessing.Event()
+        try:
+            executor = ProcessPoolExecutor(max_workers=worker_count, initializer=_init_attempt_worker,
+                                           initargs=(stop_event,))
+            futures = {executor.submit(run_scheduling_attempt, seed, components, all_data, current_semester,
+                                       all_assignments_in_semester, 1): index
+                       for index, seed in enumerate(seeds)}
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                for future in as_completed(futures, timeout=timeout):
+                    keep_if_better(futures[future], future.result())
+            except FuturesTimeoutError:
+                if best is None:  # 预算耗尽但还没有任何结果：等待最先完成的一次尝试
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        keep_if_better(futures[future], future.result())
+                print(f"SCHEDULER: 时间预算已用完，放弃其余 {len(seeds) - len(scores)} 次未完成的尝试。")
+            abandon_running = out_of_time()
+        except (BrokenProcessPool, OSError) as pool_error:
+            print(f"SCHEDULER: 警告：进程池不可用 ({pool_error})，改为在当前进程中依次尝试剩余种子。")
+        finally:
+            # 尚未开始的尝试直接取消，正在运行的尝试收到停止事件后退出
+            if abandon_running: stop_event.set()
+            if executor: executor.shutdown(wait=True, cancel_futures=True)
+
+    for index, seed in enumerate(seeds):
+        if index in scores: continue
+        if out_of_time(): break
+        keep_if_better(index, run_scheduling_attempt(seed, components, all_data, current_semester,
+                                                     all_assignments_in_semester, 1))
+
+    return best, [scores[index] for index in sorted(scores)]
+
+
+# ==================================
+# 6.3 局部搜索改进阶段 (模拟退火)
+# ==================================
+def _unscheduled_detail(assignment, remaining, all_data):
+    course = all_data['courses'].get(assignment.course_id)
+    teacher = all_data['teachers'].get(assignment.teacher_id)
+    return {'assignment_id': assignment.id, 'course_name': course.name if course else '?',
+            'teacher_name': teacher.name if teacher else '?', 'remaining_sessions': remaining}
+
+def assignment_placement_options(timetable_state, assignment, all_data):
+    """
+    返回任务可用的时间段 (排除已批准的教师“避免”偏好) 与候选教室 (容量足够，首选类型在前、容量升序)：
+    (时间段ID列表, (教室ID列表, 教室在占用数组中的下标数组))。
+    """
+    avoid = all_data.get('approved_avoid_preferences', set())
+    timeslot_ids = [ts_id for ts_id in sorted(all_data['timeslots'].keys())
+                    if (assignment.teacher_id, ts_id, assignment.semester_id) not in avoid]
+    course = all_data['courses'].get(assignment.course_id)
+    preferred_type = '实验室' if course and course.course_type == '实验课' else '普通教室'
+    rooms = sorted((c for c in all_data['classrooms'].values() if (c.capacity or 0) >= (assignment.expected_students or 0)),
+                   key=lambda c: (c.type != preferred_type, c.capacity or 0, c.id))
+    return timeslot_ids, ([c.id for c in rooms],
+                          np.array([timetable_state['classroom_index'][c.id] for c in rooms], dtype=np.intp))
+
+def best_room_for_timeslot(timetable_state, assignment, timeslot_id, room_options):
+    """
+    向量化比较所有候选教室在该时间段第 1 至 N 周的空闲情况 (同时要求教师、专业空闲)，
+    返回 (教室ID, 空闲周次数组)：可用周数最多的教室 (并列时取候选顺序靠前者)。
+    """
+    room_ids, room_rows = room_options
+    if not room_ids: return None, np.zeros(0, dtype=np.intp)
+    ts_idx = timetable_state['timeslot_index'][timeslot_id]
+    teacher_idx = _ensure_state_entity(timetable_state, 'teacher_schedule', assignment.teacher_id)
+    major_idx = _ensure_state_entity(timetable_state, 'major_schedule', assignment.major_id)
+    busy = (timetable_state['teacher_schedule'][teacher_idx, 1:, ts_idx]
+            | timetable_state['major_schedule'][major_idx, 1:, ts_idx])
+    free = ~(timetable_state['classroom_schedule'][room_rows, 1:, ts_idx] | busy)
+    best = int(np.argmax(free.sum(axis=1)))
+    return room_ids[best], np.flatnonzero(free[best]) + 1
+
+SWAP_PARTNER_TRIES = 8  # 交换操作在同专业放置中抽样寻找搭档的次数
+
+class _IndexedSet:
+    """支持 O(1) 加入、删除与随机抽取的集合 (局部搜索按此抽取放置和未排完的任务)。"""
+
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        if item not in self.positions:
+            self.positions[item] = len(self.items)
+            self.items.append(item)
+
+    def discard(self, item):
+        pos = self.positions.pop(item, None)
+        if pos is None: return
+        last = self.items.pop()
+        if pos < len(self.items):
+            self.items[pos] = last
+            self.positions[last] = pos
+
+    def choice(self, rng):
+        return self.items[rng.randrange(len(self.items))]
+
+def improve_schedule_with_local_search(results_by_major, all_data, current_semester, all_assignments_in_semester,
+                                       time_budget, seed=None, max_iterations=None, progress_callback=None):
+    """
+    在固定周模板排课结果之上做模拟退火局部搜索，目标是减少未排课时总数。
+    课表按“放置” (任务, 时间段, 教室) -> 周次列表 表示，三种邻域操作：
+      - 插入：为仍有剩余课时的任务选一个时间段，在空闲周次中补排；
+      - 移动：把一个放置整体挪到另一个时间段 (连同剩余课时一起尝试排入)；
+      - 交换：同一专业的两个放置互换时间段。
+    每次评估只释放/查询受影响的教师、教室、专业在相关时间段的占用行 (增量计算差值)，
+    教室在该时间段上按可用周数向量化择优；抽取放置与任务、刷新最优课表都是 O(1)，不随课表规模增长。
+    超过 time_budget 秒、达到 max_iterations 或已无未排课时即停止，返回搜索过程中最好的课表。
+    progress_callback(当前未排课时) 大约每 0.5 秒调用一次。
+    返回 (新的 results_by_major, 统计信息)。冲突记录沿用原排课过程的日志。
+    """
+    started = time.monotonic()
+    deadline = started + max(float(time_budget or 0), 0.0)
+    rng = random.Random(None if seed is None else f"{seed}:improve")
+    total_weeks = current_semester.total_weeks
+    state = create_timetable_state(all_data, total_weeks)
+    assignments = {aid: assign for major_assignments in all_assignments_in_semester.values()
+                   for aid, assign in major_assignments.items()}
+
+    grouped = defaultdict(list)  # (assignment_id, timeslot_id, classroom_id) -> 周次列表
+    for result in results_by_major.values():
+        for entry in result.get('schedule', []):
+            grouped[(entry.assignment_id, entry.timeslot_id, entry.classroom_id)].append(entry.week_number)
+    remaining = Counter()
+    for result in results_by_major.values():
+        for detail in result.get('unscheduled_details', []):
+            remaining[detail['assignment_id']] += detail['remaining_sessions']
+
+    # 每次操作只做 O(1) 的抽取与更新：放置、各专业的放置、仍有剩余课时的任务都保存在可随机抽取的集合中
+    placements = {}
+    placement_keys = _IndexedSet()
+    keys_by_major = defaultdict(_IndexedSet)
+    open_assignments = _IndexedSet()
+    # 最优课表 = 当前课表撤销自上次刷新最优以来的修改：记录每个被改动的键在最优时的值 (None 表示当时不存在)
+    best_placements_diff, best_remaining_diff = {}, {}
+
+    def set_weeks(key, weeks):
+        if key not in best_placements_diff: best_placements_diff[key] = placements.get(key)
+        major_keys = keys_by_major[assignments[key[0]].major_id]
+        if weeks:
+            placements[key] = weeks  # 总是新列表，最优记录中的旧列表不会被修改
+            placement_keys.add(key)
+            major_keys.add(key)
+        else:
+            placements.pop(key, None)
+            placement_keys.discard(key)
+            major_keys.discard(key)
+
+    def set_remaining(aid, count):
+        if aid not in best_remaining_diff: best_remaining_diff[aid] = remaining[aid]
+        remaining[aid] = count
+        if count > 0: open_assignments.add(aid)
+        else: open_assignments.discard(aid)
+
+    # 本阶段的占用状态只供 best_room_for_timeslot 读取占用数组，不维护空闲教室索引：
+    # 每次放置/释放只写入受影响的 (教师/教室/专业, 周次, 时间段) 单元
+    entity_rows = {aid: (_ensure_state_entity(state, 'teacher_schedule', assign.teacher_id),
+                         _ensure_state_entity(state, 'major_schedule', assign.major_id))
+                   for aid, assign in assignments.items()}
+    classroom_rows = {cid: _ensure_state_entity(state, 'classroom_schedule', cid) for cid in all_data['classrooms']}
+    timeslot_index = state['timeslot_index']
+
+    def occupy(key, weeks, value):
+        aid, ts_id, cid = key
+        teacher_idx, major_idx = entity_rows[aid]
+        ts_idx = timeslot_index[ts_id]
+        state['teacher_schedule'][teacher_idx, weeks, ts_idx] = value
+        state['classroom_schedule'][classroom_rows[cid], weeks, ts_idx] = value
+        state['major_schedule'][major_idx, weeks, ts_idx] = value
+
+    for key, weeks in grouped.items():
+        if key[2] not in classroom_rows:
+            classroom_rows[key[2]] = _ensure_state_entity(state, 'classroom_schedule', key[2])
+        occupy(key, weeks, True)
+        set_weeks(key, sorted(weeks))
+    for aid, count in list(remaining.items()):
+        set_remaining(aid, count)
+    best_placements_diff.clear()
+    best_remaining_diff.clear()
+
+    allowed_timeslots, allowed_timeslot_sets, candidate_rooms = {}, {}, {}
+    for aid, assign in assignments.items():
+        allowed_timeslots[aid], candidate_rooms[aid] = assignment_placement_options(state, assign, all_data)
+        allowed_timeslot_sets[aid] = set(allowed_timeslots[aid])
+
+    def best_room(assign, ts_id):
+        return best_room_for_timeslot(state, assign, ts_id, candidate_rooms[assign.id])
+
+    def place(aid, ts_id, cid, weeks):
+        occupy((aid, ts_id, cid), weeks, True)
+        set_weeks((aid, ts_id, cid), sorted(placements.get((aid, ts_id, cid), []) + list(weeks)))
+
+    def remove_weeks(key, weeks):
+        occupy(key, weeks, False)
+        removed = set(weeks)
+        set_weeks(key, [week for week in placements[key] if week not in removed])
+
+    def unplace(key):
+        weeks = placements[key]
+        remove_weeks(key, weeks)
+        return weeks
+
+    def accept(delta, temperature):
+        return delta <= 0 or rng.random() < math.exp(-delta / temperature)
+
+    def try_insert(temperature):
+        aid = open_assignments.choice(rng)
+        if not allowed_timeslots[aid]: return None
+        ts_id = rng.choice(allowed_timeslots[aid])
+        cid, free_weeks = best_room(assignments[aid], ts_id)
+        gain = min(remaining[aid], len(free_weeks))
+        if gain <= 0: return None
+        place(aid, ts_id, cid, free_weeks[:gain].tolist())
+        set_remaining(aid, remaining[aid] - gain)
+        return -gain
+
+    def try_move(temperature):
+        key = placement_keys.choice(rng)
+        aid = key[0]
+        if not allowed_timeslots[aid]: return None
+        old_weeks = unplace(key)
+        new_ts = rng.choice(allowed_timeslots[aid])
+        cid, free_weeks = best_room(assignments[aid], new_ts)
+        wanted = len(old_weeks) + remaining[aid]
+        placed = min(wanted, len(free_weeks))
+        delta = len(old_weeks) - placed  # 未排课时的变化量
+        if placed > 0 and accept(delta, temperature):
+            place(aid, new_ts, cid, free_weeks[:placed].tolist())
+            set_remaining(aid, wanted - placed)
+            return delta
+        place(aid, key[1], key[2], old_weeks)
+        return None
+
+    def try_swap(temperature):
+        key_a = placement_keys.choice(rng)
+        major_keys = keys_by_major[assignments[key_a[0]].major_id]
+        key_b = None
+        for _ in range(SWAP_PARTNER_TRIES):  # 在同专业的放置中抽样，不扫描全部放置
+            candidate = major_keys.choice(rng)
+            if candidate[0] != key_a[0] and candidate[1] != key_a[1] \
+                    and candidate[1] in allowed_timeslot_sets[key_a[0]] and key_a[1] in allowed_timeslot_sets[candidate[0]]:
+                key_b = candidate
+                break
+        if key_b is None: return None
+        weeks_a, weeks_b = unplace(key_a), unplace(key_b)
+        moved, delta = [], 0
+        for (aid, _, _), old_weeks, new_ts in ((key_a, weeks_a, key_b[1]), (key_b, weeks_b, key_a[1])):
+            cid, free_weeks = best_room(assignments[aid], new_ts)
+            wanted = len(old_weeks) + remaining[aid]
+            placed = min(wanted, len(free_weeks))
+            new_weeks = free_weeks[:placed].tolist()
+            if new_weeks:
+                place(aid, new_ts, cid, new_weeks)
+                moved.append(((aid, new_ts, cid), new_weeks, wanted - placed))
+            delta += len(old_weeks) - placed
+        if len(moved) == 2 and accept(delta, temperature):
+            for (aid, _, _), _, left in moved:
+                set_remaining(aid, left)
+            return delta
+        for key, new_weeks, _ in moved:
+            remove_weeks(key, new_weeks)
+        place(key_a[0], key_a[1], key_a[2], weeks_a)
+        place(key_b[0], key_b[1], key_b[2], weeks_b)
+        return None
+
+    initial_unscheduled = current_unscheduled = sum(remaining.values())
+    best_unscheduled = current_unscheduled
+    moves_evaluated = accepted_moves = 0
+    start_temperature = 2.0
+    next_report = started + 0.5
+    while current_unscheduled > 0:
+        now = time.monotonic()
+        if now >= deadline or (max_iterations is not None and moves_evaluated >= max_iterations): break
+        if progress_callback and now >= next_report:
+            progress_callback(current_unscheduled)
+            next_report = now + 0.5
+        progress = (now - started) / max(deadline - started, 1e-9)
+        temperature = max(start_temperature * (1.0 - progress), 0.01)
+        roll = rng.random()
+        if roll < 0.5:
+            delta = try_insert(temperature)
+        elif roll < 0.8 and placements:
+            delta = try_move(temperature)
+        elif placements:
+            delta = try_swap(temperature)
+        else:
+            delta = try_insert(temperature)
+        moves_evaluated += 1
+        if delta is None: continue
+        accepted_moves += 1
+        current_unscheduled += delta
+        if current_unscheduled < best_unscheduled:
+            best_unscheduled = current_unscheduled
+            best_placements_diff.clear()  # 当前课表即为新的最优
+            best_remaining_diff.clear()
+    elapsed = time.monotonic() - started
+
+    # 撤销最优之后的修改，得到最优课表
+    for key, weeks in best_placements_diff.items():
+        if weeks: placements[key] = weeks
+        else: placements.pop(key, None)
+    for aid, count in best_remaining_diff.items():
+        remaining[aid] = count
+    best_placements, best_remaining = placements, remaining
+    improved_results = {}
+    for major_id, result in results_by_major.items():
+        improved_results[major_id] = {'schedule': [], 'unscheduled_details': [],
+                                      'conflicts': list(result.get('conflicts', []))}
+    for (aid, ts_id, cid), weeks in best_placements.items():
+        assign = assignments[aid]
+        improved_results[assign.major_id]['schedule'].extend(
+            TimetableEntry(None, current_semester.id, assign.major_id, assign.course_id, assign.teacher_id,
+                           cid, ts_id, week, aid) for week in weeks)
+    for aid, count in sorted(best_remaining.items()):
+        if count > 0:
+            assign = assignments[aid]
+            improved_results[assign.major_id]['unscheduled_details'].append(_unscheduled_detail(assign, count, all_data))
+    for result in improved_results.values():
+        result['schedule'].sort(key=lambda e: (e.week_number, e.timeslot_id, e.assignment_id))
+
+    stats = {
+        'time_budget': float(time_budget or 0),
+        'elapsed_seconds': round(elapsed, 3),
+        'moves_evaluated': moves_evaluated,
+        'accepted_moves': accepted_moves,
+        'moves_per_second': round(moves_evaluated / elapsed, 1) if elapsed > 0 else 0.0,
+        'initial_unscheduled_sessions': initial_unscheduled,
+        'final_unscheduled_sessions': best_unscheduled,
+    }
+    print(f"SCHEDULER: 局部搜索用时 {stats['elapsed_seconds']}s，评估 {moves_evaluated} 次邻域操作 "
+          f"({stats['moves_per_second']} 次/秒)，接受 {accepted_moves} 次；"
+          f"未排课时 {initial_unscheduled} -> {best_unscheduled}。")
+    return improved_results, stats
+
+
+# ==================================
+# 6.4 增量重排 (只重新安排发生变化的教学任务)
+# ==================================
+def diff_semester_assignments(existing_entries, assignments, all_data):
+    """
+    对比数据库中已有的课表条目与当前教学任务，找出需要重新安排的部分：
+      - 新增任务：还没有任何课表条目；
+      - 删除任务：条目对应的任务已不存在 (或不再属于本学期)；
+      - 修改任务：条目的专业/课程/教师与任务不一致、教室容量不足、落在教师已批准的“避免”时段，
+                  或条目数超过课程总课时 —— 删除其全部条目后重新安排；
+      - 未排满任务：其余条件都满足但条目数少于总课时 —— 保留已有条目，只补排差额。
+    返回字典：kept_entries, deleted_assignment_ids (需删除其全部课表记录的任务), added, removed, modified,
+    incomplete, sessions_to_place。
+    """
+    avoid = all_data.get('approved_avoid_preferences', set())
+    entries_by_assignment = defaultdict(list)
+    for entry in existing_entries:
+        entries_by_assignment[entry.assignment_id].append(entry)
+
+    diff = {'kept_entries': [], 'deleted_assignment_ids': [], 'added': [], 'removed': [], 'modified': [],
+            'incomplete': [], 'sessions_to_place': {}}
+    for aid, entries in entries_by_assignment.items():
+        if aid not in assignments:
+            diff['removed'].append(aid)
+            diff['deleted_assignment_ids'].append(aid)
+
+    for aid, assign in assignments.items():
+        course = all_data['courses'].get(assign.course_id)
+        total_sessions = course.total_sessions if course else 0
+        entries = entries_by_assignment.get(aid, [])
+        if not entries:
+            if total_sessions > 0:
+                diff['added'].append(aid)
+                diff['sessions_to_place'][aid] = total_sessions
+            continue
+
+        def entry_still_valid(entry):
+            classroom = all_data['classrooms'].get(entry.classroom_id)
+            return ((entry.major_id, entry.course_id, entry.teacher_id) == (assign.major_id, assign.course_id, assign.teacher_id)
+                    and classroom is not None and (classroom.capacity or 0) >= (assign.expected_students or 0)
+                    and (assign.teacher_id, entry.timeslot_id, assign.semester_id) not in avoid)
+
+        if len(entries) > total_sessions or not all(entry_still_valid(entry) for entry in entries):
+            diff['modified'].append(aid)
+            diff['deleted_assignment_ids'].append(aid)
+            if total_sessions > 0: diff['sessions_to_place'][aid] = total_sessions
+            continue
+        diff['kept_entries'].extend(entries)
+        if len(entries) < total_sessions:
+            diff['incomplete'].append(aid)
+            diff['sessions_to_place'][aid] = total_sessions - len(entries)
+    return diff
+
+def place_assignment_sessions(timetable_state, assignment, sessions, all_data, current_semester):
+    """
+    在已有占用状态上为一个任务补排 sessions 个课时，沿用“同一时间段跨周重复”的排法：
+    每轮选出空闲周数最多的 (时间段, 教室)，按周次顺序排入，直到排满或再无空闲。
+    返回 (新课表条目列表, 未能排入的课时数)。
+    """
+    timeslot_ids, room_options = assignment_placement_options(timetable_state, assignment, all_data)
+    new_entries = []
+    while sessions > 0:
+        best = None
+        for ts_id in timeslot_ids:
+            classroom_id, free_weeks = best_room_for_timeslot(timetable_state, assignment, ts_id, room_options)
+            if len(free_weeks) and (best is None or len(free_weeks) > len(best[2])):
+                best = (ts_id, classroom_id, free_weeks)
+                if len(free_weeks) >= sessions: break  # 一个时间段即可排满
+        if best is None: break
+        ts_id, classroom_id, free_weeks = best
+        weeks = free_weeks[:sessions].tolist()
+        mark_slot_occupied(timetable_state, assignment.teacher_id, classroom_id, assignment.major_id, weeks, ts_id)
+        new_entries.extend(TimetableEntry(None, current_semester.id, assignment.major_id, assignment.course_id,
+                                          assignment.teacher_id, classroom_id, ts_id, week, assignment.id)
+                           for week in weeks)
+        sessions -= len(weeks)
+    return new_entries, sessions
+
+
+# ==================================
+# 7. 导出到 Excel 函数
 # ==================================
 def sanitize_sheet_name(name):
     name = re.sub(r'[\\/*?:"<>|\[\]]', '_', name)
     return name[:31]
 
-def format_semester_sheet_for_export(worksheet, total_weeks, periods_count):
-    if not OPENPYXL_AVAILABLE: return
+# --- 流式写出 ---
+# 工作簿以 openpyxl 的 write-only 模式创建：行写出后即落盘到临时文件，内存只保留当前工作表的课表格子。
+# 样式在每个工作簿中注册一次 (命名样式)，单元格只引用样式名；列宽与“周数”列的合并区域在写行之前算好，
+# 不再在写完后逐个单元格回头调整格式。
+EXPORT_DAY_ORDER = {'周一': 1, '周二': 2, '周三': 3, '周四': 4, '周五': 5, '周六': 6, '周日': 7}
+EXPORT_ROW_HEIGHT = 45
+EXPORT_INDEX_COLUMN_WIDTH = 8  # 周数、节次两列
+EXPORT_MIN_COLUMN_WIDTH = 15
+EXPORT_CELL_STYLE = 'timetable_cell'
+EXPORT_HEADER_STYLE = 'timetable_header'
+
+def register_export_styles(workbook):
+    thin_side = Side(border_style="thin", color="000000")
+    border = Border(left=thin_side, right=thin_side, top=thin_side, bottom=thin_side)
+    alignment = Alignment(wrap_text=True, vertical='center', horizontal='center')
+    workbook.add_named_style(NamedStyle(name=EXPORT_CELL_STYLE, alignment=alignment, border=border))
+    workbook.add_named_style(NamedStyle(name=EXPORT_HEADER_STYLE, alignment=alignment, border=border,
+                                        font=Font(bold=True)))
+
+def new_export_workbook():
+    workbook = openpyxl.Workbook(write_only=True)
+    register_export_styles(workbook)
+    return workbook
+
+def export_grid_layout(all_data):
+    """课表格子的列 (星期) 与行 (节次)，以及 时间段ID -> (星期序号, 节次序号)。"""
+    timeslots = all_data['timeslots'].values()
+    days = sorted({ts.day_of_week for ts in timeslots}, key=lambda d: EXPORT_DAY_ORDER.get(d, 8))
+    periods = sorted({ts.period for ts in timeslots})
+    day_index = {day: i for i, day in enumerate(days)}
+    period_index = {period: i for i, period in enumerate(periods)}
+    positions = {ts.id: (day_index[ts.day_of_week], period_index[ts.period]) for ts in timeslots}
+    return days, periods, positions
+
+def major_cell_text(entry, all_data):
+    course = all_data['courses'].get(entry.course_id)
+    teacher = all_data['teachers'].get(entry.teacher_id)
+    classroom = all_data['classrooms'].get(entry.classroom_id)
+    return f"{course.name if course else '?'}\n{teacher.name if teacher else '?'}\n@{classroom.name if classroom else '?'}"
+
+def teacher_cell_text(entry, all_data):
+    course = all_data['courses'].get(entry.course_id)
+    major = all_data['majors'].get(entry.major_id)
+    classroom = all_data['classrooms'].get(entry.classroom_id)
+    return f"{course.name if course else '?'}\n({major.name if major else '?'})\n@{classroom.name if classroom else '?'}"
+
+def export_text_width(text):
+    """按最长的一行估算列宽，中文字符按 1.8 个字符宽计算。"""
+    return max(sum(1.8 if '\u4e00' <= char <= '\u9fff' else 1 for char in line) for line in str(text).split('\n'))
+
+def semester_sheet_cells(entries, all_data, layout, total_weeks, cell_text_func):
+    """一张整学期课表的格子：(周次, 节次序号, 星期序号) -> 文本；同一格子有多个条目时保留最后一个。"""
+    _, _, positions = layout
+    cells = {}
+    for entry in entries:
+        position = positions.get(entry.timeslot_id)
+        if position is None or not 1 <= entry.week_number <= total_weeks: continue
+        day_idx, period_idx = position
+        cells[(entry.week_number, period_idx, day_idx)] = cell_text_func(entry, all_data)
+    return cells
+
+def write_semester_sheet(workbook, sheet_name, cells, layout, total_weeks):
+    """写出一张整学期课表：表头 (周数, 节次, 星期...)，每周 periods 行，“周数”列每周合并为一个单元格。"""
+    days, periods, _ = layout
+    widths = [export_text_width(day) for day in days]
+    for (_, _, day_idx), text in cells.items():
+        widths[day_idx] = max(widths[day_idx], export_text_width(text))
+
+    worksheet = workbook.create_sheet(sheet_name)
+    worksheet.sheet_format.defaultRowHeight = EXPORT_ROW_HEIGHT
+    worksheet.sheet_format.customHeight = True
+    worksheet.column_dimensions['A'].width = EXPORT_INDEX_COLUMN_WIDTH
+    worksheet.column_dimensions['B'].width = EXPORT_INDEX_COLUMN_WIDTH
+    for day_idx, width in enumerate(widths):
+        worksheet.column_dimensions[get_column_letter(day_idx + 3)].width = max(width + 4, EXPORT_MIN_COLUMN_WIDTH)
+    periods_count = len(periods)
+    if periods_count > 1:
+        for week in range(1, total_weeks + 1):
+            start_row = 2 + (week - 1) * periods_count
+            worksheet.merged_cells.add(f"A{start_row}:A{start_row + periods_count - 1}")
+
+    def cell(value, style=EXPORT_CELL_STYLE):
+        c = WriteOnlyCell(worksheet, value=value)
+        c.style = style
+        return c
+
+    worksheet.append([cell(title, EXPORT_HEADER_STYLE) for title in ['周数', '节次'] + days])
+    for week in range(1, total_weeks + 1):
+        for period_idx, period in enumerate(periods):
+            row = [cell(f"第 {week} 周" if period_idx == 0 else None), cell(period)]
+            row.extend(cell(cells.get((week, period_idx, day_idx))) for day_idx in range(len(days)))
+            worksheet.append(row)
+    return worksheet
+
+def write_message_sheet(workbook, sheet_name, values):
+    worksheet = workbook.create_sheet(sheet_name)
+    worksheet.append(values)
+    return worksheet
+
+def save_export_workbook(workbook):
+    output_buffer = io.BytesIO()
+    workbook.save(output_buffer)
+    output_buffer.seek(0)
+    return output_buffer
+
+def message_workbook(sheet_name, values):
+    workbook = new_export_workbook()
+    write_message_sheet(workbook, sheet_name, values)
+    return save_export_workbook(workbook)
+
+def export_error_workbook(error):
+    """生成失败时返回带错误信息的工作簿 (连它也写不出时返回空 BytesIO)。"""
+    print(f"SCHEDULER: 生成 Excel 文件时出错: {error}")
     try:
-        center_alignment = Alignment(wrap_text=True, vertical='center', horizontal='center')
-        thin_border_side = Side(border_style="thin", color="000000")
-        thin_border = Border(left=thin_border_side, right=thin_border_side, top=thin_border_side,
-                             bottom=thin_border_side)
-        header_font = Font(bold=True)
-
-        for col_idx, column_cells in enumerate(worksheet.columns):
-            if col_idx < 2: continue # Skip '周数' and '节次' columns for width calculation
-            max_length = 0
-            column_letter = get_column_letter(column_cells[0].column)
-            for cell in column_cells:
-                if cell.value:
-                    try:
-                        # Consider text wrapping for length calculation
-                        lines = str(cell.value).split('\n')
-                        # Heuristic: Estimate width based on characters per line
-                        # Adjust multiplier based on typical font; 1.8 for CJK, 1 for others might be too simple
-                        # Let's try a simpler approach: max length of any line + buffer
-                        cell_len = max(len(line) for line in lines) if lines else 0
-                        # Give more weight to CJK chars maybe? Or just use a fixed multiplier for max line len?
-                        # Example: Max line length * 1.2 + 2? Experiment needed.
-                        # Let's stick to a simpler max char count + buffer for now.
-                        max_line_len = 0
-                        for line in lines:
-                             line_len = sum(1.8 if '\u4e00' <= char <= '\u9fff' else 1 for char in line)
-                             if line_len > max_line_len:
-                                 max_line_len = line_len
-
-                        if max_line_len > max_length: max_length = max_line_len
-                    except:
-                        pass # Ignore errors during length calculation
-
-            # Set width: baseline + calculated length + some padding
-            adjusted_width = max(max_length + 4, 15) # Min width 15, add padding
-            worksheet.column_dimensions[column_letter].width = adjusted_width
-
-
-        worksheet.column_dimensions['A'].width = 8  # 周数
-        worksheet.column_dimensions['B'].width = 8  # 节次
-
-        header_rows = 1 # Assuming 1 header row for MultiIndex
-        # Apply styles to all cells
-        for row in worksheet.iter_rows():
-             for cell in row:
-                 cell.alignment = center_alignment
-                 cell.border = thin_border
-                 # Set default row height (might need adjustment based on content)
-                 worksheet.row_dimensions[cell.row].height = 45
-
-        # Style the header row specifically (row 1 for MultiIndex level 0)
-        # And potentially row 2 for level 1 if MultiIndex headers are split
-        # Check how pandas writes MultiIndex headers to be sure
-        # Assuming headers are in row 1 and maybe 2
-        for col_cell in worksheet[1]: # First row (days)
-             col_cell.font = header_font
-        if worksheet.max_row >= 2: # If multi-index headers span two rows
-             for col_cell in worksheet[2]:
-                 col_cell.font = header_font # Apply to second header row too if needed
-
-        # Apply header font to index names (周数, 节次) - these are usually in specific cells
-        # Check where pandas places them. Typically A1, B1 or A2, B2 etc.
+        return message_workbook("错误", ["生成Excel时出错:", str(error)])
+    except Exception as inner_e:
+        print(f"SCHEDULER: 写入Excel错误信息时也出错: {inner_e}")
+        return io.BytesIO()
+
+# --- 整学期导出：多张工作表并行生成 ---
+# 每张表在进程池中写成一个只含该表的工作簿 (分片)。openpyxl 写出的字符串是内联的，
+# 各分片注册相同的样式且使用顺序相同 (表头、普通单元格)，因此工作表 XML 自成一体、样式编号一致：
+# 合并为一个工作簿时，只需把各分片的工作表 XML 放进同样表名的骨架工作簿；打包为 ZIP 时分片直接作为文件。
+EXPORT_SCOPES = ('all', 'majors', 'teachers')
+EXPORT_PARALLEL_MIN_SHEETS = 8  # 表数少于此值时在当前进程中生成 (进程池启动开销大于收益)
+EXPORT_BATCHES_PER_WORKER = 4
+
+def semester_export_sheets(schedule_entries, all_data, layout, total_weeks, scope='all'):
+    """整学期导出的各张表 [(表名, 格子)]：先专业后教师，各按名称排序。"""
+    schedule_by_major = defaultdict(list)
+    schedule_by_teacher = defaultdict(list)
+    for entry in schedule_entries:
+        schedule_by_major[entry.major_id].append(entry)
+        schedule_by_teacher[entry.teacher_id].append(entry)
+
+    sheets = []
+    if scope in ('all', 'majors'):
+        for major_id in sorted(schedule_by_major, key=lambda mid: all_data['majors'].get(mid, Major(id=mid, name=f"UnknownMajor{mid}")).name):
+            major = all_data['majors'].get(major_id)
+            sheets.append((sanitize_sheet_name(f"专业_{major.name if major else f'专业ID_{major_id}'}"),
+                           semester_sheet_cells(schedule_by_major[major_id], all_data, layout, total_weeks, major_cell_text)))
+    if scope in ('all', 'teachers'):
+        for teacher_id in sorted(schedule_by_teacher, key=lambda tid: all_data['teachers'].get(tid, Teacher(id=tid, user_id=None, name=f"UnknownTeacher{tid}")).name):
+            teacher = all_data['teachers'].get(teacher_id)
+            sheets.append((sanitize_sheet_name(f"教师_{teacher.name if teacher else f'教师ID_{teacher_id}'}"),
+                           semester_sheet_cells(schedule_by_teacher[teacher_id], all_data, layout, total_weeks, teacher_cell_text)))
+    return sheets
+
+def render_sheet_parts(sheets, layout, total_weeks):
+    """把每张表写成一个单表工作簿，返回 xlsx 字节列表 (进程池任务)。"""
+    parts = []
+    for sheet_name, cells in sheets:
+        workbook = new_export_workbook()
+        write_semester_sheet(workbook, sheet_name, cells, layout, total_weeks)
+        parts.append(save_export_workbook(workbook).getvalue())
+    return parts
+
+def render_sheet_parts_in_parallel(sheets, layout, total_weeks, max_workers=None):
+    worker_count = min(max_workers or os.cpu_count() or 1, len(sheets))
+    if worker_count > 1 and len(sheets) >= EXPORT_PARALLEL_MIN_SHEETS:
+        batch_size = math.ceil(len(sheets) / (worker_count * EXPORT_BATCHES_PER_WORKER))
+        batches = [sheets[i:i + batch_size] for i in range(0, len(sheets), batch_size)]
         try:
-            # Assuming index names are at the start of the header rows
-             worksheet['A1'].font = header_font # 周数
-             worksheet['B1'].font = header_font # 节次
-             # If MultiIndex headers shift things, adjust accordingly
-        except Exception:
-             pass # Ignore if cells don't exist or indexing is different
-
-        # Merge '周数' column cells
-        if total_weeks > 0 and periods_count > 0:
-            # Need to account for header rows when calculating merge range
-            start_header_row = 1 # Row where the actual data starts (after headers)
-            # Find the actual first row of data (where index starts)
-            # This depends on how pandas writes the multi-index. Let's assume 2 header rows.
-            first_data_row = 3
-            if worksheet.cell(row=1, column=1).value == "周数": first_data_row = 2 # If index names are on row 1
-            if worksheet.cell(row=2, column=1).value == "周数": first_data_row = 3 # If index names are on row 2
-
-            for week in range(1, total_weeks + 1):
-                start_row = first_data_row + (week - 1) * periods_count
-                end_row = start_row + periods_count - 1
-
-                if start_row <= worksheet.max_row and end_row <= worksheet.max_row and start_row <= end_row:
-                    try:
-                        # Check if already merged: openpyxl raises ValueError if trying to merge over existing merges
-                        is_merged = False
-                        cell_coord = f"A{start_row}"
-                        for merged_range in worksheet.merged_cells.ranges:
-                            if cell_coord in merged_range:
-                                is_merged = True
-                                break
-                        if not is_merged:
-                             worksheet.merge_cells(start_row=start_row, start_column=1, end_row=end_row, end_column=1)
-                             merged_cell = worksheet.cell(row=start_row, column=1)
-                             merged_cell.value = f"第 {week} 周"
-                             merged_cell.alignment = center_alignment
-                             # merged_cell.font = header_font # Optional: make week number bold
-                             merged_cell.border = thin_border # Ensure border is applied to merged cell
-                        else:
-                             # If already merged, just ensure value and style (might be needed if file is regenerated)
-                             merged_cell = worksheet.cell(row=start_row, column=1)
-                             if merged_cell.value != f"第 {week} 周": merged_cell.value = f"第 {week} 周"
-                             merged_cell.alignment = center_alignment
-                             # merged_cell.font = header_font
-                             merged_cell.border = thin_border
-
-
-                    except ValueError as merge_error:
-                        # print(f"SCHEDULER: 警告：尝试合并单元格 (周数 {week}, 行 {start_row}-{end_row}) 时出错: {merge_error}. 可能已合并?")
-                        # If merge fails, at least set the value in the first cell
-                        first_cell = worksheet.cell(row=start_row, column=1)
-                        if first_cell.value != f"第 {week} 周": first_cell.value = f"第 {week} 周"
-                        first_cell.alignment = center_alignment
-                        # first_cell.font = header_font
-                        first_cell.border = thin_border
-
-                    except Exception as merge_e:
-                         print(f"SCHEDULER: 警告：合并单元格 (周数 {week}) 时发生未知错误: {merge_e}")
-                         # Fallback: set value in the first cell
-                         first_cell = worksheet.cell(row=start_row, column=1)
-                         if first_cell.value != f"第 {week} 周": first_cell.value = f"第 {week} 周"
-                         first_cell.alignment = center_alignment
-                         # first_cell.font = header_font
-                         first_cell.border = thin_border
-
-    except Exception as format_e:
-        print(f"SCHEDULER: 警告：在调整工作表 '{worksheet.title}' 格式时发生错误: {format_e}")
-        # import traceback; traceback.print_exc() # Debugging help
+            with ProcessPoolExecutor(max_workers=worker_count) as executor:
+                futures = [executor.submit(render_sheet_parts, batch, layout, total_weeks) for batch in batches]
+                return [part for future in futures for part in future.result()]
+        except (BrokenProcessPool, OSError) as pool_error:
+            print(f"SCHEDULER: 警告：进程池不可用 ({pool_error})，改为在当前进程中依次生成工作表。")
+    return render_sheet_parts(sheets, layout, total_weeks)
+
+def assemble_sheet_parts(sheet_names, parts):
+    """把单表分片合并为一个工作簿：骨架工作簿提供表名与目录，工作表 XML 与样式取自分片。"""
+    skeleton = new_export_workbook()
+    for sheet_name in sheet_names:
+        skeleton.create_sheet(sheet_name)  # 重名时 openpyxl 自动改名
+    skeleton_buffer = save_export_workbook(skeleton)
+
+    replacements = {}
+    for index, part in enumerate(parts, start=1):
+        with zipfile.ZipFile(io.BytesIO(part)) as part_zip:
+            replacements[f"xl/worksheets/sheet{index}.xml"] = part_zip.read("xl/worksheets/sheet1.xml")
+            if index == 1:
+                replacements["xl/styles.xml"] = part_zip.read("xl/styles.xml")
+
+    output_buffer = io.BytesIO()
+    with zipfile.ZipFile(skeleton_buffer) as source, \
+            zipfile.ZipFile(output_buffer, 'w', zipfile.ZIP_DEFLATED) as target:
+        for item in source.infolist():
+            target.writestr(item.filename, replacements.pop(item.filename, None) or source.read(item.filename))
+    output_buffer.seek(0)
+    return output_buffer
+
+def zip_sheet_parts(sheet_names, parts):
+    """把单表分片打包为 ZIP，每张表一个 .xlsx 文件。"""
+    output_buffer = io.BytesIO()
+    used_names = Counter()
+    with zipfile.ZipFile(output_buffer, 'w', zipfile.ZIP_STORED) as target:  # xlsx 本身已压缩
+        for sheet_name, part in zip(sheet_names, parts):
+            used_names[sheet_name] += 1
+            suffix = f"_{used_names[sheet_name]}" if used_names[sheet_name] > 1 else ""
+            target.writestr(f"{sheet_name}{suffix}.xlsx", part)
+    output_buffer.seek(0)
+    return output_buffer
+
+def generate_semester_export(schedule_entries, all_data, semester, scope='all', as_zip=False, max_workers=None):
+    """
+    整学期导出，返回 BytesIO：scope 为 all (每个专业、每个教师各一张表)、majors 或 teachers；
+    as_zip=True 时返回每张表一个 .xlsx 的 ZIP，否则为一个工作簿。各表在进程池中并行生成。
+    """
+    if not OPENPYXL_AVAILABLE:
+        raise ImportError("缺少 openpyxl 库，无法导出 Excel 课表。")
+    if scope not in EXPORT_SCOPES:
+        raise ValueError(f"不支持的导出范围: {scope}")
+    try:
+        if semester.total_weeks <= 0:
+            print("SCHEDULER: 错误：学期总周数无效，无法生成学期课表。")
+            sheet_names, parts = ["错误"], [message_workbook("错误", ["学期总周数无效，无法生成课表"]).getvalue()]
+        elif not schedule_entries:
+            sheet_names, parts = ["无数据"], [message_workbook("无数据", ["没有排课数据可导出。"]).getvalue()]
+        else:
+            layout = export_grid_layout(all_data)
+            sheets = semester_export_sheets(schedule_entries, all_data, layout, semester.total_weeks, scope)
+            sheet_names = [sheet_name for sheet_name, _ in sheets]
+            if len(sheets) == 1 or (not as_zip and len(sheets) < EXPORT_PARALLEL_MIN_SHEETS):
+                # 表少时直接写一个工作簿，省去分片与合并
+                workbook = new_export_workbook()
+                for sheet_name, cells in sheets:
+                    write_semester_sheet(workbook, sheet_name, cells, layout, semester.total_weeks)
+                if not as_zip:
+                    return save_export_workbook(workbook)
+                parts = [save_export_workbook(workbook).getvalue()]
+            else:
+                parts = render_sheet_parts_in_parallel(sheets, layout, semester.total_weeks, max_workers)
+        if as_zip:
+            return zip_sheet_parts(sheet_names, parts)
+        return io.BytesIO(parts[0]) if len(parts) == 1 else assemble_sheet_parts(sheet_names, parts)
+    except Exception as e:
+        return export_error_workbook(e)
 
 def generate_excel_report_for_send_file(schedule_entries, all_data, semester,
                                         target_major_id=None, target_teacher_id=None):
+    """
+    生成学期课表 Excel，返回 BytesIO：指定专业或教师时只有该专业/教师一张表，
+    否则每个专业、每个教师各一张表 (见 generate_semester_export)。没有数据时返回只有一条提示的工作簿。
+    """
     if not OPENPYXL_AVAILABLE:
         raise ImportError("缺少 openpyxl 库，无法导出 Excel 课表。")
-
-    # Handle cases where there's absolutely no data or filter yields nothing
-    create_empty_excel = False
-    empty_message = "没有排课数据可导出。"
-    if not schedule_entries:
-        create_empty_excel = True
-        if target_major_id:
-            major_info = all_data['majors'].get(target_major_id)
-            major_name = major_info.name if major_info else f"专业ID_{target_major_id}"
-            empty_message = f"专业 '{major_name}' 没有排课数据。"
-        elif target_teacher_id:
-            teacher_info = all_data['teachers'].get(target_teacher_id)
-            teacher_name = teacher_info.name if teacher_info else f"教师ID_{target_teacher_id}"
-            empty_message = f"教师 '{teacher_name}' 没有排课数据。"
-    elif target_major_id and not any(e.major_id == target_major_id for e in schedule_entries):
-         create_empty_excel = True
-         major_info = all_data['majors'].get(target_major_id)
-         major_name = major_info.name if major_info else f"专业ID_{target_major_id}"
-         empty_message = f"专业 '{major_name}' 没有找到符合条件的排课数据。"
-    elif target_teacher_id and not any(e.teacher_id == target_teacher_id for e in schedule_entries):
-         create_empty_excel = True
-         teacher_info = all_data['teachers'].get(target_teacher_id)
-         teacher_name = teacher_info.name if teacher_info else f"教师ID_{target_teacher_id}"
-         empty_message = f"教师 '{teacher_name}' 没有找到符合条件的排课数据。"
-
-
-    if create_empty_excel:
-        output_buffer_empty = io.BytesIO()
-        try:
-            with pd.ExcelWriter(output_buffer_empty, engine='openpyxl') as writer_empty:
-                df_empty = pd.DataFrame([[empty_message]])
-                df_empty.to_excel(writer_empty, sheet_name="无数据", index=False, header=False)
-                # Format the single cell? Maybe not necessary.
-            output_buffer_empty.seek(0)
-        except Exception as empty_excel_e:
-            print(f"SCHEDULER: 生成空 Excel 文件时出错: {empty_excel_e}")
-            return io.BytesIO() # Return truly empty buffer on error
-        return output_buffer_empty
-
-
-    # print(f"SCHEDULER: 开始生成 Excel 报告...")
-    output_buffer = io.BytesIO()
+    if not target_major_id and not target_teacher_id:
+        return generate_semester_export(schedule_entries, all_data, semester)
+
+    if target_major_id:
+        major_info = all_data['majors'].get(target_major_id)
+        entity_name = major_info.name if major_info else f"专业ID_{target_major_id}"
+        sheet_name = sanitize_sheet_name(f"专业_{entity_name}")
+        filtered_entries = [e for e in schedule_entries if e.major_id == target_major_id]
+        cell_text_func = major_cell_text
+        empty_message = f"专业 '{entity_name}' 没有排课数据。" if not schedule_entries else \
+            f"专业 '{entity_name}' 没有找到符合条件的排课数据。"
+    else:
+        teacher_info = all_data['teachers'].get(target_teacher_id)
+        entity_name = teacher_info.name if teacher_info else f"教师ID_{target_teacher_id}"
+        sheet_name = sanitize_sheet_name(f"教师_{entity_name}")
+        filtered_entries = [e for e in schedule_entries if e.teacher_id == target_teacher_id]
+        cell_text_func = teacher_cell_text
+        empty_message = f"教师 '{entity_name}' 没有排课数据。" if not schedule_entries else \
+            f"教师 '{entity_name}' 没有找到符合条件的排课数据。"
+
+    if not filtered_entries:
+        return message_workbook("无数据", [empty_message])
     try:
-        with pd.ExcelWriter(output_buffer, engine='openpyxl') as writer:
-            timeslots = sorted(all_data['timeslots'].values(), key=lambda t: (t.day_of_week, t.period))
-            day_map = {'周一': 1, '周二': 2, '周三': 3, '周四': 4, '周五': 5, '周六': 6, '周日': 7}
-            periods = sorted(list(set(t.period for t in timeslots)))
-            days = sorted(list(set(t.day_of_week for t in timeslots)), key=lambda d: day_map.get(d, 8))
-            total_weeks = semester.total_weeks
-
-            if total_weeks <= 0:
-                print("SCHEDULER: 错误：学期总周数无效，无法生成学期课表。")
-                df_error = pd.DataFrame([["学期总周数无效，无法生成课表"]])
-                df_error.to_excel(writer, sheet_name="错误", index=False, header=False)
-                output_buffer.seek(0)
-                return output_buffer
-
-            periods_count = len(periods)
-            all_defined_days = sorted(list(set(ts.day_of_week for ts in all_data['timeslots'].values())), key=lambda d: day_map.get(d, 8))
-            if len(days) != len(all_defined_days): days = all_defined_days
-
-            # Filter entries based on target_major_id or target_teacher_id *before* processing
-            filtered_entries = schedule_entries
-            entity_name = None # Store name for sheet naming
-
-            if target_major_id:
-                filtered_entries = [e for e in schedule_entries if e.major_id == target_major_id]
-                major_info = all_data['majors'].get(target_major_id)
-                entity_name = major_info.name if major_info else f"专业ID_{target_major_id}"
-            elif target_teacher_id:
-                filtered_entries = [e for e in schedule_entries if e.teacher_id == target_teacher_id]
-                teacher_info = all_data['teachers'].get(target_teacher_id)
-                entity_name = teacher_info.name if teacher_info else f"教师ID_{target_teacher_id}"
-
-            # If after filtering, no entries remain (this check is redundant if handled above, but safe)
-            if not filtered_entries and (target_major_id or target_teacher_id):
-                 # This case should have been handled by create_empty_excel logic
-                 print("SCHEDULER: 逻辑错误 - 筛选后无数据，但未生成空Excel。")
-                 return io.BytesIO() # Return empty
-
-            # --- Generate Sheet(s) ---
-            if target_major_id:
-                # Generate single sheet for the major
-                df_major_semester = pd.DataFrame(
-                    index=pd.MultiIndex.from_product([range(1, total_weeks + 1), periods], names=['周数', '节次']),
-                    columns=days
-                ).fillna('')
-                for entry in filtered_entries:
-                    ts = all_data['timeslots'].get(entry.timeslot_id)
-                    if not ts or ts.day_of_week not in days or ts.period not in periods: continue
-                    course = all_data['courses'].get(entry.course_id)
-                    teacher = all_data['teachers'].get(entry.teacher_id)
-                    classroom = all_data['classrooms'].get(entry.classroom_id)
-                    cell_text = f"{course.name if course else '?'}\n{teacher.name if teacher else '?'}\n@{classroom.name if classroom else '?'}"
-                    if (entry.week_number, ts.period) in df_major_semester.index and ts.day_of_week in df_major_semester.columns:
-                         df_major_semester.loc[(entry.week_number, ts.period), ts.day_of_week] = cell_text
-
-                sheet_name = sanitize_sheet_name(f"专业_{entity_name}")
-                df_major_semester.to_excel(writer, sheet_name=sheet_name, merge_cells=False)
-                worksheet = writer.sheets[sheet_name]
-                format_semester_sheet_for_export(worksheet, total_weeks, periods_count)
-
-            elif target_teacher_id:
-                # Generate single sheet for the teacher
-                df_teacher_semester = pd.DataFrame(
-                    index=pd.MultiIndex.from_product([range(1, total_weeks + 1), periods], names=['周数', '节次']),
-                    columns=days
-                ).fillna('')
-                for entry in filtered_entries:
-                    ts = all_data['timeslots'].get(entry.timeslot_id)
-                    if not ts or ts.day_of_week not in days or ts.period not in periods: continue
-                    course = all_data['courses'].get(entry.course_id)
-                    major = all_data['majors'].get(entry.major_id)
-                    classroom = all_data['classrooms'].get(entry.classroom_id)
-                    cell_text = f"{course.name if course else '?'}\n({major.name if major else '?'})\n@{classroom.name if classroom else '?'}"
-                    if (entry.week_number, ts.period) in df_teacher_semester.index and ts.day_of_week in df_teacher_semester.columns:
-                         df_teacher_semester.loc[(entry.week_number, ts.period), ts.day_of_week] = cell_text
-
-                sheet_name = sanitize_sheet_name(f"教师_{entity_name}")
-                df_teacher_semester.to_excel(writer, sheet_name=sheet_name, merge_cells=False)
-                worksheet = writer.sheets[sheet_name]
-                format_semester_sheet_for_export(worksheet, total_weeks, periods_count)
-
-            else:  # Full semester report (all majors AND all teachers sheets)
-                # A. 专业课表 (One sheet per major involved)
-                schedule_by_major = defaultdict(list)
-                involved_major_ids = sorted(list(set(entry.major_id for entry in filtered_entries)), key=lambda mid: all_data['majors'].get(mid, Major(id=mid, name=f"UnknownMajor{mid}")).name)
-                for entry in filtered_entries: schedule_by_major[entry.major_id].append(entry)
-
-                for major_id_iter in involved_major_ids:
-                    major_schedule = schedule_by_major[major_id_iter]
-                    major_info_iter = all_data['majors'].get(major_id_iter)
-                    major_name_iter = major_info_iter.name if major_info_iter else f"专业ID_{major_id_iter}"
-                    df_major_semester = pd.DataFrame(
-                        index=pd.MultiIndex.from_product([range(1, total_weeks + 1), periods], names=['周数', '节次']),
-                        columns=days
-                    ).fillna('')
-                    for entry in major_schedule:
-                        ts = all_data['timeslots'].get(entry.timeslot_id)
-                        if not ts or ts.day_of_week not in days or ts.period not in periods: continue
-                        course = all_data['courses'].get(entry.course_id)
-                        teacher = all_data['teachers'].get(entry.teacher_id)
-                        classroom = all_data['classrooms'].get(entry.classroom_id)
-                        cell_text = f"{course.name if course else '?'}\n{teacher.name if teacher else '?'}\n@{classroom.name if classroom else '?'}"
-                        if (entry.week_number, ts.period) in df_major_semester.index and ts.day_of_week in df_major_semester.columns:
-                            df_major_semester.loc[(entry.week_number, ts.period), ts.day_of_week] = cell_text
-
-                    sheet_name_major = sanitize_sheet_name(f"专业_{major_name_iter}")
-                    df_major_semester.to_excel(writer, sheet_name=sheet_name_major, merge_cells=False)
-                    worksheet_major = writer.sheets[sheet_name_major]
-                    format_semester_sheet_for_export(worksheet_major, total_weeks, periods_count)
-
-                # B. 教师课表 (One sheet per teacher involved)
-                schedule_by_teacher = defaultdict(list)
-                involved_teacher_ids = sorted(list(set(entry.teacher_id for entry in filtered_entries)), key=lambda tid: all_data['teachers'].get(tid, Teacher(id=tid, user_id=None, name=f"UnknownTeacher{tid}")).name)
-                for entry in filtered_entries: schedule_by_teacher[entry.teacher_id].append(entry)
-
-                for teacher_id_iter in involved_teacher_ids:
-                    teacher_schedule = schedule_by_teacher[teacher_id_iter]
-                    teacher_info_iter = all_data['teachers'].get(teacher_id_iter)
-                    teacher_name_iter = teacher_info_iter.name if teacher_info_iter else f"教师ID_{teacher_id_iter}"
-                    df_teacher_semester = pd.DataFrame(
-                        index=pd.MultiIndex.from_product([range(1, total_weeks + 1), periods], names=['周数', '节次']),
-                        columns=days
-                    ).fillna('')
-                    for entry in teacher_schedule:
-                        ts = all_data['timeslots'].get(entry.timeslot_id)
-                        if not ts or ts.day_of_week not in days or ts.period not in periods: continue
-                        course = all_data['courses'].get(entry.course_id)
-                        major = all_data['majors'].get(entry.major_id)
-                        classroom = all_data['classrooms'].get(entry.classroom_id)
-                        cell_text = f"{course.name if course else '?'}\n({major.name if major else '?'})\n@{classroom.name if classroom else '?'}"
-                        if (entry.week_number, ts.period) in df_teacher_semester.index and ts.day_of_week in df_teacher_semester.columns:
-                            df_teacher_semester.loc[(entry.week_number, ts.period), ts.day_of_week] = cell_text
-
-                    sheet_name_teacher = sanitize_sheet_name(f"教师_{teacher_name_iter}")
-                    df_teacher_semester.to_excel(writer, sheet_name=sheet_name_teacher, merge_cells=False)
-                    worksheet_teacher = writer.sheets[sheet_name_teacher]
-                    format_semester_sheet_for_export(worksheet_teacher, total_weeks, periods_count)
-
-        # End of 'with pd.ExcelWriter' block, file is saved to buffer here
-        output_buffer.seek(0)
-        # print(f"SCHEDULER: Excel 报告生成完毕。")
-        return output_buffer
-
+        total_weeks = semester.total_weeks
+        if total_weeks <= 0:
+            print("SCHEDULER: 错误：学期总周数无效，无法生成学期课表。")
+            return message_workbook("错误", ["学期总周数无效，无法生成课表"])
+        layout = export_grid_layout(all_data)
+        workbook = new_export_workbook()
+        write_semester_sheet(workbook, sheet_name,
+                             semester_sheet_cells(filtered_entries, all_data, layout, total_weeks, cell_text_func),
+                             layout, total_weeks)
+        return save_export_workbook(workbook)
     except Exception as e:
-        print(f"SCHEDULER: 生成 Excel 文件时出错: {e}")
-        # import traceback; traceback.print_exc() # For debugging
-        # Try to return a buffer with an error message
-        error_output = io.BytesIO()
-        try:
-             with pd.ExcelWriter(error_output, engine='openpyxl') as writer_error:
-                 pd.DataFrame([["生成Excel时出错:", str(e)]]).to_excel(writer_error, sheet_name="错误", index=False, header=False)
-             error_output.seek(0)
-        except Exception as inner_e:
-             print(f"SCHEDULER: 写入Excel错误信息时也出错: {inner_e}")
-             return io.BytesIO() # Return empty buffer if even error logging fails
-        return error_output # Return buffer with error message
+        return export_error_workbook(e)
 
 
 # ==================================
 # 8. 数据库操作函数 (保持不变)
 # ==================================
+# --- 课表存储：每个放置 (任务, 时间段, 教室) 一行，weeks 为周次集合 ---
+# timetable_entries 只保存单周的例外/手动安排 (包括旧版本按周逐行保存的数据)，
+# 读取时通过视图 timetable_entries_expanded 展开为“每周一行”的形式；
+# 按周查询使用 timetable_entries_for_week()，其中 weeks @> ARRAY[周次] 走 GIN 索引。
+# 两张表都按 semester_id 做 LIST 分区，每个学期一个分区 (<表名>_s<学期ID>)：所有读取都带 semester_id 条件，
+# 规划器只扫描一个分区。管理员清空学期课表 (DELETE /api/timetables/semester/<id>) 通过 TRUNCATE 分区完成
+# (见 clear_db_for_semester，只短暂锁住该学期的分区)；排课后的整体替换在一个事务内按行删除/写入
+# (见 replace_semester_schedule，不对父表或分区做 DDL，读者不受影响)。
+# 冲突由数据库保证：两张表上的触发器把每个放置的每一周、每个单周条目写入按周展开的占用表 timetable_occupancy，
+# 其唯一约束拒绝同一周同一时间段内教师/教室/专业的重复安排；占用表同样按学期分区。
+# 表、索引、视图与函数的定义见 migrations/ (0003、0004、0013)。
+
+TIMETABLE_PARTITIONED_TABLES = ('timetable_entries', 'timetable_placements')
+TIMETABLE_OCCUPANCY_TABLE = 'timetable_occupancy'  # 由触发器维护，与课表分区一起创建和清空
+
+def semester_partition_name(table, semester_id):
+    return f"{table}_s{int(semester_id)}"
+
+def _relation_exists(cur, name):
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+    return cur.fetchone()[0]
+
+def ensure_semester_partitions(cur, semester_id):
+    """确保学期在两张课表表及占用表中都有分区 (已存在时不加锁、不做任何操作)。"""
+    for table in TIMETABLE_PARTITIONED_TABLES + (TIMETABLE_OCCUPANCY_TABLE,):
+        partition = semester_partition_name(table, semester_id)
+        if not _relation_exists(cur, partition):
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {table} FOR VALUES IN ({int(semester_id)})")
+
+def _count_semester_rows(cur, semester_id):
+    total = 0
+    for table in TIMETABLE_PARTITIONED_TABLES:
+        partition = semester_partition_name(table, semester_id)
+        if _relation_exists(cur, partition):
+            cur.execute(f"SELECT count(*) FROM {partition}")
+            total += cur.fetchone()[0]
+    return total
+
+def iter_placements(schedule_entries):
+    """把逐周的排课条目按 (任务, 时间段, 教室) 合并为放置，逐个产出 (代表条目, 升序周次列表)。"""
+    placements = {}
+    for e in schedule_entries:
+        key = (e.semester_id, e.assignment_id, e.timeslot_id, e.classroom_id)
+        if key in placements:
+            placements[key][1].append(e.week_number)
+        else:
+            placements[key] = (e, [e.week_number])
+    for entry, weeks in placements.values():
+        yield entry, sorted(set(weeks))
+
+# --- COPY 流式写入 ---
+# 放置行由生成器逐行编码，经 _CopyRowStream 按 COPY 的读取块大小拉取，不会在内存中拼出整批 SQL 或数据。
+PLACEMENT_COPY_COLUMNS = ('semester_id', 'major_id', 'course_id', 'teacher_id', 'classroom_id', 'timeslot_id',
+                          'weeks', 'assignment_id')
+COPY_FORMATS = ('text', 'binary')
+_PG_INT4_OID = 23
+COPY_READ_SIZE = 64 * 1024  # copy_expert 每次从流中读取的字节数
+_PGCOPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+
+class _CopyRowStream(io.RawIOBase):
+    """把产出 bytes 的迭代器包装为 copy_expert 所需的只读文件对象。"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        # 尽量填满 target (COPY 每次读取 COPY_READ_SIZE 字节)，避免每行一次读取
+        filled = 0
+        while filled < len(target):
+            if not self._buffer:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                self._buffer = chunk
+            size = min(len(target) - filled, len(self._buffer))
+            target[filled:filled + size] = self._buffer[:size]
+            self._buffer = self._buffer[size:]
+            filled += size
+        return filled
+
+def _placement_row_values(entry, weeks):
+    return (entry.semester_id, entry.major_id, entry.course_id, entry.teacher_id, entry.classroom_id,
+            entry.timeslot_id, weeks, entry.assignment_id)
+
+def _encode_copy_text(placements, counter):
+    for entry, weeks in placements:
+        values = _placement_row_values(entry, weeks)
+        counter[0] += 1
+        yield ("\t".join("{" + ",".join(map(str, v)) + "}" if isinstance(v, list) else str(int(v)) for v in values)
+               + "\n").encode('ascii')
+
+def _encode_copy_binary(placements, counter):
+    yield _PGCOPY_SIGNATURE + struct.pack('!ii', 0, 0)
+    field_count = len(PLACEMENT_COPY_COLUMNS)
+    for entry, weeks in placements:
+        parts = [struct.pack('!h', field_count)]
+        for v in _placement_row_values(entry, weeks):
+            if isinstance(v, list):
+                # 一维 int4 数组：维数、是否含 NULL、元素类型、(长度, 下界)，然后每个元素 (长度 4, 值)
+                array = struct.pack('!iiIii', 1, 0, _PG_INT4_OID, len(v), 1) + b''.join(
+                    struct.pack('!ii', 4, int(w)) for w in v)
+                parts.append(struct.pack('!i', len(array)) + array)
+            else:
+                parts.append(struct.pack('!ii', 4, int(v)))
+        counter[0] += 1
+        yield b''.join(parts)
+    yield struct.pack('!h', -1)
+
+def copy_placements(cur, schedule_entries, copy_format='text', table='timetable_placements'):
+    """
+    用 COPY <table> FROM STDIN 流式写入放置行 (text 或 binary 格式)，table 默认为 timetable_placements，
+    也可以是列结构相同的暂存表。返回 (写入行数, 耗时秒数)。
+    """
+    if copy_format not in COPY_FORMATS:
+        raise ValueError(f"不支持的 COPY 格式: {copy_format}")
+    counter = [0]
+    encoder = _encode_copy_binary if copy_format == 'binary' else _encode_copy_text
+    stream = _CopyRowStream(encoder(iter_placements(schedule_entries), counter))
+    started = time.monotonic()
+    cur.copy_expert(f"COPY {table} ({', '.join(PLACEMENT_COPY_COLUMNS)}) FROM STDIN"
+                    + (" WITH (FORMAT binary)" if copy_format == 'binary' else ""), stream, size=COPY_READ_SIZE)
+    return counter[0], time.monotonic() - started
+
+def _rows_per_second(rows, seconds):
+    return round(rows / seconds, 1) if seconds > 0 else float(rows)
+
+def _insert_placements(cur, schedule_entries, copy_format='text'):
+    if not schedule_entries: return 0
+    inserted_count, seconds = copy_placements(cur, schedule_entries, copy_format)
+    print(f"SCHEDULER: COPY 写入 {inserted_count} 条放置记录，用时 {seconds:.3f} 秒 "
+          f"({_rows_per_second(inserted_count, seconds)} 行/秒)。")
+    return inserted_count
+
+def bump_timetable_version(cur, semester_id):
+    """
+    学期课表版本号加一 (migrations/0010)。INSERT/UPDATE/DELETE 由触发器处理；
+    TRUNCATE 分区不经过父表的触发器，需在同一事务中调用本函数。
+    """
+    cur.execute("""
+        INSERT INTO timetable_versions (semester_id) VALUES (%s)
+        ON CONFLICT (semester_id) DO UPDATE SET version = timetable_versions.version + 1
+    """, (semester_id,))
+
 def clear_db_for_semester(semester_id, get_connection_func):
+    """
+    清空学期课表：直接 TRUNCATE 该学期的分区 (不逐行删除)，返回 (True, 清除的记录数)。
+    TRUNCATE 需要分区上的 ACCESS EXCLUSIVE 锁，只阻塞该学期的读写，且只持有到提交 (TRUNCATE 本身与行数无关)。
+    """
     conn = None
     cur = None
     try:
         conn = get_connection_func()
         cur = conn.cursor()
         # print(f"SCHEDULER: 正在清空数据库中 学期 ID={semester_id} 的旧排课记录...")
-        delete_query = "DELETE FROM timetable_entries WHERE semester_id = %s"
-        cur.execute(delete_query, (semester_id,))
-        deleted_count = cur.rowcount
+        deleted_count = _count_semester_rows(cur, semester_id)
+        # TRUNCATE 不触发占用表的同步触发器，占用表的分区一起清空
+        partitions = [semester_partition_name(table, semester_id)
+                      for table in TIMETABLE_PARTITIONED_TABLES + (TIMETABLE_OCCUPANCY_TABLE,)]
+        partitions = [name for name in partitions if _relation_exists(cur, name)]
+        if partitions:
+            cur.execute(f"TRUNCATE {', '.join(partitions)}")
+            bump_timetable_version(cur, semester_id)
         conn.commit()
         cur.close()
         # print(f"SCHEDULER: 成功删除 {deleted_count} 条旧记录。")
@@ -897,50 +1803,137 @@ def clear_db_for_semester(semester_id, get_connection_func):
         if cur: cur.close()
         if conn: conn.close()
 
-def save_schedule_to_db(schedule_entries, get_connection_func):
-    if not schedule_entries:
-        # print("SCHEDULER: 没有排课条目需要保存。")
-        return 0
-    conn_save = None
-    cur_save = None
-    inserted_count = 0
+def replace_semester_schedule(semester_id, schedule_entries, get_connection_func, copy_format='text'):
+    """
+    用新的排课结果整体替换学期课表 (一个事务内的行交换)。
+    1. 新结果 COPY 到本会话的临时暂存表 (提交或回滚时自动删除)，此时不触碰课表表；
+    2. 同一事务中删除该学期的放置与单周条目，再从暂存表 INSERT ... SELECT 写入新放置。
+    全程只有行级写入，不对父表或分区做 DDL/TRUNCATE，只持有 ROW EXCLUSIVE 锁：任何学期的读者都不会被阻塞，
+    提交前读到完整的旧课表，提交后读到完整的新课表；排课或写入失败时整个事务回滚，旧课表保持不变。
+    课表版本号由 migrations/0010 的触发器随 DELETE/INSERT 递增。
+    返回 (删除的旧记录数, 写入的放置行数, 每秒写入行数)。
+    """
+    semester_id = int(semester_id)
+    staging = 'timetable_placements_staging'
+    columns = ', '.join(('id',) + PLACEMENT_COPY_COLUMNS)
+    conn = None
+    cur = None
     try:
-        conn_save = get_connection_func()
-        cur_save = conn_save.cursor()
-
-        insert_query = """
-            INSERT INTO timetable_entries
-            (semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id)
-            VALUES %s
-        """
+        conn = get_connection_func()
+        cur = conn.cursor()
+        # 学期第一次排课时才需要建分区 (短暂锁住父表)，单独提交，不与写入课表放在同一事务中
+        ensure_semester_partitions(cur, semester_id)
+        conn.commit()
 
-        data_to_insert = [
-            (e.semester_id, e.major_id, e.course_id, e.teacher_id, e.classroom_id, e.timeslot_id, e.week_number,
-             e.assignment_id)
-            for e in schedule_entries
-        ]
+        cur.execute(f"CREATE TEMP TABLE {staging} (LIKE timetable_placements INCLUDING DEFAULTS) ON COMMIT DROP")
+        staged_count, copy_seconds = copy_placements(cur, schedule_entries, copy_format, table=staging)
+        rows_per_second = _rows_per_second(staged_count, copy_seconds)
+        print(f"SCHEDULER: 学期 {semester_id} 的 {staged_count} 条放置记录已写入暂存表 (COPY {copy_format}，{rows_per_second} 行/秒)。")
 
-        from psycopg2.extras import execute_values
-        execute_values(cur_save, insert_query, data_to_insert, page_size=max(100, len(data_to_insert)//10))
+        swap_started = time.monotonic()
+        cur.execute("DELETE FROM timetable_placements WHERE semester_id = %s", (semester_id,))
+        deleted_count = cur.rowcount
+        cur.execute("DELETE FROM timetable_entries WHERE semester_id = %s", (semester_id,))
+        deleted_count += cur.rowcount
+        cur.execute(f"INSERT INTO timetable_placements ({columns}) SELECT {columns} FROM {staging}")
+        conn.commit()
+        print(f"SCHEDULER: 学期 {semester_id} 课表已替换：删除旧记录 {deleted_count} 条，"
+              f"替换用时 {time.monotonic() - swap_started:.3f} 秒。")
+        return deleted_count, staged_count, rows_per_second
+    except psycopg2.Error as e:
+        print(f"SCHEDULER: 替换学期 {semester_id} 的课表时出错，原课表保持不变: {e}")
+        if conn: conn.rollback()
+        raise
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
 
-        inserted_count = len(data_to_insert) # Assume all attempted rows are inserted if no error
-        conn_save.commit()
+def load_semester_timetable_entries(semester_id, get_connection_func):
+    """读取学期内已保存的课表 (放置按周展开，另含单周条目)，用于增量重排。"""
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute("""
+            SELECT id, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id
+            FROM timetable_entries_expanded WHERE semester_id = %s
+        """, (semester_id,))
+        return [TimetableEntry(**row) for row in cur.fetchall()]
+    except psycopg2.Error as e:
+        print(f"SCHEDULER: 读取学期 {semester_id} 的已有课表时出错: {e}")
+        raise
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
 
-        cur_save.close()
-        # print(f"SCHEDULER: 成功保存 {inserted_count} 条排课记录到数据库。")
-        return inserted_count
+def apply_schedule_delta(semester_id, deleted_assignment_ids, new_entries, get_connection_func):
+    """
+    在同一个事务中删除指定任务在本学期的全部课表记录 (放置与单周条目)，并以放置形式插入新条目。
+    返回 (删除行数, 插入的放置行数)。
+    """
+    if not deleted_assignment_ids and not new_entries:
+        return 0, 0
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        deleted_count = 0
+        if deleted_assignment_ids:
+            for table in ('timetable_placements', 'timetable_entries'):
+                cur.execute(f"DELETE FROM {table} WHERE semester_id = %s AND assignment_id = ANY(%s)",
+                            (semester_id, list(deleted_assignment_ids)))
+                deleted_count += cur.rowcount
+        if new_entries:
+            ensure_semester_partitions(cur, semester_id)
+        inserted_count = _insert_placements(cur, new_entries)
+        conn.commit()
+        return deleted_count, inserted_count
     except psycopg2.Error as e:
-        print(f"SCHEDULER: 保存排课结果到数据库时出错: {e}")
-        if conn_save: conn_save.rollback()
-        # import traceback; traceback.print_exc()
-        raise  # Re-raise
-    except Exception as e:
-         print(f"SCHEDULER: 保存记录过程中发生未知错误: {e}")
-         if conn_save: conn_save.rollback()
-         raise
+        print(f"SCHEDULER: 写入增量排课结果时出错: {e}")
+        if conn: conn.rollback()
+        raise
     finally:
-        if cur_save: cur_save.close()
-        if conn_save: conn_save.close()
+        if cur: cur.close()
+        if conn: conn.close()
+
+def mark_teacher_preferences_applied(get_connection_func, semester_id):
+    """排课流程结束后（无论成功或失败）把该学期的教师偏好状态更新为已应用。"""
+    # --- START: Update teacher preference status ---
+    print(f"SCHEDULER: 排课流程结束，尝试更新学期 {semester_id} 的教师偏好状态...")
+    update_conn = None
+    update_cursor = None
+    try:
+        update_conn = get_connection_func()
+        update_cursor = update_conn.cursor()
+        new_status_value = "applied"
+        # 只更新本学期状态有变化的行；只改 status 不会触发基础数据版本号 (migrations/0011)，
+        # 其它学期的基础数据缓存和导出缓存不受影响
+        update_query = """
+            UPDATE teacher_scheduling_preferences SET status = %s
+            WHERE semester_id = %s AND status IS DISTINCT FROM %s
+        """
+        update_cursor.execute(update_query, (new_status_value, semester_id, new_status_value))
+        update_conn.commit()
+        print(f"SCHEDULER: 已将学期 {semester_id} 的教师偏好状态更新为 '{new_status_value}'。影响行数: {update_cursor.rowcount}")
+
+    except Exception as update_e:
+        print(f"SCHEDULER: 更新教师偏好状态时发生错误: {update_e}")
+        if update_conn:
+            try:
+                update_conn.rollback()
+                print("SCHEDULER: 教师偏好状态更新事务已回滚。")
+            except Exception as rb_e:
+                print(f"SCHEDULER: 回滚教师偏好状态更新事务时发生错误: {rb_e}")
+    finally:
+        if update_cursor:
+            try: update_cursor.close()
+            except: pass
+        if update_conn:
+            try: update_conn.close()
+            except: pass
+        # --- END: Update teacher preference status ---
 
 
 # ==================================
@@ -951,12 +1944,24 @@ import random
 # Assume necessary classes (Course, Major, etc.) and functions are defined elsewhere and correctly imported.
 # Assume get_connection_func returns a standard DB-API 2 connection object.
 
-def run_full_scheduling_process(target_semester_id, get_connection_func):
+def run_full_scheduling_process(target_semester_id, get_connection_func, max_workers=None, attempts=1, seed=None,
+                                improve_time_budget=None, time_budget=None, progress_callback=None):
     """
     主排课流程函数，被 Flask API 调用。
     返回一个包含排课结果摘要的字典。
     在排课完成后（无论成功或失败）尝试更新所有教师偏好状态。
+    max_workers: 并行求解独立子问题的进程数上限，默认使用 CPU 核数；为 1 时在当前进程中依次排课。
+    attempts: 多起点排课的尝试次数，只保存得分最优的一次；seed 为第一次尝试的随机种子 (默认随机生成)，
+              摘要中的 "seed" 为最优尝试的种子，以 attempts=1 和该种子重跑即可复现同一课表。
+    improve_time_budget: 大于 0 时，在最优尝试之上再进行最多这么多秒的局部搜索改进，统计见摘要 "local_search"。
+    time_budget: 排课的总时间上限 (秒，从调用开始计时，不含最后保存课表)。到点后使用目前为止最优的可行课表保存并返回；
+                 至少完成一次排课尝试。未指定 improve_time_budget 时，多起点尝试剩下的时间全部用于局部搜索。
+    progress_callback: 可选，接收进度字典 (stage, total_majors, processed_majors, scheduled_entries,
+                       attempts_completed, unscheduled_sessions)；回调中抛出 SchedulingCancelled 可中止排课，
+                       此时不会改动已保存的课表，摘要状态为 "cancelled"。
     """
+    started = time.monotonic()
+    deadline = started + time_budget if time_budget else None
     print(f"SCHEDULER: 开始执行学期 ID {target_semester_id} 的自动排课程序...")
     summary = {
         "status": "failure",
@@ -965,16 +1970,39 @@ def run_full_scheduling_process(target_semester_id, get_connection_func):
         "total_scheduled_entries": 0,
         "total_conflicts": 0, # Note: Conflicts now primarily reflect Week 1 issues or inter-major conflicts during replication
         "total_uncompleted_tasks": 0,
+        "independent_components": 0,
+        "seed": None,
+        "attempts": [],  # 每次尝试的种子与得分
+        "local_search": None,  # 局部搜索改进阶段的统计 (未启用时为 None)
+        "time_budget": time_budget,
+        "search_seconds": 0.0,  # 多起点尝试与局部搜索实际用时
         "db_records_cleared": 0,
         "db_records_saved": 0,
+        "db_rows_per_second": 0.0,  # COPY 写入速度 (行/秒)
         "details": []  # For per-major messages or errors
     }
 
     all_data = None
     all_assignments_in_semester = defaultdict(dict)
 
+    progress = {"stage": "loading", "total_majors": 0, "processed_majors": 0, "scheduled_entries": 0,
+                "attempts_completed": 0, "unscheduled_sessions": None}
+    entries_by_major = {}  # 已排完专业的条目数 (按专业去重，进程池回退重排时不会重复计数)
+
+    def report_progress(**changes):
+        progress.update(changes)
+        if progress_callback: progress_callback(dict(progress))
+
+    def on_major_done(major_id, result):
+        entries_by_major[major_id] = len(result.get('schedule', []))
+        report_progress(processed_majors=len(entries_by_major), scheduled_entries=sum(entries_by_major.values()))
+
+    def on_attempt_done(score):
+        report_progress(attempts_completed=progress["attempts_completed"] + 1)
+
     try:
-        all_data = load_data_from_db(get_connection_func)
+        report_progress()
+        all_data = load_semester_data_from_db(target_semester_id, get_connection_func)
         if not all_data:
             summary["message"] = "数据加载失败。"
             return summary # Finally block will still run
@@ -998,15 +2026,7 @@ def run_full_scheduling_process(target_semester_id, get_connection_func):
             summary["status"] = "success_no_tasks"
             return summary # Finally block will still run
 
-        clear_success, cleared_count = clear_db_for_semester(target_semester_id, get_connection_func)
-        summary["db_records_cleared"] = cleared_count
-        if not clear_success:
-             summary["message"] = "清空旧排课记录失败。"
-             summary["status"] = "error"
-             return summary # Finally block will still run
-
         all_final_schedule_entries_for_semester = []
-        master_global_timetable_state = {'teacher_schedule': set(), 'classroom_schedule': set(), 'major_schedule': set()}
 
         # Define a safe sort key function
         def get_major_sort_key(major_id):
@@ -1015,31 +2035,47 @@ def run_full_scheduling_process(target_semester_id, get_connection_func):
 
         sorted_major_ids = sorted(list(majors_in_semester), key=get_major_sort_key)
 
+        # 按共享教师/稀缺教室划分子问题，各自在独立的全局状态上排课，合并时解决普通教室的争用
+        components = build_major_conflict_components(sorted_major_ids, all_assignments_in_semester, all_data)
+        summary["independent_components"] = len(components)
+        report_progress(stage="scheduling", total_majors=len(sorted_major_ids))
+        print(f"SCHEDULER: {len(sorted_major_ids)} 个专业划分为 {len(components)} 个互不冲突的子问题。")
+        base_seed = seed if seed is not None else random.SystemRandom().randrange(2 ** 31)
+        best_attempt, attempt_scores = run_multi_start_scheduling(
+            attempts, base_seed, components, all_data, current_semester, all_assignments_in_semester, max_workers,
+            deadline=deadline, on_major_done=on_major_done, on_attempt_done=on_attempt_done)
+        results_by_major = best_attempt['results_by_major']
+        summary["seed"] = best_attempt['seed']
+        summary["attempts"] = attempt_scores
+        print(f"SCHEDULER: 共进行 {len(attempt_scores)} 次排课尝试，最优种子 {best_attempt['seed']} "
+              f"(未排课时 {best_attempt['unscheduled_sessions']}, 冲突 {best_attempt['conflicts']})。")
+        if deadline is not None:
+            time_left = deadline - time.monotonic()
+            improve_time_budget = time_left if improve_time_budget is None else min(improve_time_budget, time_left)
+        report_progress(processed_majors=len(results_by_major),
+                        scheduled_entries=sum(len(r.get('schedule', [])) for r in results_by_major.values()),
+                        unscheduled_sessions=best_attempt['unscheduled_sessions'])
+        if improve_time_budget and improve_time_budget > 0:
+            report_progress(stage="improving")
+            results_by_major, summary["local_search"] = improve_schedule_with_local_search(
+                results_by_major, all_data, current_semester, all_assignments_in_semester,
+                improve_time_budget, seed=best_attempt['seed'],
+                progress_callback=lambda unscheduled: report_progress(unscheduled_sessions=unscheduled))
+        summary["search_seconds"] = round(time.monotonic() - started, 3)
+
         for major_id in sorted_major_ids:
             current_major = all_data['majors'].get(major_id)
-            assignments_for_this_major = all_assignments_in_semester.get(major_id, {})
             major_name = current_major.name if current_major else f"未知专业ID_{major_id}"
 
             major_detail_msg = f"专业 '{major_name}' (ID: {major_id}): "
-            if not assignments_for_this_major:
+            schedule_result_obj = results_by_major.get(major_id)
+            if schedule_result_obj is None:
                 major_detail_msg += "没有教学任务，跳过。"
                 summary["details"].append(major_detail_msg)
                 continue
 
-            initial_template_dp, unscheduled_pool = generate_initial_template(assignments_for_this_major, all_data)
-            major_obj_for_scheduling = current_major if current_major else type('MajorDummy', (object,), {'id': major_id, 'name': major_name})()
-
-            # Call the MODIFIED scheduling function
-            schedule_result_obj = schedule_with_generated_template(
-                assignments_for_this_major, current_semester,
-                major_obj_for_scheduling,
-                all_data, initial_template_dp, unscheduled_pool,
-                master_global_timetable_state  # Pass and update global state
-            )
-
             major_schedule = schedule_result_obj.get('schedule', [])
             all_final_schedule_entries_for_semester.extend(major_schedule)
-            # Global state is updated inside the function now
 
             num_scheduled_major = len(major_schedule)
             major_conflicts_log = schedule_result_obj.get('conflicts', []) # Now reflects W1/replication conflicts
@@ -1057,15 +2093,24 @@ def run_full_scheduling_process(target_semester_id, get_connection_func):
                  major_detail_msg += f" 未完成任务 {num_uncompleted_major}个。"
             summary["details"].append(major_detail_msg)
 
-        if all_final_schedule_entries_for_semester:
-            saved_count_total = save_schedule_to_db(all_final_schedule_entries_for_semester, get_connection_func)
-            summary["db_records_saved"] = saved_count_total
+        # 最后一个可取消的检查点：此后新课表写入暂存表并在一个事务内替换旧课表
+        report_progress(stage="saving", scheduled_entries=len(all_final_schedule_entries_for_semester))
+        cleared_count, saved_count_total, rows_per_second = replace_semester_schedule(
+            target_semester_id, all_final_schedule_entries_for_semester, get_connection_func)
+        summary["db_records_cleared"] = cleared_count
+        summary["db_records_saved"] = saved_count_total
+        summary["db_rows_per_second"] = rows_per_second
 
         summary["status"] = "success"
-        summary["message"] = f"学期 {target_semester_id} 排课完成 (采用固定周模板策略)。"
+        summary["message"] = f"学期 {target_semester_id} 排课完成 (采用固定周模板策略，随机种子 {summary['seed']})。"
         if summary["total_conflicts"] > 0:
             summary["message"] += f" 总记录冲突: {summary['total_conflicts']}次。"
 
+    except SchedulingCancelled:
+        print(f"SCHEDULER: 学期 ID {target_semester_id} 的排课已被取消，数据库中的课表保持不变。")
+        summary["message"] = "排课已取消，原有课表未被修改。"
+        summary["status"] = "cancelled"
+
     except Exception as e:
         print(f"SCHEDULER: 排课主流程发生严重错误: {e}")
         import traceback; traceback.print_exc() # Keep traceback for debugging errors
@@ -1073,42 +2118,120 @@ def run_full_scheduling_process(target_semester_id, get_connection_func):
         summary["status"] = "error"
 
     finally:
-        # --- START: Update teacher preference status ---
-        print("SCHEDULER: 排课流程结束，尝试更新所有教师偏好状态...")
-        update_conn = None
-        update_cursor = None
-        try:
-            update_conn = get_connection_func()
-            update_cursor = update_conn.cursor()
-            # --- Update ALL preferences status ---
-            # IMPORTANT: Define the status value used in your DB
-            new_status_value = "applied" # Example: use 'applied', 'processed', etc.
-            # Consider if you only want to update preferences for the processed semester
-            # or only those that were initially 'pending' etc. Add WHERE clause if needed.
-            # Example: WHERE semester_id = %s AND status = 'pending'
-            update_query = "UPDATE teacher_scheduling_preferences SET status = %s"
-            # Execute the query - pass status as a tuple even if only one value
-            update_cursor.execute(update_query, (new_status_value,))
-            update_conn.commit()
-            print(f"SCHEDULER: 已尝试更新数据库中所有教师偏好状态为 '{new_status_value}'。影响行数: {update_cursor.rowcount}") # rowcount might work
-
-        except Exception as update_e:
-            print(f"SCHEDULER: 在 finally 块中更新教师偏好状态时发生错误: {update_e}")
-            if update_conn:
-                try:
-                    update_conn.rollback()
-                    print("SCHEDULER: 教师偏好状态更新事务已回滚。")
-                except Exception as rb_e:
-                    print(f"SCHEDULER: 回滚教师偏好状态更新事务时发生错误: {rb_e}")
-        finally:
-            if update_cursor:
-                try: update_cursor.close()
-                except: pass
-            if update_conn:
-                try: update_conn.close()
-                except: pass
-            # --- END: Update teacher preference status ---
+        mark_teacher_preferences_applied(get_connection_func, target_semester_id)
 
         return summary
 
+def run_incremental_scheduling_process(target_semester_id, get_connection_func, progress_callback=None):
+    """
+    增量排课：把学期内已保存的课表载入占用状态，只为新增、修改或未排满的教学任务重新安排课时，
+    并只把差异 (删除的条目与新条目) 写回数据库，其余条目保持不变。
+    progress_callback 的用法与 run_full_scheduling_process 相同。
+    """
+    print(f"SCHEDULER: 开始执行学期 ID {target_semester_id} 的增量排课...")
+    summary = {
+        "status": "failure",
+        "message": "",
+        "mode": "incremental",
+        "added_assignments": 0,
+        "removed_assignments": 0,
+        "modified_assignments": 0,
+        "incomplete_assignments": 0,
+        "kept_entries": 0,
+        "total_scheduled_entries": 0,  # 本次新生成的条目数
+        "total_uncompleted_tasks": 0,
+        "unscheduled_details": [],
+        "db_records_deleted": 0,
+        "db_records_saved": 0,
+    }
+    progress = {"stage": "loading", "total_assignments": 0, "processed_assignments": 0, "scheduled_entries": 0}
+
+    def report_progress(**changes):
+        progress.update(changes)
+        if progress_callback: progress_callback(dict(progress))
+
+    try:
+        report_progress()
+        all_data = load_semester_data_from_db(target_semester_id, get_connection_func)
+        if not all_data:
+            summary["message"] = "数据加载失败。"
+            return summary
+        current_semester = all_data['semesters'].get(target_semester_id)
+        if not current_semester:
+            summary["message"] = f"未找到 ID 为 {target_semester_id} 的学期信息。"
+            return summary
+        if current_semester.total_weeks <= 0:
+            summary["message"] = f"目标学期 '{current_semester.name}' (ID: {target_semester_id}) 总周数 ({current_semester.total_weeks}) 无效。"
+            return summary
+
+        assignments = {aid: assign for aid, assign in all_data['course_assignments'].items()
+                       if assign.semester_id == target_semester_id}
+        existing_entries = load_semester_timetable_entries(target_semester_id, get_connection_func)
+        diff = diff_semester_assignments(existing_entries, assignments, all_data)
+        summary["added_assignments"] = len(diff['added'])
+        summary["removed_assignments"] = len(diff['removed'])
+        summary["modified_assignments"] = len(diff['modified'])
+        summary["incomplete_assignments"] = len(diff['incomplete'])
+        summary["kept_entries"] = len(diff['kept_entries'])
+        print(f"SCHEDULER: 已有条目 {len(existing_entries)} 条；新增任务 {len(diff['added'])}，删除任务 {len(diff['removed'])}，"
+              f"修改任务 {len(diff['modified'])}，未排满任务 {len(diff['incomplete'])}。")
+
+        # 载入保留的条目：按 (任务, 时间段, 教室) 聚合后整段标记
+        timetable_state = create_timetable_state(all_data, current_semester.total_weeks)
+        kept_weeks = defaultdict(list)
+        for entry in diff['kept_entries']:
+            if 0 < entry.week_number <= current_semester.total_weeks:
+                kept_weeks[(entry.teacher_id, entry.classroom_id, entry.major_id, entry.timeslot_id)].append(entry.week_number)
+        for (teacher_id, classroom_id, major_id, timeslot_id), weeks in kept_weeks.items():
+            if timeslot_id in timetable_state['timeslot_index']:
+                mark_slot_occupied(timetable_state, teacher_id, classroom_id, major_id, weeks, timeslot_id)
+
+        # 按核心课优先、人数多者优先的顺序补排
+        to_place = sorted(diff['sessions_to_place'].items(),
+                          key=lambda item: (not assignments[item[0]].is_core_course,
+                                            -(assignments[item[0]].expected_students or 0), item[0]))
+        report_progress(stage="scheduling", total_assignments=len(to_place))
+        new_entries = []
+        for index, (aid, sessions) in enumerate(to_place):
+            assign = assignments[aid]
+            placed_entries, remaining = place_assignment_sessions(timetable_state, assign, sessions, all_data,
+                                                                  current_semester)
+            new_entries.extend(placed_entries)
+            if remaining > 0:
+                summary["unscheduled_details"].append(_unscheduled_detail(assign, remaining, all_data))
+            report_progress(processed_assignments=index + 1, scheduled_entries=len(new_entries))
+        summary["total_scheduled_entries"] = len(new_entries)
+        summary["total_uncompleted_tasks"] = len(summary["unscheduled_details"])
+
+        report_progress(stage="saving")
+        deleted_count, saved_count = apply_schedule_delta(target_semester_id, diff['deleted_assignment_ids'], new_entries,
+                                                          get_connection_func)
+        summary["db_records_deleted"] = deleted_count
+        summary["db_records_saved"] = saved_count
+
+        summary["status"] = "success"
+        if not diff['deleted_assignment_ids'] and not to_place:
+            summary["message"] = f"学期 {target_semester_id} 的教学任务没有变化，无需重新排课。"
+        else:
+            summary["message"] = (f"学期 {target_semester_id} 增量排课完成：删除 {deleted_count} 条、新增 {saved_count} 条课表记录，"
+                                  f"其余 {len(diff['kept_entries'])} 个已排课时保持不变。")
+            if summary["total_uncompleted_tasks"] > 0:
+                summary["message"] += f" 仍有 {summary['total_uncompleted_tasks']} 个任务未排满。"
+
+    except SchedulingCancelled:
+        print(f"SCHEDULER: 学期 ID {target_semester_id} 的增量排课已被取消，数据库中的课表保持不变。")
+        summary["message"] = "排课已取消，原有课表未被修改。"
+        summary["status"] = "cancelled"
+
+    except Exception as e:
+        print(f"SCHEDULER: 增量排课发生严重错误: {e}")
+        import traceback; traceback.print_exc()
+        summary["message"] = f"增量排课过程中发生错误: {str(e)}"
+        summary["status"] = "error"
+
+    finally:
+        mark_teacher_preferences_applied(get_connection_func, target_semester_id)
+
+    return summary
+
 # --- End of scheduler_module.py ---
@@ -0,0 +1,75 @@
+import datetime
+import os
+import sys
+from collections import Counter
+
+import pytest
+
+# 后端模块都在 backend/ 下以顶层模块方式导入 (与 app.py 相同)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scheduler_module as sm  # noqa: E402
+
+
+@pytest.fixture
+def semester_data():
+    """
+    接近真实的一个学期：6 个专业，各自的任课教师 (专业 1、2 共用一名教师)，
+    全校共用的普通教室 (容量 40~120) 和 3 间实验室，以及唯一一间 200 人阶梯教室 (专业 3、4 的大课都只能用它)。
+    """
+    days = ['周一', '周二', '周三', '周四', '周五']
+    timeslots = {}
+    for day_index, day in enumerate(days):
+        for period in range(1, 5):
+            ts_id = day_index * 4 + period
+            start = datetime.time(8 + 2 * (period - 1))
+            timeslots[ts_id] = sm.TimeSlot(ts_id, day, period, start, start.replace(minute=45))
+    classrooms = {room_id: sm.Classroom(room_id, f"教学楼-{room_id}", 40 + 10 * (room_id % 9), '普通教室')
+                  for room_id in range(1, 13)}
+    classrooms.update({room_id: sm.Classroom(room_id, f"实验楼-{room_id}", 50, '实验室') for room_id in (21, 22, 23)})
+    classrooms[31] = sm.Classroom(31, '阶梯教室', 200, '普通教室')
+
+    majors, teachers, courses, assignments = {}, {}, {}, {}
+    for major_id in range(1, 7):
+        majors[major_id] = sm.Major(major_id, f"专业{major_id}")
+        for index in range(5):
+            teacher_id = major_id * 10 + index
+            if major_id == 2 and index == 0:
+                teacher_id = 10  # 与专业 1 共用的教师
+            teachers[teacher_id] = sm.Teacher(teacher_id, teacher_id, f"教师{teacher_id}")
+            course_id = major_id * 10 + index
+            courses[course_id] = sm.Course(course_id, f"课程{course_id}", 32, '实验课' if index == 4 else '理论课')
+            students = 180 if major_id in (3, 4) and index == 0 else 45
+            assignments[course_id] = sm.CourseAssignment(course_id, major_id, course_id, teacher_id, 1,
+                                                         index < 2, students)
+    return {
+        'semesters': {1: sm.Semester(1, '测试学期', datetime.date(2024, 2, 26), datetime.date(2024, 6, 14), 16)},
+        'majors': majors, 'teachers': teachers, 'courses': courses, 'classrooms': classrooms,
+        'timeslots': timeslots,
+        'timeslot_lookup': {(ts.day_of_week, ts.period): ts.id for ts in timeslots.values()},
+        'course_assignments': assignments,
+        'approved_avoid_preferences': set(),
+    }
+
+
+@pytest.fixture
+def assignments_by_major(semester_data):
+    by_major = {}
+    for assign_id, assign in semester_data['course_assignments'].items():
+        by_major.setdefault(assign.major_id, {})[assign_id] = assign
+    return by_major
+
+
+def assert_consistent_schedule(all_data, results):
+    """课表中没有教室/教师/专业的重复占用，且每个任务的已排与未排课时之和等于课程总课时。"""
+    entries = [entry for result in results.values() for entry in result['schedule']]
+    for key in ('classroom_id', 'teacher_id', 'major_id'):
+        usage = Counter((getattr(entry, key), entry.week_number, entry.timeslot_id) for entry in entries)
+        assert max(usage.values()) == 1, key
+    # 每个任务的已排与未排课时之和仍等于课程总课时
+    scheduled = Counter(entry.assignment_id for entry in entries)
+    for result in results.values():
+        for detail in result['unscheduled_details']:
+            scheduled[detail['assignment_id']] += detail['remaining_sessions']
+    assert all(scheduled[assign_id] == all_data['courses'][assign.course_id].total_sessions
+               for assign_id, assign in all_data['course_assignments'].items())
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+import scheduler_module as sm
+from conftest import assert_consistent_schedule
+
+
+def test_shared_ordinary_classrooms_do_not_merge_components(semester_data, assignments_by_major):
+    all_data, by_major = semester_data, assignments_by_major
+    components = sm.build_major_conflict_components(sorted(by_major), by_major, all_data)
+    # 专业 1、2 共用教师，专业 3、4 共用唯一的阶梯教室；其余专业只共享普通教室和实验室
+    assert components == [[1, 2], [3, 4], [5], [6]]
+
+
+def test_merged_components_have_no_double_bookings(semester_data, assignments_by_major):
+    all_data, by_major = semester_data, assignments_by_major
+    components = sm.build_major_conflict_components(sorted(by_major), by_major, all_data)
+    semester = all_data['semesters'][1]
+    results = sm.schedule_components(components, all_data, semester, by_major, max_workers=1, seed=7)
+
+    assert_consistent_schedule(all_data, results)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import io
+
+import course_plan_import as cpi
+
+HEADER = "学期名称,专业名称,课程名称,总课时,课程类型,授课教师姓名,是否核心课程,预计学生人数\n"
+
+
+def test_csv_rows_are_numbered_by_file_line():
+    # 第 2、4、5 行为空行，第 6 行的记录在引号内换行 (占第 6、7 行)
+    data = (HEADER + "\n秋,软件,高数,32,理论课,王,是,50\n\n\n秋,软件,\"多\n行\",32,理论课,王,,\n"
+            "秋,软件,英语,,理论课,李,否,40\n").encode('utf-8-sig')
+    _, _, chunks = cpi.open_course_plan_reader(io.BytesIO(data), 'plan.csv', chunk_rows=2)
+    rows = [(index + 2, row['课程名称'], row['总课时']) for chunk in chunks for index, row in chunk.iterrows()]
+    assert rows == [(3, '高数', '32'), (6, '多\n行', '32'), (8, '英语', None)]
+
+
+# --- 差异导入：用内存中的基础数据和教学任务代替数据库 ---
+SEMESTER_ID = 3
+MAJORS = {'软件工程': 1, '网络工程': 2}
+TEACHER_USERS = {'王老师': 11, '李老师': 12}
+TEACHERS = {11: 101, 12: 102}
+COURSES = {'高等数学': 201, '大学英语': 202}
+NAME_LOOKUPS = {'majors': MAJORS, 'users': TEACHER_USERS, 'teachers': TEACHERS, 'courses': COURSES}
+
+
+class FakeDatabase:
+    def __init__(self, assignments):
+        self.assignments = {row[0]: row for row in assignments}  # id -> (id, 专业, 课程, 教师, 是否核心, 人数)
+        self.inserted, self.updated, self.deleted = [], [], []
+
+    def execute_values(self, cur, sql, argslist, page_size=None, fetch=False):
+        if 'INSERT INTO course_assignments' in sql:
+            self.inserted += argslist
+        elif 'UPDATE course_assignments' in sql:
+            self.updated += argslist
+        return [] if fetch else None  # 课程均已存在且未变化
+
+    def connect(self):
+        return FakeConnection(self)
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self):
+        return FakeCursor(self.db)
+
+    def commit(self): pass
+
+    def rollback(self): pass
+
+    def close(self): pass
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.result = []
+        self.rowcount = -1
+
+    def execute(self, query, params=None):
+        query = ' '.join(query.split())
+        if query.startswith('SELECT name FROM semesters'):
+            self.result = [('2026秋',)]
+        elif query.startswith('SELECT id, major_id, course_id, teacher_id'):
+            self.result = sorted(self.db.assignments.values())
+        elif '= ANY(%s)' in query and query.startswith('SELECT'):
+            lookup = NAME_LOOKUPS[query.split(' FROM ')[1].split()[0]]
+            self.result = [(name, lookup[name]) for name in params[0] if name in lookup]
+        elif query.startswith('DELETE FROM course_assignments ca USING'):
+            names = {table: {v: k for k, v in lookup.items()} for table, lookup in NAME_LOOKUPS.items()}
+            self.result = []
+            for assignment_id in params[0]:
+                _, major_id, course_id, teacher_id, is_core, expected = self.db.assignments.pop(assignment_id)
+                self.db.deleted.append(assignment_id)
+                self.result.append((assignment_id, names['majors'][major_id], names['courses'][course_id],
+                                    names['users'][names['teachers'][teacher_id]], is_core, expected))
+            self.rowcount = len(self.result)
+        else:
+            raise AssertionError(f"unexpected query: {query}")
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+    def fetchall(self):
+        return list(self.result)
+
+    def close(self): pass
+
+
+def run_diff_import(monkeypatch, existing, lines):
+    db = FakeDatabase(existing)
+    monkeypatch.setattr(cpi, 'execute_values', db.execute_values)
+    data = (HEADER + ''.join(line + '\n' for line in lines)).encode('utf-8')
+    summary = cpi.import_course_plans(io.BytesIO(data), 'plan.csv', SEMESTER_ID, db.connect,
+                                      mode=cpi.IMPORT_MODE_DIFF)
+    return db, summary
+
+
+def test_diff_import_matches_repeated_keys_one_to_one(monkeypatch):
+    existing = [(1, 1, 201, 101, False, 50), (2, 1, 201, 101, False, 50), (3, 1, 201, 101, False, 60),
+                (4, 1, 202, 102, False, 40)]
+    db, summary = run_diff_import(monkeypatch, existing, [
+        '2026秋,软件工程,高等数学,64,理论课,王老师,否,50',
+        '2026秋,软件工程,高等数学,64,理论课,王老师,否,80',
+        '2026秋,网络工程,高等数学,64,理论课,王老师,是,30',
+    ])
+
+    # 同键的两行依次匹配任务 1、2 (1 不变，2 更新)，同键的第三条任务 3 和文件中没有的任务 4 被删除
+    assert db.inserted == [(2, 201, 101, SEMESTER_ID, True, 30)]
+    assert db.updated == [(2, False, 80)]
+    assert sorted(db.deleted) == [3, 4]
+    assert (summary['unchanged_assignments'], summary['inserted_assignments'], summary['updated_assignments'],
+            summary['deleted_assignments'], summary['kept_unmatched_assignments']) == (1, 1, 1, 2, 0)
+    assert [item['assignment_id'] for item in summary['diff']['updated']] == [2]
+    assert sorted(item['assignment_id'] for item in summary['diff']['deleted']) == [3, 4]
+
+
+def test_diff_import_keeps_unmatched_assignments_when_rows_are_skipped(monkeypatch):
+    existing = [(1, 1, 201, 101, False, 50), (2, 1, 201, 101, False, 50), (4, 1, 202, 102, False, 40)]
+    db, summary = run_diff_import(monkeypatch, existing, [
+        '2026秋,软件工程,高等数学,64,理论课,王老师,否,50',
+        '2026秋,不存在的专业,大学英语,32,理论课,李老师,否,40',
+    ])
+
+    # 第 3 行被跳过，它可能正对应未匹配的任务，因此任务 2、4 都保留
+    assert (db.inserted, db.updated, db.deleted) == ([], [], [])
+    assert summary['error_rows'] == 1
+    assert summary['errors'][0].startswith('Row 3: ')
+    assert (summary['unchanged_assignments'], summary['kept_unmatched_assignments']) == (1, 2)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+import ical_export
+import scheduler_module as sm
+
+TZ = ical_export.ICS_TIMEZONE
+
+
+def calendar_data():
+    # 学期从周四开始：第 1 周为 start_date 所在的周，周三的课第 1 周为 2026-09-09
+    semester = sm.Semester(1, '2026秋', datetime.date(2026, 9, 10), datetime.date(2027, 1, 15), 18)
+    all_data = {
+        'timeslots': {3: sm.TimeSlot(3, '周三', 2, datetime.time(10), datetime.time(11, 45))},
+        'courses': {201: sm.Course(201, '高等数学', 64, '理论课')},
+        'teachers': {101: sm.Teacher(101, 11, '王老师')},
+        'majors': {1: sm.Major(1, '软件工程')},
+        'classrooms': {7: sm.Classroom(7, '教学楼-7', 80, '普通教室')},
+    }
+    return semester, all_data
+
+
+def placement(placement_id, weeks):
+    return {'id': placement_id, 'major_id': 1, 'course_id': 201, 'teacher_id': 101, 'classroom_id': 7,
+            'timeslot_id': 3, 'weeks': weeks}
+
+
+def events(semester, all_data, placements, single_entries=()):
+    lines = [line.rstrip('\r\n') for line in ical_export.iter_calendar(semester, placements, single_entries,
+                                                                         all_data, '王老师')]
+    result, current = [], None
+    for line in lines:
+        if line == 'BEGIN:VEVENT':
+            current = []
+        elif line == 'END:VEVENT':
+            result.append(current)
+            current = None
+        elif current is not None and not line.startswith(('UID:', 'DTSTAMP:', 'SUMMARY:', 'LOCATION:',
+                                                          'DESCRIPTION:')):
+            current.append(line)
+    return result
+
+
+def test_placement_with_gaps_recurs_weekly_with_exdates():
+    semester, all_data = calendar_data()
+    # 周次无序且有重复；第 2、4 周被调走
+    assert events(semester, all_data, [placement(5, [6, 3, 1, 5, 3])]) == [[
+        f'DTSTART;TZID={TZ}:20260909T100000',
+        f'DTEND;TZID={TZ}:20260909T114500',
+        'RRULE:FREQ=WEEKLY;COUNT=6',
+        f'EXDATE;TZID={TZ}:20260916T100000,20260930T100000',
+    ]]
+
+
+def test_single_week_placement_and_entry_are_single_events():
+    semester, all_data = calendar_data()
+    entry = dict(placement(9, None), week_number=2)
+    assert events(semester, all_data, [placement(5, [4])], [entry]) == [
+        [f'DTSTART;TZID={TZ}:20260930T100000', f'DTEND;TZID={TZ}:20260930T114500'],
+        [f'DTSTART;TZID={TZ}:20260916T100000', f'DTEND;TZID={TZ}:20260916T114500'],
+    ]
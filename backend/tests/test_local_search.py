@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+import scheduler_module as sm
+from conftest import assert_consistent_schedule
+
+
+def scarce_room_schedule(all_data, by_major):
+    """只保留 3 间普通教室、实验室和阶梯教室，使模板排课留下未排课时。"""
+    all_data['classrooms'] = {room_id: room for room_id, room in all_data['classrooms'].items()
+                              if room_id in (1, 2, 3, 21, 22, 23, 31)}
+    components = sm.build_major_conflict_components(sorted(by_major), by_major, all_data)
+    return sm.schedule_components(components, all_data, all_data['semesters'][1], by_major, max_workers=1, seed=11)
+
+
+def test_local_search_reduces_unscheduled_sessions(semester_data, assignments_by_major):
+    results = scarce_room_schedule(semester_data, assignments_by_major)
+    improved, stats = sm.improve_schedule_with_local_search(
+        results, semester_data, semester_data['semesters'][1], assignments_by_major,
+        time_budget=30, seed=11, max_iterations=3000)
+
+    assert stats['initial_unscheduled_sessions'] > 0
+    assert stats['final_unscheduled_sessions'] < stats['initial_unscheduled_sessions']
+    assert stats['final_unscheduled_sessions'] == sum(detail['remaining_sessions'] for result in improved.values()
+                                                      for detail in result['unscheduled_details'])
+    assert_consistent_schedule(semester_data, improved)
+
@@ -1,116 +1,17 @@
 import psycopg2
+import migrate
+
+DB_PARAMS = dict(database="postgres", user="postgres", password="031104", host="localhost", port="5432")
+#先用迁移工具建表 (migrations/ 目录中的全部版本)
+migrate.apply_migrations(lambda: psycopg2.connect(**DB_PARAMS))
 #建立数据库连接
-con = psycopg2.connect(database="postgres", user="postgres", password="031104", host="localhost", port="5432")
+con = psycopg2.connect(**DB_PARAMS)
 #调用游标对象
 cur = con.cursor()
-#用cursor中的execute 使用DDL语句创建一个名为 STUDENT 的表,指定表的字段以及字段类型
+#用cursor中的execute 插入初始数据
 select_query = """-- 假设 user 'leqijia' 的 id 是 1009 (根据你的 users 插入语句)
 -- SQL for PostgreSQL
--- 1. Create Tables
-
-CREATE TABLE semesters (
-    id INT PRIMARY KEY,
-    name VARCHAR(255) NOT NULL,
-    start_date DATE NOT NULL,
-    end_date DATE NOT NULL
-);
-
-CREATE TABLE majors (
-    id INT PRIMARY KEY,
-    name VARCHAR(255) NOT NULL UNIQUE
-);
-
-CREATE TABLE courses (
-    id SERIAL PRIMARY KEY,
-    name VARCHAR(255) NOT NULL,
-    total_sessions INT NOT NULL CHECK (total_sessions >= 0),
-    course_type VARCHAR(50) DEFAULT '理论课'
-);
-
-CREATE TABLE users (
-    id SERIAL PRIMARY KEY,
-    username VARCHAR(255) NOT NULL UNIQUE,
-    password VARCHAR(255) NOT NULL, -- WARNING: Plain text password! Use hashing in production.
-    role VARCHAR(50) NOT NULL
-);
-
-CREATE TABLE teachers (
-    id SERIAL PRIMARY KEY,
-    user_id INT NOT NULL UNIQUE REFERENCES users(id) ON DELETE CASCADE -- Link to the user account
-);
-
--- Junction table for M:N relationship between teachers and the courses they can teach
-CREATE TABLE teacher_course_permissions (
-    teacher_id INT NOT NULL REFERENCES teachers(id) ON DELETE CASCADE,
-    course_id INT NOT NULL REFERENCES courses(id) ON DELETE CASCADE,
-    PRIMARY KEY (teacher_id, course_id) -- Ensure unique pairings
-);
-
-CREATE TABLE classrooms (
-    id INT PRIMARY KEY,
-    building VARCHAR(100) NOT NULL,
-    room_number VARCHAR(50) NOT NULL,
-    capacity INT DEFAULT 0 CHECK (capacity >= 0),
-    room_type VARCHAR(50) DEFAULT '普通教室',
-    UNIQUE (building, room_number) -- Optional: Ensure building/room combo is unique
-);
-
-CREATE TABLE time_slots (
-    id INT PRIMARY KEY,
-    day_of_week VARCHAR(10) NOT NULL, -- e.g., '周一', '周二'
-    period INT NOT NULL, -- e.g., 1, 2, 3, 4
-    start_time TIME NOT NULL,
-    end_time TIME NOT NULL,
-    UNIQUE (day_of_week, period) -- Ensure unique day/period combo
-);
-
--- Use SERIAL for automatic ID generation if preferred, otherwise manage IDs manually
--- CREATE SEQUENCE course_assignments_id_seq; -- Or use SERIAL directly
-CREATE TABLE course_assignments (
-    id SERIAL PRIMARY KEY, -- Or: id SERIAL PRIMARY KEY
-    major_id INT NOT NULL REFERENCES majors(id),
-    course_id INT NOT NULL REFERENCES courses(id),
-    teacher_id INT NOT NULL REFERENCES teachers(id),
-    semester_id INT NOT NULL REFERENCES semesters(id),
-    is_core_course BOOLEAN DEFAULT FALSE,
-    expected_students INT DEFAULT 0 CHECK (expected_students >= 0)
-    -- Optional: UNIQUE constraint if a specific combo shouldn't be duplicated
-    -- UNIQUE (major_id, course_id, teacher_id, semester_id)
-);
-
--- Table to store the final schedule results (optional, if you want to save results to DB)
-CREATE TABLE timetable_entries (
-    id SERIAL PRIMARY KEY, -- Auto-incrementing ID
-    semester_id INT NOT NULL REFERENCES semesters(id),
-    major_id INT NOT NULL REFERENCES majors(id),
-    course_id INT NOT NULL REFERENCES courses(id),
-    teacher_id INT NOT NULL REFERENCES teachers(id),
-    classroom_id INT NOT NULL REFERENCES classrooms(id),
-    timeslot_id INT NOT NULL REFERENCES time_slots(id),
-    week_number INT NOT NULL CHECK (week_number > 0),
-    assignment_id INT NOT NULL REFERENCES course_assignments(id) ON DELETE CASCADE -- Link back to the assignment
-);
-create TABLE students
-(
-	id SERIAL PRIMARY KEY,
-	user_id INT NOT NULL	REFERENCES users(id) ON DELETE CASCADE,
-	major_id INT NOT NULL REFERENCES majors(id),
-	student_id_number VARCHAR(100) UNIQUE
-);
-create TABLE teacher_scheduling_preferences
-(
-	id SERIAL PRIMARY KEY,
-	teacher_id INT NOT NULL REFERENCES teachers(id) ON DELETE CASCADE,
-	semester_id INT NOT NULL REFERENCES semesters(id) ON DELETE CASCADE,
-	timeslot_id INT NOT NULL REFERENCES time_slots(id) ON DELETE CASCADE,
-	preference_type VARCHAR(50) NOT NULL,
-	reason TEXT,
-	status VARCHAR(50) DEFAULT 'pending'::character varying,
-	created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-	updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-	constraint teacher_scheduling_preference_teacher_id_semester_id_timesl_key
-		unique (teacher_id, semester_id, timeslot_id, preference_type)
-);
+-- 1. 表结构由 migrations/ 中的版本化迁移创建 (见上方 migrate.apply_migrations)
 
 -- 2. Insert Data
 
@@ -118,6 +19,10 @@ create TABLE teacher_scheduling_preferences
 INSERT INTO semesters (id, name, start_date, end_date) VALUES
 (1, '2023-2024学年秋季', '2023-09-04', '2024-01-19');
 
+-- Timetable partitions for each semester (the scheduler creates them automatically for new semesters)
+CREATE TABLE IF NOT EXISTS timetable_entries_s1 PARTITION OF timetable_entries FOR VALUES IN (1);
+CREATE TABLE IF NOT EXISTS timetable_placements_s1 PARTITION OF timetable_placements FOR VALUES IN (1);
+
 
 
 -- Insert Majors
@@ -260,16 +165,6 @@ INSERT INTO course_assignments (id, major_id, course_id, teacher_id, semester_id
 (44, 5, 602, 6, 1, TRUE, 55), (45, 5, 603, 7, 1, TRUE, 55), (46, 5, 604, 7, 1, FALSE, 55),
 (47, 5, 605, 8, 1, TRUE, 55);
 
--- Add indexes for performance on foreign keys and frequently queried columns
-CREATE INDEX idx_course_assignments_major ON course_assignments (major_id);
-CREATE INDEX idx_course_assignments_course ON course_assignments (course_id);
-CREATE INDEX idx_course_assignments_teacher ON course_assignments (teacher_id);
-CREATE INDEX idx_course_assignments_semester ON course_assignments (semester_id);
-CREATE INDEX idx_timetable_entries_week ON timetable_entries (week_number);
-CREATE INDEX idx_timetable_entries_timeslot ON timetable_entries (timeslot_id);
-CREATE INDEX idx_timetable_entries_classroom ON timetable_entries (classroom_id);
-CREATE INDEX idx_teacher_course_permissions_course ON teacher_course_permissions (course_id);
-
 """
 cur.execute(select_query)
 # records = cur.fetchall()